@@ -0,0 +1,256 @@
+import argparse
+import glob
+import json
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict, deque
+
+from country_index import DATA_DIR, UNKNOWN, get_index, read_csv
+from results_store import iter_records
+from work_planner import DEFAULT_OUTPUTS
+
+# Affiliation parts naming an institution, in the order they are preferred
+INSTITUTION_WORDS = [
+    (re.compile(r"univers|universit|\buniv\b", re.I), 0.85),
+    (re.compile(r"\b(college|institute|institut|instituto|istituto|school|academy|polytechnic)\b", re.I), 0.6),
+    (re.compile(r"\b(hospital|centre|center|clinic|council|foundation)\b", re.I), 0.5),
+]
+# Institution names must have been returned by the model this often to be trusted
+MIN_LEARNED = 2
+# This script's own outputs match the author output patterns, but hold its guesses rather than the model's answers
+OWN_OUTPUTS = ("_local.json", "_remaining.json")
+
+_punct = re.compile(r"[^\w]+")
+# Stops at ';' so an address does not swallow the separator before the next affiliation
+_email = re.compile(r"[^\s;]+@[^\s;]+|electronic address:[^;]*", re.I)
+
+
+def normalise(text):
+    """
+    Lower case, accents and punctuation removed, padded with spaces so matches fall on word boundaries
+    """
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii")
+    return " " + _punct.sub(" ", text.casefold()).strip() + " "
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton: finds every dictionary phrase in a text in one pass over its characters
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    def add(self, phrase, value):
+        s = 0
+        for ch in phrase:
+            t = self.goto[s].get(ch)
+            if t is None:
+                t = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[s][ch] = t
+            s = t
+        self.out[s].append((len(phrase), value))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for ch, t in self.goto[s].items():
+                queue.append(t)
+                f = self.fail[s]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[t] = self.goto[f].get(ch, 0)
+                self.out[t] = self.out[t] + self.out[self.fail[t]]
+        return self
+
+    def matches(self, text):
+        """
+        Returns list of (start, end, value)
+        """
+        found = []
+        s = 0
+        for i, ch in enumerate(text):
+            while s and ch not in self.goto[s]:
+                s = self.fail[s]
+            s = self.goto[s].get(ch, 0)
+            for n, value in self.out[s]:
+                found.append((i + 1 - n, i + 1, value))
+        return found
+
+
+class AffiliationResolver:
+    """
+    Resolves first author affiliations to {institution, country} without the model when the answer is clear.
+    countries: {normalised alias: country name}, e.g. from data/countries.csv
+    institutions: {institution name: country name or None}, e.g. the 985/211 lists and institutions the model returned before
+    """
+
+    def __init__(self, countries, institutions):
+        self.countries = Automaton()
+        for alias, country in countries.items():
+            # Phrases are matched including their surrounding spaces, so "uk" never matches inside "ukraine"
+            self.countries.add(" {} ".format(alias), country)
+        self.countries.build()
+        self.institutions = Automaton()
+        self.institution_country = {}
+        for name, country in institutions.items():
+            k = normalise(name)
+            if k.strip():
+                self.institutions.add(k, name)
+                self.institution_country[name] = country
+        self.institutions.build()
+
+    def find_country(self, text):
+        """
+        Returns (country, confidence). The country is expected at the end of the affiliation.
+        """
+        found = []
+        for start, end, country in self.countries.matches(text):
+            # Two letter codes such as "CA" or "CN" only count as the last word
+            if end - start <= 4 and end != len(text):
+                continue
+            found.append((end, end - start, country))
+        if not found:
+            return "", 0.5
+        end, _, country = max(found)
+        confidence = 1.0 if end >= len(text) - 12 else 0.7
+        if len({c for _, _, c in found}) > 1:
+            confidence = min(confidence, 0.7)
+        return country, confidence
+
+    def find_institution(self, segment, text):
+        found = self.institutions.matches(text)
+        if found:
+            # Prefer universities, then the first mentioned, then the longest name
+            _, start, length, name = min((0 if "univ" in name.lower() else 1, start, start - end, name) for start, end, name in found)
+            confidence = 1.0 if len({name for _, _, name in found}) == 1 else 0.9
+            return name, confidence
+        parts = [p.strip() for p in segment.split(",")]
+        for pattern, confidence in INSTITUTION_WORDS:
+            for part in parts:
+                if pattern.search(part):
+                    return part, confidence
+        return "", 0.0
+
+    def resolve(self, author_affil):
+        """
+        Returns {"institution", "country", "confidence"}, with confidence in [0, 1]
+        """
+        if isinstance(author_affil, list):
+            author_affil = author_affil[0] if author_affil else ""
+        # Only the first affiliation is used, as the model does
+        segment = _email.sub("", str(author_affil or "")).split(";")[0].strip().rstrip(".")
+        text = normalise(segment)
+        country, country_confidence = self.find_country(text)
+        institution, institution_confidence = self.find_institution(segment, text)
+        known = self.institution_country.get(institution)
+        if known and country and known != country:
+            country_confidence = min(country_confidence, 0.5)
+        return {"institution": institution, "country": country, "confidence": round(min(country_confidence, institution_confidence), 2)}
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR, learn_from=()):
+        """
+        learn_from: author results whose institutions are added to the dictionary, e.g. data/pubmed_authors.json;
+        records this resolver marked as local are skipped
+        """
+        index = get_index("{}/country_index.json".format(data_dir), data_dir=data_dir)
+        # Report countries as data/countries.csv names them, which is what the R analyses join on
+        csv_names = {}
+        for alias, name in read_csv("{}/countries.csv".format(data_dir)):
+            if name not in UNKNOWN and index.lookup(name):
+                csv_names.setdefault(index.lookup(name), name)
+        countries = {}
+        for alias, name in index.aliases.items():
+            if name not in UNKNOWN and alias:
+                countries[alias] = csv_names.get(name, name)
+
+        institutions = {}
+        for tier in ("985", "211"):
+            with open("{}/{}_universities.txt".format(data_dir, tier)) as f:
+                institutions.update({line.strip(): "China" for line in f if line.strip()})
+        seen = defaultdict(Counter)
+        for path in learn_from:
+            for x in iter_records(path):
+                if x.get("source") == "local":
+                    continue
+                if isinstance(x.get("institution"), str) and isinstance(x.get("country"), str):
+                    seen[x["institution"].strip()][x["country"]] += 1
+        for name, counts in seen.items():
+            country, n = counts.most_common(1)[0]
+            # Single words ("Department", "Hospital") are too generic to look for
+            if sum(counts.values()) >= MIN_LEARNED and len(name.split()) > 1:
+                institutions.setdefault(name, csv_names.get(index.resolve(country), country) if n / sum(counts.values()) >= 0.9 else None)
+        return cls(countries, institutions)
+
+
+def resolve_records(records, resolver, threshold=0.8, on_result=None, details=False):
+    """
+    Resolve the records' author_affil locally where confidence >= threshold.
+    on_result: called with each resolved record, e.g. ResultsStore.append
+    details: add 'confidence' and 'source' to resolved records; by default they have the model's fields only
+    Returns the records left for the model
+    """
+    remaining = []
+    for x in records:
+        if "author_affil" not in x.keys():
+            continue
+        o = resolver.resolve(x["author_affil"])
+        if o["confidence"] < threshold:
+            remaining.append(x)
+            continue
+        if details:
+            o["source"] = "local"
+        else:
+            del o["confidence"]
+        o["pmid"] = x["pmid"]
+        if on_result is not None:
+            on_result(o)
+    return remaining
+
+
+def learned_outputs():
+    return sorted({p for pattern in DEFAULT_OUTPUTS["authors"] for p in glob.glob(pattern) if not p.endswith((".failed.jsonl",) + OWN_OUTPUTS)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resolve affiliations to institution and country locally, leaving only unclear ones for the model")
+    parser.add_argument("input", help="e.g. data/pubmed_new.json")
+    parser.add_argument("--resolved", default="data/pubmed_authors_local.json", help="Locally resolved records")
+    parser.add_argument("--remaining", default="data/pubmed_authors_remaining.json", help="Input records to send to the model")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--learn", nargs="*", default=None, help="Author results to learn institution names from, default every one in data/")
+    parser.add_argument("--details", action="store_true", help="Add 'confidence' and 'source' to the resolved records")
+    parser.add_argument("--compare", default=None, help="Model results for the same PMIDs, e.g. data/pubmed_authors.json, to check agreement")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    resolver = AffiliationResolver.build(learn_from=learned_outputs() if args.learn is None else args.learn)
+    records = list(iter_records(args.input))
+    resolved = []
+    remaining = resolve_records(records, resolver, args.threshold, resolved.append, args.details)
+    with open(args.resolved, "w") as f:
+        json.dump(resolved, f)
+    with open(args.remaining, "w") as f:
+        json.dump(remaining, f)
+    print("Resolved {} affiliations locally, {} left for the model ({:.1f}s)".format(len(resolved), len(remaining), time.monotonic() - start))
+
+    if args.compare:
+        index = get_index()
+        model = {x["pmid"]: x for x in iter_records(args.compare)}
+        common = [o for o in resolved if o["pmid"] in model]
+        same_country = sum(index.resolve(o["country"]) == index.resolve(model[o["pmid"]].get("country")) for o in common)
+        same_institution = sum(normalise(o["institution"]) == normalise(model[o["pmid"]].get("institution", "")) for o in common)
+        print("Agreement with {} over {} PMIDs: country {:.1%}, institution {:.1%}".format(
+            args.compare, len(common), same_country / max(len(common), 1), same_institution / max(len(common), 1)))
+
+
+if __name__ == "__main__":
+    main()
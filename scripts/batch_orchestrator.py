@@ -0,0 +1,334 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from output_parser import DeadLetterQueue, iter_batch_output
+from prompts import abstract_messages, auth_messages
+from results_store import ResultsStore, iter_records
+
+# Batch API limits per input file
+MAX_REQUESTS = 50000
+MAX_FILE_BYTES = 190 * 1000 * 1000
+
+TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+
+def batch_request(pmid, messages, model="gpt-3.5-turbo", max_tokens=1000):
+    return {
+        "custom_id": pmid,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens
+        }
+    }
+
+
+def write_shards(requests, jsonl_file_root, max_requests=MAX_REQUESTS, max_bytes=MAX_FILE_BYTES, start=0, token_counts=None, max_batch_tokens=None):
+    """
+    requests: iterable of batch request dicts from batch_request
+    jsonl_file_root: e.g. "data/abstract_processing_20250502_batch", <shard>.jsonl is appended
+    token_counts: prompt tokens for each request (see token_planner.py), needed for max_batch_tokens
+    max_batch_tokens: enqueued token limit per batch
+    Starts a new shard whenever the next line would exceed max_requests, max_bytes or max_batch_tokens.
+    Returns list of (shard file name, list of custom_ids)
+    """
+    shards = []
+    f = None
+    if token_counts is None:
+        token_counts = itertools.repeat(0)
+    for request, n_tokens in zip(requests, token_counts):
+        line = (json.dumps(request) + "\n").encode("utf-8")
+        if (f is None or len(shards[-1][1]) >= max_requests or size + len(line) > max_bytes
+                or (max_batch_tokens and tokens + n_tokens > max_batch_tokens)):
+            if f is not None:
+                f.close()
+            name = "{}.{}.jsonl".format(jsonl_file_root, start + len(shards))
+            f = open(name, "wb")
+            shards.append((name, []))
+            size, tokens = 0, 0
+        f.write(line)
+        size += len(line)
+        tokens += n_tokens
+        shards[-1][1].append(request["custom_id"])
+    if f is not None:
+        f.close()
+    return shards
+
+
+def iter_shard_requests(path, custom_ids):
+    custom_ids = set(custom_ids)
+    with open(path) as f:
+        for line in f:
+            request = json.loads(line)
+            if request["custom_id"] in custom_ids:
+                yield request
+
+
+class BatchOrchestrator:
+    """
+    Resumable driver for the Batch API: write shards, upload, create batches, poll, harvest and resubmit failures.
+    client: OpenAI client, or stub_server.FakeBatchClient for testing
+    state_path: JSON file recording every shard's progress; rerunning with the same path resumes
+    store: ResultsStore receiving parsed results
+    dead_letter: DeadLetterQueue receiving every failed request with its reason
+    kind: 'abstracts' or 'authors', the schema results are validated against
+    ledger: RunLedger receiving stage timings and each request's tokens and failure reason
+    """
+
+    def __init__(self, client, state_path, store, dead_letter=None, kind="abstracts", description="abstract processing", upload_workers=8,
+                 poll_interval=10.0, max_poll_interval=300.0, max_attempts=3, ledger=None):
+        self.client = client
+        self.ledger = ledger
+        self.state_path = state_path
+        self.store = store
+        self.dead_letter = dead_letter
+        self.kind = kind
+        self.description = description
+        self.upload_workers = upload_workers
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_attempts = max_attempts
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {"shards": []}
+
+    def stage(self, name):
+        return self.ledger.stage(name) if self.ledger is not None else contextlib.nullcontext()
+
+    def save(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.state_path)
+
+    def add_shards(self, shards, attempt=1):
+        for name, custom_ids in shards:
+            self.state["shards"].append({"path": name, "custom_ids": custom_ids, "attempt": attempt, "file_id": None,
+                                         "batch_id": None, "status": "written", "harvested": False})
+        self.save()
+
+    def prepare(self, records, build_messages, field, jsonl_file_root, model="gpt-3.5-turbo", max_batch_tokens=None, **limits):
+        """
+        Write shards for records not already in the store, unless a previous run already did.
+        max_batch_tokens: pack shards by prompt tokens instead of only by request count and size
+        """
+        if self.state["shards"]:
+            return
+        with self.stage("prompt"):
+            self._prepare(records, build_messages, field, jsonl_file_root, model, max_batch_tokens, **limits)
+
+    def _prepare(self, records, build_messages, field, jsonl_file_root, model, max_batch_tokens, **limits):
+        self.state["root"] = jsonl_file_root
+        requests = (batch_request(x["pmid"], build_messages(x[field]), model) for x in records
+                    if field in x.keys() and x["pmid"] not in self.store)
+        token_counts = None
+        if max_batch_tokens:
+            from token_planner import TokenCounter, plan_shards, print_plan
+            requests = list(requests)
+            token_counts = TokenCounter(model).count_messages([r["body"]["messages"] for r in requests])
+            print_plan(plan_shards(token_counts, max_batch_tokens, model, max_requests=limits.get("max_requests", MAX_REQUESTS)))
+        shards = write_shards(requests, jsonl_file_root, token_counts=token_counts, max_batch_tokens=max_batch_tokens, **limits)
+        print("Number of batches: {}".format(len(shards)))
+        self.add_shards(shards)
+
+    def upload(self):
+        pending = [s for s in self.state["shards"] if s["file_id"] is None]
+        if not pending:
+            return
+
+        def upload_one(shard):
+            with open(shard["path"], "rb") as f:
+                return self.client.files.create(file=f, purpose="batch").id
+
+        with self.stage("upload"), ThreadPoolExecutor(self.upload_workers) as pool:
+            for shard, file_id in zip(pending, pool.map(upload_one, pending)):
+                shard["file_id"] = file_id
+                shard["status"] = "uploaded"
+        print("Uploaded {} files".format(len(pending)))
+        self.save()
+
+    def submit(self):
+        for i, shard in enumerate(self.state["shards"]):
+            if shard["batch_id"] is not None or shard["file_id"] is None:
+                continue
+            with self.stage("submit"):
+                batch = self.client.batches.create(
+                    input_file_id=shard["file_id"],
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h",
+                    metadata={
+                        "description": self.description,
+                        "batch": str(i),
+                        "batch_input_file": shard["path"],
+                        "attempt": str(shard["attempt"])
+                    }
+                )
+            shard["batch_id"] = batch.id
+            # A batch can already be finished, or failed validation, when it is created
+            self.update_shard(shard, batch)
+            self.save()
+
+    @staticmethod
+    def update_shard(shard, batch):
+        shard["status"] = batch.status
+        shard["output_file_id"] = batch.output_file_id
+        shard["error_file_id"] = batch.error_file_id
+
+    def poll(self):
+        """
+        Refresh every unfinished batch once. Returns True if any status changed.
+        """
+        changed = False
+        for shard in self.state["shards"]:
+            if shard["batch_id"] is None or shard["status"] in TERMINAL:
+                continue
+            with self.stage("poll"):
+                batch = self.client.batches.retrieve(shard["batch_id"])
+            if batch.status != shard["status"]:
+                changed = True
+                self.update_shard(shard, batch)
+        status_count = {}
+        for shard in self.state["shards"]:
+            status_count[shard["status"]] = status_count.get(shard["status"], 0) + 1
+        print(", ".join("{}: {}".format(k, v) for k, v in status_count.items()))
+        self.save()
+        return changed
+
+    def fail(self, custom_id, reason, stage="batch", usage=None):
+        if self.dead_letter is not None and custom_id is not None:
+            self.dead_letter.add(custom_id, reason, stage)
+        if self.ledger is not None and custom_id is not None:
+            usage = usage or {}
+            self.ledger.record(custom_id, "failed", usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), stage=stage, reason=reason)
+
+    def harvest_file(self, file_id, ok):
+        # Output files can be hundreds of MB, so they are parsed line by line as they download
+        usage = {}
+        on_usage = usage.__setitem__ if self.ledger is not None else None
+        with self.stage("parse"), self.client.files.with_streaming_response.content(file_id) as response:
+            for custom_id, record, reason in iter_batch_output(response.iter_lines(), self.kind, on_usage):
+                u = usage.pop(custom_id, {})
+                if record is None:
+                    self.fail(custom_id, reason, usage=u)
+                    continue
+                self.store.append(record)
+                ok.add(custom_id)
+                if self.ledger is not None:
+                    self.ledger.record(custom_id, "done", u.get("prompt_tokens", 0), u.get("completion_tokens", 0))
+
+    def harvest(self):
+        """
+        Stream finished batches into the store and resubmit only the requests that did not succeed.
+        """
+        retries = []
+        for shard in self.state["shards"]:
+            if shard["status"] not in TERMINAL or shard["harvested"]:
+                continue
+            ok = set()
+            if shard.get("output_file_id"):
+                self.harvest_file(shard["output_file_id"], ok)
+            if shard.get("error_file_id"):
+                self.harvest_file(shard["error_file_id"], ok)
+            self.store.sync()
+            failed = [c for c in shard["custom_ids"] if c not in ok]
+            if shard["status"] != "completed":
+                for c in failed:
+                    self.fail(c, "batch {}".format(shard["status"]))
+            shard["failed"] = len(failed)
+            shard["harvested"] = True
+            if failed and shard["attempt"] < self.max_attempts:
+                retries.append((shard, failed))
+            elif failed:
+                print("Giving up on {} requests from {}".format(len(failed), shard["path"]))
+        for shard, failed in retries:
+            root = "{}.retry{}".format(self.state.get("root", shard["path"]), shard["attempt"])
+            start = sum(1 for s in self.state["shards"] if s["attempt"] == shard["attempt"] + 1)
+            print("Resubmitting {} failed requests from {}".format(len(failed), shard["path"]))
+            self.add_shards(write_shards(iter_shard_requests(shard["path"], failed), root, start=start), attempt=shard["attempt"] + 1)
+        self.save()
+
+    def done(self):
+        return all(s["harvested"] for s in self.state["shards"])
+
+    def run(self):
+        interval = self.poll_interval
+        while True:
+            self.upload()
+            self.submit()
+            changed = self.poll()
+            self.harvest()
+            if self.done():
+                return
+            interval = self.poll_interval if changed else min(self.max_poll_interval, interval * 1.5)
+            with self.stage("wait"):
+                time.sleep(interval)
+
+
+def run_batch(args, client, build_messages, field, ledger=None):
+    """
+    The batch run described by the command line arguments, recording into ledger if given
+    """
+    with ResultsStore(args.root + ".results.jsonl") as store, DeadLetterQueue(args.root + ".failed.jsonl") as dead_letter:
+        orchestrator = BatchOrchestrator(client, args.root + ".state.json", store, dead_letter, kind=args.kind, description="{} processing".format(args.kind),
+                                         poll_interval=args.poll_interval, max_attempts=args.max_attempts, ledger=ledger)
+        records = iter_records(args.input)
+        if args.skip_predatory:
+            from journal_screen import skip_listed
+            records = skip_listed(records)
+        orchestrator.prepare(records, build_messages, field, args.root, model=args.model,
+                             max_batch_tokens=args.max_batch_tokens, max_requests=args.max_requests)
+        orchestrator.run()
+        with orchestrator.stage("persist"):
+            n = store.compact(args.output)
+        print("Wrote {} results to {}".format(n, args.output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an extraction through the Batch API end to end, resumably")
+    parser.add_argument("input", help="e.g. data/pubmed_new.json")
+    parser.add_argument("output", help="e.g. data/pubmed_abstracts_20250502.json")
+    parser.add_argument("--root", required=True, help="Shard file root, e.g. data/abstract_processing_20250502_batch")
+    parser.add_argument("--kind", choices=["abstracts", "authors"], default="abstracts")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--base-url", default=None, help="e.g. http://127.0.0.1:8000/v1 for the stub server")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS)
+    parser.add_argument("--max-batch-tokens", type=int, default=None, help="Enqueued token limit per batch, e.g. 2000000")
+    parser.add_argument("--poll-interval", type=float, default=10.0)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--skip-predatory", action="store_true", help="Skip records from journals in data/predatory_journals.txt")
+    parser.add_argument("--ledger", default="data/run_ledger.sqlite", help="SQLite run ledger, see run_ledger.py")
+    parser.add_argument("--no-ledger", action="store_true")
+    args = parser.parse_args()
+
+    from openai import OpenAI
+    import dotenv
+    dotenv.load_dotenv()
+    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), base_url=args.base_url)
+
+    if args.kind == "abstracts":
+        build_messages, field = abstract_messages, "ab"
+    else:
+        build_messages, field = auth_messages, "author_affil"
+
+    if args.no_ledger:
+        run_batch(args, client, build_messages, field)
+        return
+    from run_ledger import RunLedger
+    # A run that crashes or is interrupted is recorded as failed instead of staying 'running'
+    with RunLedger(args.ledger) as ledger:
+        ledger.start("batch_orchestrator", args.kind, args.model, batch=True, args=args)
+        run_batch(args, client, build_messages, field, ledger)
+    print("Recorded run {} in {}".format(ledger.run_id, args.ledger))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from extract_engine import extract_all
+from output_parser import parse_result
+from prompts import abstract_messages, auth_messages
+from results_store import ResultsStore, iter_records
+from stub_server import fake_completion
+from trait_normalise import CATEGORIES, build_index, normalise_records
+from work_planner import merge_by_pmid
+
+STAGES = ("extract", "extract-authors", "parse", "merge", "normalise")
+
+# For each metric, whether a larger value is better, and the smallest absolute change worth reporting
+METRICS = {
+    "records_per_sec": (True, 0),
+    "p50_ms": (False, 1.0),
+    "p99_ms": (False, 1.0),
+    "peak_rss_mb": (False, 5.0),
+    "tokens_per_record": (False, 1.0),
+}
+
+FILLER = ("we", "used", "two-sample", "Mendelian", "randomization", "to", "estimate", "the", "causal", "effect", "of", "on",
+          "using", "genetic", "variants", "from", "genome-wide", "association", "studies", "in", "European", "ancestry",
+          "individuals", "inverse-variance", "weighted", "method", "was", "primary", "analysis", "sensitivity", "analyses",
+          "showed", "consistent", "evidence", "for", "association", "between", "and", "risk", "odds", "ratio", "confidence", "interval")
+METHODS = ["two-sample MR", "inverse variance weighted", "MR Egger", "weighted median", "MR-PRESSO", "multivariable MR", "colocalisation"]
+TRAITS = ["Body mass index", "BMI", "Type 2 diabetes", "Coronary artery disease", "LDL cholesterol", "Smoking initiation",
+          "Alcohol consumption", "Educational attainment", "Systolic blood pressure", "Major depressive disorder"]
+INSTITUTIONS = [("University of Bristol", "UK"), ("Central South University", "China"), ("Harvard University", "USA"),
+                ("Karolinska Institutet", "Sweden"), ("Zhejiang University", "China")]
+
+
+class MockAPIError(Exception):
+    status_code = 500
+
+
+def vocabulary(data_dir="data"):
+    """
+    Traits and institutions to build the corpus from, taken from the existing outputs where present
+    """
+    traits, institutions = set(), set()
+    for path in ("pubmed_abstracts.json", "pubmed_abstracts_new.json"):
+        if os.path.exists(os.path.join(data_dir, path)):
+            for x in iter_records(os.path.join(data_dir, path)):
+                for key in ("exposures", "outcomes"):
+                    traits.update(t["trait"] for t in x.get(key, []) if isinstance(t, dict) and isinstance(t.get("trait"), str))
+    if os.path.exists(os.path.join(data_dir, "pubmed_authors.json")):
+        for x in iter_records(os.path.join(data_dir, "pubmed_authors.json")):
+            if isinstance(x.get("institution"), str) and isinstance(x.get("country"), str) and x["institution"]:
+                institutions.add((x["institution"], x["country"]))
+    return sorted(traits) or TRAITS, sorted(institutions) or INSTITUTIONS
+
+
+def make_corpus(n, seed=1, data_dir="data"):
+    """
+    n synthetic records shaped like the pipeline's data.
+    Returns (inputs like pubmed.json, abstract results like pubmed_abstracts.json, author results like pubmed_authors.json)
+    """
+    rng = random.Random(seed)
+    traits, institutions = vocabulary(data_dir)
+    inputs, abstracts, authors = [], [], []
+    for i in range(n):
+        pmid = str(30000000 + i)
+        exposures = [{"id": str(j + 1), "trait": rng.choice(traits), "category": rng.choice(CATEGORIES)} for j in range(rng.randint(1, 3))]
+        outcomes = [{"id": str(j + 1), "trait": rng.choice(traits), "category": rng.choice(CATEGORIES)} for j in range(rng.randint(1, 3))]
+        words = [rng.choice(FILLER) for _ in range(rng.randint(180, 300))]
+        for t in exposures + outcomes:
+            words.insert(rng.randrange(len(words)), t["trait"])
+        institution, country = rng.choice(institutions)
+        inputs.append({
+            "pmid": pmid,
+            "ab": "{} {}.".format(pmid, " ".join(words)),
+            "pub_date": "20{:02d}-{:02d}-{:02d}".format(rng.randint(10, 25), rng.randint(1, 12), rng.randint(1, 28)),
+            "title": "Synthetic study {}".format(pmid),
+            "journal_issn": "0000-0000",
+            "journal": "Journal of Synthetic Epidemiology",
+            "author_affil": "Department of Epidemiology, {}, {}.".format(institution, country),
+        })
+        n_null = rng.randint(0, 4)
+        abstracts.append({"exposures": exposures, "outcomes": outcomes, "methods": rng.sample(METHODS, rng.randint(1, 3)),
+                          "results": {"null": n_null, "non-null": rng.randint(0, 4)}, "pmid": pmid})
+        authors.append({"institution": institution, "country": country, "pmid": pmid})
+    return inputs, abstracts, authors
+
+
+def make_mock_call(latency=0.05, error_rate=0.0, seed=1):
+    """
+    In-process stand-in for make_openai_call: waits latency (exponentially distributed around it) and fails error_rate of
+    requests with a retryable error. Use --http to go through stub_server.py and the OpenAI client instead.
+    """
+    rng = random.Random(seed)
+
+    async def call(messages):
+        await asyncio.sleep(rng.expovariate(1 / latency) if latency else 0)
+        if rng.random() < error_rate:
+            raise MockAPIError("mock server error")
+        response = fake_completion(messages, "mock")
+        return response["choices"][0]["message"]["content"], {k: response["usage"][k] for k in ("prompt_tokens", "completion_tokens")}
+    call.model = "mock"
+    return call
+
+
+def percentiles(latencies):
+    if len(latencies) < 2:
+        return None, None
+    q = statistics.quantiles(latencies, n=100)
+    return q[49] * 1000, q[98] * 1000
+
+
+def run_extract(inputs, options, kind):
+    build_messages, field = (abstract_messages, "ab") if kind == "abstracts" else (auth_messages, "author_affil")
+    if options["http"]:
+        from extract_engine import make_openai_call
+        from stub_server import make_stub_server
+        server = make_stub_server(latency=options["latency"], error_rate=options["error_rate"])
+        call = make_openai_call(model="mock", base_url="http://127.0.0.1:{}/v1".format(server.server_address[1]), api_key="mock")
+    else:
+        call = make_mock_call(options["latency"], options["error_rate"])
+
+    # Time each record from when its request is built to when its result arrives, retries included.
+    # build_messages only sees the text, and affiliations repeat, so start times are queued per text.
+    started, latencies = defaultdict(deque), []
+    texts = {x["pmid"]: x[field] for x in inputs}
+
+    def timed_messages(text):
+        started[text].append(time.perf_counter())
+        return build_messages(text)
+
+    def on_result(o):
+        latencies.append(time.perf_counter() - started[texts[o["pmid"]]].popleft())
+
+    _, stats = asyncio.run(extract_all(inputs, call, timed_messages, field, concurrency=options["concurrency"],
+                                       on_result=on_result, report_every=0, kind=kind))
+    if options["http"]:
+        server.shutdown()
+    tokens = (stats["prompt_tokens"] + stats["completion_tokens"]) / max(stats["done"], 1)
+    return stats["done"], stats["elapsed"], latencies, tokens
+
+
+def run_parse(abstracts):
+    # Responses as the model writes them, some inside markdown fences
+    texts = [("```json\n{}\n```" if i % 3 == 0 else "{}").format(json.dumps({k: v for k, v in o.items() if k != "pmid"}))
+             for i, o in enumerate(abstracts)]
+    latencies = []
+    start = time.perf_counter()
+    for text, o in zip(texts, abstracts):
+        t = time.perf_counter()
+        parse_result(text, o["pmid"], "abstracts")
+        latencies.append(time.perf_counter() - t)
+    return len(texts), time.perf_counter() - start, latencies, None
+
+
+def run_merge(abstracts):
+    # Checkpoint every result, compact the store, then merge a rerun of a tenth of the PMIDs into the snapshot
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        with ResultsStore(os.path.join(tmp, "results.jsonl")) as store:
+            for o in abstracts:
+                store.append(o)
+            store.compact(os.path.join(tmp, "results.json"))
+        old = list(iter_records(os.path.join(tmp, "results.json")))
+        merged = merge_by_pmid(old, abstracts[::10])
+    return len(merged), time.perf_counter() - start, [], None
+
+
+def run_normalise(abstracts):
+    start = time.perf_counter()
+    index, _ = build_index(abstracts)
+    normalise_records(abstracts, index)
+    return len(abstracts), time.perf_counter() - start, [], None
+
+
+def run_stage(stage, n, options):
+    """
+    Runs one stage on a fresh corpus in this process and returns its metrics. Called in a child process so the
+    peak RSS belongs to the stage alone.
+    """
+    inputs, abstracts, authors = make_corpus(n, options["seed"])
+    if stage == "extract":
+        done, elapsed, latencies, tokens = run_extract(inputs, options, "abstracts")
+    elif stage == "extract-authors":
+        done, elapsed, latencies, tokens = run_extract(inputs, options, "authors")
+    elif stage == "parse":
+        done, elapsed, latencies, tokens = run_parse(abstracts)
+    elif stage == "merge":
+        done, elapsed, latencies, tokens = run_merge(abstracts)
+    else:
+        done, elapsed, latencies, tokens = run_normalise(abstracts)
+    p50, p99 = percentiles(latencies)
+    return {"records": done, "seconds": elapsed, "records_per_sec": done / elapsed if elapsed else 0.0, "p50_ms": p50, "p99_ms": p99,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "tokens_per_record": tokens}
+
+
+def compare(result, baseline, tolerance=0.2):
+    """
+    Returns the metrics that are more than tolerance worse than the baseline
+    """
+    worse = []
+    for metric, (higher_is_better, floor) in METRICS.items():
+        new, old = result.get(metric), baseline.get(metric)
+        if new is None or not old or abs(new - old) <= floor:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            worse.append("{} {:.3g} -> {:.3g}".format(metric, old, new))
+    return worse
+
+
+def options_key(options):
+    """
+    Baselines are kept per mock mode and settings, e.g. "mock latency=0.05 error_rate=0.01 concurrency=64 seed=1",
+    since a run through stub_server.py is not comparable with the in-process mock
+    """
+    return " ".join(["http" if options["http"] else "mock"] + ["{}={}".format(k, options[k]) for k in ("latency", "error_rate", "concurrency", "seed")])
+
+
+def load_baselines(path):
+    """
+    Returns {options key: {"options", "results"}}; a file from before baselines were keyed counts as one entry
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        saved = json.load(f)
+    if "baselines" in saved:
+        return saved["baselines"]
+    return {options_key(saved["options"]): {"options": saved["options"], "results": saved["results"]}}
+
+
+def fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic corpus against a mock LLM")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean mock response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--http", action="store_true", help="Go through the OpenAI client and stub_server.py instead of an in-process mock")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default="data/benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    options = {"latency": args.latency, "error_rate": args.error_rate, "concurrency": args.concurrency, "http": args.http, "seed": args.seed}
+    baselines = load_baselines(args.baseline)
+    key = options_key(options)
+    baseline = baselines.get(key, {}).get("results", {})
+    if baselines and not baseline:
+        print("No baseline for '{}' in {}, nothing to compare against (saved: {})".format(key, args.baseline, "; ".join(baselines)))
+
+    # A fresh process per run so peak RSS is not carried over between stages
+    ctx = multiprocessing.get_context("spawn")
+    results, regressions = {}, []
+    print("{:<16} {:>7} {:>10} {:>9} {:>9} {:>9} {:>10}".format("stage", "n", "records/s", "p50 ms", "p99 ms", "RSS MB", "tok/rec"))
+    for n in args.scales:
+        for stage in args.stages:
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run_stage, (stage, n, options))
+            name = "{}@{}".format(stage, n)
+            results[name] = r
+            worse = compare(r, baseline.get(name, {}), args.tolerance)
+            regressions += ["{}: {}".format(name, w) for w in worse]
+            print("{:<16} {:>7} {:>10.1f} {:>9} {:>9} {:>9.0f} {:>10}{}".format(
+                stage, n, r["records_per_sec"], fmt(r["p50_ms"], ".2f"), fmt(r["p99_ms"], ".2f"), r["peak_rss_mb"],
+                fmt(r["tokens_per_record"], ".0f"), "  REGRESSION" if worse else ""))
+
+    if args.save_baseline:
+        baseline.update(results)
+        baselines[key] = {"python": platform.python_version(), "machine": platform.machine(), "options": options, "results": baseline}
+        with open(args.baseline, "w") as f:
+            json.dump({"baselines": baselines}, f, indent=1)
+        print("Saved baseline for '{}' to {}".format(key, args.baseline))
+    if regressions:
+        print("Regressions against {}:".format(args.baseline))
+        for r in regressions:
+            print("  " + r)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+import zlib
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from results_store import iter_records
+from trait_normalise import TraitIndex, normalise_category
+from work_planner import DEFAULT_OUTPUTS, record_ok, snapshot_date
+
+# Rows of each snapshot are split into this many files by PMID, so a change only rewrites the files holding it
+BUCKETS = 16
+
+_string = pa.dictionary(pa.int32(), pa.string())
+SCHEMAS = {
+    "traits": pa.schema([("pmid", pa.string()), ("role", _string), ("trait", _string), ("category", _string),
+                         ("trait_norm", _string), ("category_norm", _string)]),
+    "methods": pa.schema([("pmid", pa.string()), ("method", _string)]),
+    "results": pa.schema([("pmid", pa.string()), ("null", pa.int32()), ("non_null", pa.int32())]),
+    "authors": pa.schema([("pmid", pa.string()), ("institution", _string), ("country", _string),
+                          ("institutions", pa.list_(pa.string())), ("countries", pa.list_(pa.string()))]),
+}
+KIND_TABLES = {
+    "abstracts": ("traits", "methods", "results"),
+    "authors": ("authors",),
+}
+EXTENSIONS = {"parquet": "parquet", "feather": "arrow"}
+
+
+def bucket(pmid):
+    return zlib.crc32(str(pmid).encode("utf-8")) % BUCKETS
+
+
+def record_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def record_kind(record):
+    if "institution" in record or "country" in record:
+        return "authors"
+    return "abstracts"
+
+
+def _count(value):
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def _affiliations(value):
+    """
+    Author fields hold a string, or for a few records a list with one entry per affiliation.
+    Returns (first value, all values)
+    """
+    values = value if isinstance(value, list) else [value]
+    values = [v for v in values if isinstance(v, str)]
+    return (values[0] if values else None), values
+
+
+def flatten(records, kind, trait_index=None):
+    """
+    records: extraction results of one kind, at most one per pmid
+    trait_index: optional TraitIndex from trait_normalise.py to fill in trait_norm
+    Returns {table name: {column: list of values}}
+    """
+    rows = {name: {field.name: [] for field in SCHEMAS[name]} for name in KIND_TABLES[kind]}
+    for x in records:
+        pmid = str(x["pmid"])
+        if kind == "authors":
+            authors = rows["authors"]
+            authors["pmid"].append(pmid)
+            # institution and country hold the first affiliation, institutions and countries every one
+            for one, many in (("institution", "institutions"), ("country", "countries")):
+                first, values = _affiliations(x.get(one))
+                authors[one].append(first)
+                authors[many].append(values)
+            continue
+        traits = rows["traits"]
+        for role, key in (("exposure", "exposures"), ("outcome", "outcomes")):
+            for t in x.get(key, []):
+                if not isinstance(t, dict) or not isinstance(t.get("trait"), str):
+                    continue
+                category = t.get("category") if isinstance(t.get("category"), str) else None
+                trait_norm = None
+                if trait_index is not None:
+                    cid, _ = trait_index.lookup(t["trait"])
+                    trait_norm = trait_index.clusters[cid]["label"] if cid is not None else None
+                traits["pmid"].append(pmid)
+                traits["role"].append(role)
+                traits["trait"].append(t["trait"])
+                traits["category"].append(category)
+                traits["trait_norm"].append(trait_norm)
+                traits["category_norm"].append(normalise_category(category) if category else None)
+        for method in x.get("methods", []):
+            if isinstance(method, str):
+                rows["methods"]["pmid"].append(pmid)
+                rows["methods"]["method"].append(method)
+        results = x.get("results")
+        if isinstance(results, dict):
+            rows["results"]["pmid"].append(pmid)
+            rows["results"]["null"].append(_count(results.get("null")))
+            rows["results"]["non_null"].append(_count(results.get("non-null")))
+    return rows
+
+
+def to_table(name, columns):
+    arrays = []
+    for field in SCHEMAS[name]:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(columns[field.name], pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(columns[field.name], field.type))
+    return pa.Table.from_arrays(arrays, schema=SCHEMAS[name])
+
+
+def write_table(table, path, fmt="parquet"):
+    tmp = path + ".tmp"
+    if fmt == "parquet":
+        pq.write_table(table, tmp, compression="zstd")
+    else:
+        # Uncompressed Arrow IPC files can be memory-mapped without decoding
+        feather.write_feather(table, tmp, compression="uncompressed")
+    os.replace(tmp, path)
+
+
+class TableBuilder:
+    """
+    Incrementally flattens extraction outputs into typed tables under root, one directory per table
+    partitioned by snapshot, e.g. data/tables/traits/snapshot=20250502/pubmed_abstracts_20250502_json.03.parquet
+    root: output directory, with manifest.json recording the per-PMID hashes of every source file
+    fmt: 'parquet', or 'feather' for memory-mappable Arrow IPC files
+    trait_index: path of a trait_normalise.py index, to fill in trait_norm. Every source is rebuilt when it changes.
+    """
+
+    def __init__(self, root="data/tables", fmt="parquet", trait_index=None):
+        self.root = root
+        self.fmt = fmt
+        self.trait_index = TraitIndex.load(trait_index) if trait_index else None
+        self.trait_index_version = "{}:{}".format(trait_index, os.path.getmtime(trait_index)) if trait_index else None
+        self.manifest_path = os.path.join(root, "manifest.json")
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest["format"] != fmt:
+                raise ValueError("{} holds {} tables, use another --root for {}".format(root, self.manifest["format"], fmt))
+        else:
+            self.manifest = {"format": fmt, "sources": {}}
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_path)
+
+    def part_path(self, name, snapshot, source, b):
+        stem = os.path.basename(source).replace(".", "_")
+        return os.path.join(self.root, name, "snapshot={}".format(snapshot), "{}.{:02d}.{}".format(stem, b, EXTENSIONS[self.fmt]))
+
+    def write_bucket(self, name, snapshot, source, b, columns):
+        path = self.part_path(name, snapshot, source, b)
+        if not columns["pmid"]:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_table(to_table(name, columns), path, self.fmt)
+
+    def update(self, path):
+        """
+        Rebuild the files of every bucket whose PMIDs changed since the last build of this source.
+        Returns the number of changed PMIDs
+        """
+        stat = os.stat(path)
+        entry = self.manifest["sources"].get(path)
+        if entry and entry["trait_index"] != self.trait_index_version:
+            entry["hashes"] = {}
+        elif entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return 0
+
+        latest = {}
+        for x in iter_records(path):
+            if "pmid" in x:
+                latest[str(x["pmid"])] = x
+        if latest:
+            kind = record_kind(next(iter(latest.values())))
+        elif entry:
+            # The source was emptied, so every file built from it is removed below
+            kind = entry["kind"]
+        else:
+            return 0
+        latest = {p: x for p, x in latest.items() if record_ok(x, kind)}
+        hashes = {p: record_hash(x) for p, x in latest.items()}
+
+        old = entry["hashes"] if entry else {}
+        changed = {p for p in hashes if old.get(p) != hashes[p]} | (set(old) - set(hashes))
+        snapshot = entry["snapshot"] if entry else snapshot_date(path)
+        buckets = {bucket(p) for p in changed}
+
+        by_bucket = {b: [] for b in buckets}
+        for p, x in latest.items():
+            b = bucket(p)
+            if b in by_bucket:
+                by_bucket[b].append(x)
+        for b, records in by_bucket.items():
+            for name, columns in flatten(records, kind, self.trait_index).items():
+                self.write_bucket(name, snapshot, path, b, columns)
+
+        self.manifest["sources"][path] = {"mtime": stat.st_mtime, "size": stat.st_size, "snapshot": snapshot, "kind": kind,
+                                          "trait_index": self.trait_index_version, "hashes": hashes}
+        self.save()
+        return len(changed)
+
+    def prune(self, paths, drop=()):
+        """
+        Remove the tables of sources that no longer exist, and of the sources in drop
+        """
+        sources = self.manifest["sources"]
+        for source in [s for s in sources if s in drop or (s not in paths and not os.path.exists(s))]:
+            entry = sources.pop(source)
+            for name in KIND_TABLES[entry["kind"]]:
+                for b in range(BUCKETS):
+                    part = self.part_path(name, entry["snapshot"], source, b)
+                    if os.path.exists(part):
+                        os.remove(part)
+            print("Removed tables of {}".format(source))
+        self.save()
+
+
+def load_table(name, root="data/tables", fmt="parquet"):
+    """
+    Returns a pyarrow Dataset over every snapshot of a table, with 'snapshot' as a column.
+    e.g. load_table("traits").to_table(filter=ds.field("snapshot") == 20250502).to_pandas()
+    """
+    return ds.dataset(os.path.join(root, name), format="ipc" if fmt == "feather" else "parquet", partitioning="hive")
+
+
+def compacted(path):
+    """
+    True for an engine checkpoint (.jsonl) that has been compacted into its .json, which holds the same records
+    """
+    return path.endswith(".jsonl") and os.path.exists(os.path.splitext(path)[0] + ".json")
+
+
+def default_inputs():
+    """
+    Every abstracts and authors output in data/, leaving out compacted checkpoints so their records are not written twice
+    """
+    return sorted({p for patterns in DEFAULT_OUTPUTS.values() for pattern in patterns for p in glob.glob(pattern)
+                   if not p.endswith((".failed.jsonl", "_normalised.json")) and not compacted(p)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build columnar tables from the JSON extraction outputs")
+    parser.add_argument("inputs", nargs="*", help="Extraction outputs, by default every abstracts and authors output in data/")
+    parser.add_argument("--root", default="data/tables")
+    parser.add_argument("--format", choices=list(EXTENSIONS), default="parquet")
+    parser.add_argument("--trait-index", default=None, help="e.g. data/trait_index.json from trait_normalise.py, to fill in trait_norm")
+    args = parser.parse_args()
+
+    if not args.inputs:
+        args.inputs = default_inputs()
+
+    start = time.monotonic()
+    builder = TableBuilder(args.root, args.format, args.trait_index)
+    for path in args.inputs:
+        if not os.path.exists(path):
+            print("{} not found".format(path))
+            continue
+        n = builder.update(path)
+        if n:
+            print("{}: {} changed PMIDs".format(path, n))
+    # Tables built from a checkpoint before it was compacted hold the same PMIDs as the .json's
+    builder.prune(args.inputs, drop=[s for s in builder.manifest["sources"] if s not in args.inputs and compacted(s)])
+    print("Tables in {} are up to date ({:.1f}s)".format(args.root, time.monotonic() - start))
+
+
+if __name__ == "__main__":
+    main()
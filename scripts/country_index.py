@@ -0,0 +1,270 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import Counter
+
+from results_store import iter_records
+
+DATA_DIR = "data"
+
+# countries.csv maps to "USA" and "The Netherlands", the other tables use these names
+CANONICAL_FIXES = {
+    "USA": "United States",
+    "The Netherlands": "Netherlands",
+}
+UNKNOWN = ("Unknown",)
+
+# Spellings in continent.csv, the Nature Index tables and author results that differ from sdi.csv
+COUNTRY_ALIASES = {
+    "Columbia": "Colombia",
+    "Srilanka": "Sri Lanka",
+    "Burkina": "Burkina Faso",
+    "Ivory Coast": "Cote d'Ivoire",
+    "(North) Sudan": "Sudan",
+    "Republic of Congo": "Congo",
+    "(Democratic Republic of) Congo": "Democratic Republic of the Congo",
+    "Sai Tome and Principe": "Sao Tome and Principe",
+    "East Timor": "Timor-Leste",
+    "Micronesia": "Federated States of Micronesia",
+    "Palestinian territories": "Palestine",
+    "St.Kitts and Nevis": "Saint Kitts and Nevis",
+    "St. Lucia": "Saint Lucia",
+    "St. Vincent and The Grenadines": "Saint Vincent and the Grenadines",
+    "Lieischenstein": "Liechtenstein",
+    "CHN": "China",
+    "Hong Kong Special Administrative Region of China": "Hong Kong",
+}
+
+# Most universities on the 985/211 lists are inside China, so only Chinese affiliations are checked against them
+TIER_COUNTRIES = ("China",)
+
+_punct = re.compile(r"[^\w]+")
+_nature_index_name = re.compile(r"^(.*?)\s*\(([^)]+)\)\s*$")
+
+
+def key(name):
+    """
+    Case, accent and punctuation insensitive key, e.g. "P.R. China" -> "p r china", "México" -> "mexico"
+    """
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii")
+    k = _punct.sub(" ", name.casefold()).strip()
+    return k[4:] if k.startswith("the ") else k
+
+
+def read_csv(path):
+    # countries.csv starts with a byte order mark
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return list(csv.reader(f))
+
+
+class CountryIndex:
+    """
+    Canonical countries with their aliases, SDI group, continent and Nature Index rank, and the Chinese 985/211 universities.
+    Build it once from the reference tables in data/ with CountryIndex.build, or load the serialised copy with get_index.
+    """
+
+    def __init__(self):
+        self.aliases = {}
+        self.countries = {}
+        self.universities = {}
+        self._max_words = 1
+        self._resolved = {}
+        self._tiers = {}
+
+    def add_country(self, name):
+        if name not in self.countries:
+            self.countries[name] = {"sdi": None, "continent": None, "nature_index": {}}
+            self.aliases.setdefault(key(name), name)
+        return name
+
+    def add_alias(self, alias, name):
+        self.aliases.setdefault(key(alias), name)
+
+    def lookup(self, name):
+        return self.aliases.get(key(name))
+
+    def resolve(self, country):
+        """
+        Canonical country for an affiliation's country string, or None.
+        Lists take their first entry, and "Bristol, UK" style strings fall back to their last part.
+        """
+        if isinstance(country, list):
+            country = country[0] if country else None
+        if not isinstance(country, str):
+            return None
+        if country not in self._resolved:
+            name = self.lookup(country)
+            if name is None and "," in country:
+                parts = [p for p in country.split(",") if p.strip()]
+                name = self.lookup(parts[-1]) if parts else None
+            self._resolved[country] = None if name in UNKNOWN else name
+        return self._resolved[country]
+
+    def add_universities(self, names, tier):
+        # Keyed without spaces so "Xi'an Jiao Tong University" and "Xian Jiaotong University" are the same
+        for name in names:
+            k = key(name)
+            if k:
+                self.universities.setdefault(k.replace(" ", ""), set()).add(tier)
+                self._max_words = max(self._max_words, len(k.split(" ")) + 1)
+
+    def university_tiers(self, institution):
+        """
+        Set of lists ('985', '211') the institution belongs to. Matches a listed name anywhere in the institution
+        ("Peking University Health Science Center", but not "Shandong University of Traditional Chinese Medicine").
+        Near-identical names of different universities are common (Beihang/Beihua), so there is no fuzzy matching.
+        """
+        if not isinstance(institution, str):
+            return set()
+        if institution in self._tiers:
+            return self._tiers[institution]
+        words = key(institution).split(" ")
+        tiers = set()
+        # Longest listed name contained in the institution, by looking up each run of words
+        for n in range(min(self._max_words, len(words)), 0, -1):
+            for i in range(len(words) - n + 1):
+                if i + n < len(words) and words[i + n] == "of":
+                    continue
+                tiers = self.universities.get("".join(words[i:i + n]))
+                if tiers:
+                    break
+            if tiers:
+                break
+        self._tiers[institution] = set(tiers or ())
+        return self._tiers[institution]
+
+    def nature_index(self, country, year=None):
+        """
+        Nature Index position, share and count of a canonical country for a year, by default the latest
+        """
+        ranks = self.countries.get(country, {}).get("nature_index", {})
+        if not ranks:
+            return None
+        return ranks.get(str(year if year is not None else max(ranks)))
+
+    def enrich(self, records, nature_index_year=None):
+        """
+        records: author results, e.g. from data/pubmed_authors.json
+        Adds country_norm, sdi, continent, nature_index_share/count/position, c985 and c211 to each record.
+        Returns a Counter of the country strings that could not be resolved.
+        """
+        unresolved = Counter()
+        for x in records:
+            country = self.resolve(x.get("country"))
+            info = self.countries.get(country, {})
+            ni = self.nature_index(country, nature_index_year) if country else None
+            tiers = self.university_tiers(x.get("institution")) if country in TIER_COUNTRIES else set()
+            x["country_norm"] = country
+            x["sdi"] = info.get("sdi")
+            x["continent"] = info.get("continent")
+            x["nature_index_share"] = ni["share"] if ni else None
+            x["nature_index_count"] = ni["count"] if ni else None
+            x["nature_index_position"] = ni["position"] if ni else None
+            x["c985"] = "985" in tiers
+            x["c211"] = "211" in tiers
+            if country is None:
+                unresolved[str(x.get("country"))] += 1
+        return unresolved
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR):
+        index = cls()
+        for row in read_csv(os.path.join(data_dir, "sdi.csv"))[1:]:
+            # "Virgin Islands, U.S." is not quoted
+            index.countries[index.add_country(",".join(row[:-1]))]["sdi"] = row[-1]
+        for alias, name in COUNTRY_ALIASES.items():
+            index.add_alias(alias, index.lookup(name) or index.add_country(name))
+        for row in read_csv(os.path.join(data_dir, "continent.csv"))[1:]:
+            name = index.lookup(row[0]) or index.add_country(row[0])
+            index.countries[name]["continent"] = row[1]
+        for alias, name in read_csv(os.path.join(data_dir, "countries.csv")):
+            name = CANONICAL_FIXES.get(name, name)
+            if name in UNKNOWN:
+                index.add_alias(alias, name)
+                continue
+            index.add_alias(alias, index.lookup(name) or index.add_country(name))
+        for path in sorted(glob.glob(os.path.join(data_dir, "nature_index", "*-research-leading-countries.csv"))):
+            index.add_nature_index(read_csv(path))
+        for tier in ("985", "211"):
+            with open(os.path.join(data_dir, "{}_universities.txt".format(tier))) as f:
+                index.add_universities([line.strip() for line in f], tier)
+        return index
+
+    def add_nature_index(self, rows):
+        # The table for year N holds the counts for year N-1, in a column named "Count <year>"
+        header = rows[0]
+        count_col = next(i for i, h in enumerate(header) if h.startswith("Count "))
+        year = header[count_col].split(" ")[1]
+        share_col = header.index("Share {}".format(year))
+        for row in rows[1:]:
+            if len(row) <= count_col:
+                continue
+            # e.g. "United States of America (USA)"
+            m = _nature_index_name.match(row[1])
+            names = [m.group(1), m.group(2)] if m else [row[1]]
+            name = next((self.lookup(n) for n in names if self.lookup(n)), None) or self.add_country(names[0])
+            for n in names:
+                self.add_alias(n, name)
+            self.countries[name]["nature_index"][year] = {
+                "position": int(row[0]), "share": float(row[share_col]), "count": int(row[count_col])}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"aliases": self.aliases, "countries": self.countries,
+                       "universities": {k: sorted(v) for k, v in self.universities.items()}, "max_words": self._max_words}, f)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path) as f:
+            d = json.load(f)
+        index.aliases = d["aliases"]
+        index.countries = d["countries"]
+        index.universities = {k: set(v) for k, v in d["universities"].items()}
+        index._max_words = d["max_words"]
+        return index
+
+
+def get_index(path="data/country_index.json", data_dir=DATA_DIR):
+    """
+    Load the serialised index, rebuilding it first if any reference table is newer
+    """
+    sources = [os.path.join(data_dir, f) for f in ("sdi.csv", "continent.csv", "countries.csv", "985_universities.txt", "211_universities.txt")]
+    sources += glob.glob(os.path.join(data_dir, "nature_index", "*.csv"))
+    if os.path.exists(path) and os.path.getmtime(path) >= max(os.path.getmtime(p) for p in sources):
+        return CountryIndex.load(path)
+    index = CountryIndex.build(data_dir)
+    index.save(path)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add SDI, continent, Nature Index and 985/211 status to author results")
+    parser.add_argument("inputs", nargs="+", help="e.g. data/pubmed_authors.json data/pubmed_authors_20250502.json")
+    parser.add_argument("--output", default="data/authors_enriched.json")
+    parser.add_argument("--index", default="data/country_index.json")
+    parser.add_argument("--nature-index-year", type=int, default=None, help="Defaults to the latest year")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    index = get_index(args.index)
+    records = [x for path in args.inputs for x in iter_records(path)]
+    unresolved = index.enrich(records, args.nature_index_year)
+    with open(args.output, "w") as f:
+        json.dump(records, f)
+
+    print("Enriched {} records from {} countries in {:.1f}s".format(
+        len(records), len({x["country_norm"] for x in records if x["country_norm"]}), time.monotonic() - start))
+    print("985: {}, 211: {}".format(sum(x["c985"] for x in records), sum(x["c211"] for x in records)))
+    print("Countries not resolved ({} records):".format(sum(unresolved.values())))
+    for country, n in unresolved.most_common(20):
+        print("  {}: {}".format(country, n))
+
+
+if __name__ == "__main__":
+    main()
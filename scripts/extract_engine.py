@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import time
+
+from output_parser import DeadLetterQueue, parse_content, parse_result, validate
+from prompts import PROMPT_VERSION, abstract_messages, auth_messages, compact_messages, packed_messages, split_packed_output
+from response_cache import CacheMiss, ResponseCache, cached_call
+from results_store import ResultsStore, iter_records
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute.
+    rpm: requests per minute, None for no limit
+    tpm: tokens per minute, None for no limit
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm or 0)
+        self._tokens = float(tpm or 0)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens=0):
+        # Requests queue on the lock so they are let through in arrival order
+        async with self._lock:
+            tokens = min(tokens, self.tpm) if self.tpm else 0
+            while True:
+                self._refill()
+                wait = 0
+                if self.rpm and self._requests < 1:
+                    wait = (1 - self._requests) * 60 / self.rpm
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.rpm:
+                self._requests -= 1
+            if self.tpm:
+                self._tokens -= tokens
+
+    def correct(self, estimated, actual):
+        # Charge the difference once the real usage is known
+        if self.tpm:
+            self._tokens -= actual - estimated
+
+
+def estimate_tokens(messages, max_tokens=1000):
+    # Roughly four characters per token, plus the completion allowance
+    return sum(len(m["content"]) for m in messages) // 4 + max_tokens
+
+
+def is_retryable(err):
+    status = getattr(err, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(err).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(err, (ConnectionError, asyncio.TimeoutError))
+
+
+def retry_after(err):
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def make_replay_call(model="gpt-3.5-turbo"):
+    # Used with a read-only cache, any request that reaches it was not cached
+    async def call(messages):
+        raise CacheMiss("No cached response and running in replay mode")
+    call.model = model
+    return call
+
+
+def make_openai_call(model="gpt-3.5-turbo", base_url=None, api_key=None, max_tokens=1000):
+    """
+    Returns an async function taking a message list and returning (content, usage).
+    base_url: point at a local stub server (see stub_server.py) for testing
+    """
+    from openai import AsyncOpenAI
+    if api_key is None:
+        import dotenv
+        dotenv.load_dotenv()
+        api_key = os.environ.get("OPENAI_API_KEY")
+    # Retries are handled by the engine so they can be counted and rate limited
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+    async def call(messages):
+        response = await client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens)
+        usage = {"prompt_tokens": response.usage.prompt_tokens, "completion_tokens": response.usage.completion_tokens} if response.usage else {}
+        return response.choices[0].message.content, usage
+    call.model = model
+    return call
+
+
+async def call_with_backoff(call, messages, limiter, stats, max_retries=6, base_delay=1.0, max_delay=60.0):
+    estimated = estimate_tokens(messages)
+    attempt = 0
+    while True:
+        await limiter.acquire(estimated)
+        try:
+            content, usage = await call(messages)
+        except Exception as err:
+            if attempt >= max_retries or not is_retryable(err):
+                raise
+            delay = retry_after(err) or min(max_delay, base_delay * 2 ** attempt)
+            # Full jitter so a burst of 429s does not retry in lockstep
+            await asyncio.sleep(random.uniform(0, delay))
+            attempt += 1
+            stats["retries"] += 1
+            continue
+        limiter.correct(estimated, sum(usage.values()) if usage else estimated)
+        return content, usage
+
+
+async def extract_all(records, call, build_messages=abstract_messages, field="ab", concurrency=16, rpm=None, tpm=None, max_retries=6, on_result=None, on_failure=None, report_every=100, kind=None, ledger=None):
+    """
+    records: list of dicts with 'pmid' and the text field, e.g. the contents of data/pubmed.json
+    call: async function from make_openai_call
+    build_messages: abstract_messages or auth_messages
+    field: 'ab' for abstracts, 'author_affil' for affiliations, 'group' for groups from pack_records
+    concurrency: maximum number of requests in flight
+    rpm, tpm: requests and tokens per minute limits
+    on_result: called with each parsed result as it arrives
+    on_failure: called with (pmid, reason, stage, content) for each record that could not be processed
+    kind: 'abstracts' or 'authors' to validate results against that schema, None to only parse the json
+    ledger: RunLedger receiving prompt/api/parse/persist timings and each PMID's tokens, retries and failure reason
+    Returns (results, stats)
+    """
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    queue = asyncio.Queue()
+    for record in records:
+        if field in record.keys():
+            queue.put_nowait(record)
+    stats = {"total": queue.qsize(), "done": 0, "failed": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0, "failures": []}
+    results = []
+    start = time.monotonic()
+
+    async def worker():
+        while True:
+            try:
+                record = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            pmid = record["pmid"]
+            # A packed request answers for every PMID of its group, each gets its own result, failure and ledger row
+            pmids = [x["pmid"] for x in record["group"]] if field == "group" else [pmid]
+            stage, content, usage = "request", None, {}
+            # Retries are counted per record for the ledger, then added to the run's total
+            attempts = {"retries": 0}
+            t0 = time.perf_counter()
+            try:
+                messages = build_messages(record[field])
+                t1 = time.perf_counter()
+                try:
+                    content, usage = await call_with_backoff(call, messages, limiter, attempts, max_retries=max_retries)
+                finally:
+                    t2 = time.perf_counter()
+                    stats["retries"] += attempts["retries"]
+                stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                stats["completion_tokens"] += usage.get("completion_tokens", 0)
+                stage = "parse"
+                if field == "group":
+                    found, missing = parse_packed(content, record["group"], kind)
+                elif kind is None:
+                    o = parse_content(content)
+                    o["pmid"] = pmid
+                    found, missing = [o], {}
+                else:
+                    found, missing = [parse_result(content, pmid, kind)], {}
+            except Exception as err:
+                stats["failed"] += 1
+                reason = "{}: {}".format(type(err).__name__, err)
+                stats["failures"].append((pmid, reason))
+                shares = split_counts({**usage, **attempts}, len(pmids))
+                for p, share in zip(pmids, shares):
+                    if on_failure is not None:
+                        on_failure(p, reason, stage, content)
+                    if ledger is not None:
+                        ledger.record(p, "failed", share.get("prompt_tokens", 0), share.get("completion_tokens", 0), share["retries"],
+                                      stage=stage, reason=reason)
+                continue
+            t3 = time.perf_counter()
+            if missing:
+                # Members missing from a packed response make the request count as failed, the rest are still kept
+                stats["failed"] += 1
+                stats["failures"].append((pmid, "ParseError: {} of {} missing or invalid".format(len(missing), len(pmids))))
+            else:
+                stats["done"] += 1
+            for o in found:
+                results.append(o)
+                if on_result is not None:
+                    on_result(o)
+            for p, reason in missing.items():
+                if on_failure is not None:
+                    on_failure(p, reason, "parse", content)
+            if ledger is not None:
+                ledger.add_time("prompt", t1 - t0)
+                ledger.add_time("api", t2 - t1)
+                ledger.add_time("parse", t3 - t2)
+                ledger.add_time("persist", time.perf_counter() - t3)
+                for p, share in zip(pmids, split_counts({**usage, **attempts}, len(pmids))):
+                    ledger.record(p, "failed" if p in missing else "done", share.get("prompt_tokens", 0), share.get("completion_tokens", 0),
+                                  share["retries"], (t2 - t1) / len(pmids), stage="parse" if p in missing else None, reason=missing.get(p))
+            if report_every and stats["done"] and stats["done"] % report_every == 0:
+                print("{} of {} done, {:.1f} abstracts/sec".format(stats["done"], stats["total"], stats["done"] / (time.monotonic() - start)))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+    stats["elapsed"] = elapsed
+    stats["abstracts_per_sec"] = stats["done"] / elapsed if elapsed else 0.0
+    stats["tokens_per_sec"] = (stats["prompt_tokens"] + stats["completion_tokens"]) / elapsed if elapsed else 0.0
+    return results, stats
+
+
+def split_counts(counts, n):
+    """
+    Share the token and retry counts of a packed request between its n PMIDs, so the per-PMID rows add up to the request's
+    """
+    return [{k: v // n + (i < v % n) for k, v in counts.items()} for i in range(n)]
+
+
+def parse_packed(content, group, kind=None):
+    """
+    content: response to packed_messages for the records in group
+    kind: schema to validate each result against and stamp with the prompt_version, None to only parse the json
+    Returns (results of the PMIDs found, {pmid: reason} for those missing or invalid)
+    """
+    pmids = [x["pmid"] for x in group]
+    found = {str(x["pmid"]): x for x in split_packed_output(parse_content(content), pmids)}
+    results, missing = [], {}
+    for pmid in pmids:
+        o = found.get(str(pmid))
+        problems = ["missing from packed response"] if o is None else validate(o, kind) if kind is not None else []
+        if problems:
+            missing[pmid] = "ParseError: " + "; ".join(problems)
+            continue
+        if kind is not None:
+            o["prompt_version"] = PROMPT_VERSION
+        results.append(o)
+    return results, missing
+
+
+def pack_records(records, size, field="ab"):
+    """
+    Group records into pseudo-records of up to size abstracts for use with packed_messages and field='group'.
+    The 'pmid' of each group only labels the request in stats; results, failures and ledger rows are per member PMID.
+    """
+    records = [x for x in records if field in x.keys()]
+    groups = []
+    for i in range(0, len(records), size):
+        group = records[i:i + size]
+        groups.append({"pmid": ",".join(str(x["pmid"]) for x in group), "group": group})
+    return groups
+
+
+def print_stats(stats):
+    print("Processed {done} of {total} ({failed} failed, {retries} retries) in {elapsed:.1f}s".format(**stats))
+    print("Throughput: {:.2f} abstracts/sec, {:.0f} tokens/sec".format(stats["abstracts_per_sec"], stats["tokens_per_sec"]))
+
+
+def run_extraction(args, ledger=None):
+    """
+    The extraction described by the command line arguments, recording into ledger if given
+    """
+    stage = ledger.stage if ledger is not None else lambda name: contextlib.nullcontext()
+
+    with stage("load"):
+        a = list(iter_records(args.input))
+    with stage("filter"):
+        if args.skip_predatory:
+            from journal_screen import skip_listed
+            a = list(skip_listed(a))
+        store = ResultsStore(args.store or os.path.splitext(args.output)[0] + ".jsonl")
+        a = store.todo(a)
+    print("{} already done, {} to process".format(len(store), len(a)))
+
+    if args.kind == "abstracts":
+        build_messages, field = abstract_messages, "ab"
+        if args.compact:
+            few_shot = not args.no_few_shot
+            build_messages = lambda abstract: compact_messages(abstract, few_shot=few_shot)
+    else:
+        build_messages, field = auth_messages, "author_affil"
+        if args.local_threshold is not None:
+            from affil_resolver import AffiliationResolver, learned_outputs, resolve_records
+            with stage("filter"):
+                resolver = AffiliationResolver.build(learn_from=learned_outputs())
+                local = []
+
+                def on_local(o):
+                    o["prompt_version"] = PROMPT_VERSION
+                    store.append(o)
+                    local.append(o["pmid"])
+                    if ledger is not None:
+                        ledger.record(o["pmid"], "local")
+                a = resolve_records(a, resolver, args.local_threshold, on_local)
+            print("Resolved {} affiliations locally, {} left for the model".format(len(local), len(a)))
+
+    if args.replay:
+        call = make_replay_call(model=args.model)
+    else:
+        call = make_openai_call(model=args.model, base_url=args.base_url)
+    cache = None
+    if args.cache:
+        max_bytes = int(args.cache_max_mb * 1e6) if args.cache_max_mb else None
+        cache = ResponseCache(args.cache, max_bytes=max_bytes, replay=args.replay)
+        call = cached_call(call, cache)
+
+    if args.pack > 1 and args.kind == "abstracts":
+        a = pack_records(a, args.pack)
+        build_messages = lambda group: packed_messages(group, few_shot=not args.no_few_shot)
+        field = "group"
+
+    dlq = DeadLetterQueue(args.dead_letter or os.path.splitext(args.output)[0] + ".failed.jsonl")
+    with store, dlq:
+        result, stats = asyncio.run(extract_all(a, call, build_messages, field, concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm,
+                                                on_result=store.append, on_failure=dlq.add, kind=args.kind, ledger=ledger))
+        print_stats(stats)
+        with stage("persist"):
+            store.compact(args.output)
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract exposures/outcomes or affiliations concurrently")
+    parser.add_argument("input", help="e.g. data/pubmed_new.json")
+    parser.add_argument("output", help="e.g. data/pubmed_abstracts_new.json")
+    parser.add_argument("--kind", choices=["abstracts", "authors"], default="abstracts")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--base-url", default=None, help="e.g. http://127.0.0.1:8000/v1 for the stub server")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rpm", type=int, default=None)
+    parser.add_argument("--tpm", type=int, default=None)
+    parser.add_argument("--store", default=None, help="JSONL checkpoint, defaults to the output path with .jsonl; rerunning resumes from it")
+    parser.add_argument("--dead-letter", default=None, help="JSONL of failed PMIDs and reasons, defaults to the output path with .failed.jsonl")
+    parser.add_argument("--compact", action="store_true", help="Use the compact prompt (cacheable prefix, prompt sent once)")
+    parser.add_argument("--no-few-shot", action="store_true", help="With --compact, show only the example output, not the example abstract")
+    parser.add_argument("--pack", type=int, default=1, help="Number of abstracts per request, always uses the compact prompt")
+    parser.add_argument("--cache", default=None, help="SQLite response cache, e.g. data/response_cache.sqlite")
+    parser.add_argument("--cache-max-mb", type=float, default=None)
+    parser.add_argument("--replay", action="store_true", help="Only serve responses from the cache, never call the API")
+    parser.add_argument("--skip-predatory", action="store_true", help="Skip records from journals in data/predatory_journals.txt")
+    parser.add_argument("--local-threshold", type=float, default=None,
+                        help="With --kind authors, resolve affiliations locally when confidence is at least this, e.g. 0.8")
+    parser.add_argument("--ledger", default="data/run_ledger.sqlite", help="SQLite run ledger, see run_ledger.py")
+    parser.add_argument("--no-ledger", action="store_true")
+    args = parser.parse_args()
+
+    if args.replay and not args.cache:
+        parser.error("--replay needs --cache")
+    if args.no_ledger:
+        run_extraction(args)
+        return
+    from run_ledger import RunLedger
+    # A run that crashes or is interrupted is recorded as failed instead of staying 'running'
+    with RunLedger(args.ledger) as ledger:
+        ledger.start("extract_engine", args.kind, args.model, args=args)
+        run_extraction(args, ledger)
+    print("Recorded run {} in {}".format(ledger.run_id, args.ledger))
+
+
+if __name__ == "__main__":
+    main()
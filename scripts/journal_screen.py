@@ -0,0 +1,237 @@
+import argparse
+import csv
+import difflib
+import json
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+from results_store import iter_records
+
+# Full words and their ISO 4 abbreviations map to the same token, so "Int J Med Sci" matches
+# "International Journal of Medical Sciences"
+ABBREVIATIONS = {
+    "journal": "j", "journals": "j", "jour": "j",
+    "international": "int", "intl": "int",
+    "medicine": "med", "medical": "med",
+    "research": "res",
+    "science": "sci", "sciences": "sci", "scientific": "sci",
+    "review": "rev", "reviews": "rev",
+    "clinical": "clin",
+    "american": "am",
+    "european": "eur",
+    "advances": "adv", "advanced": "adv",
+    "reports": "rep",
+    "studies": "stud",
+    "biology": "biol", "biological": "biol",
+    "chemistry": "chem", "chemical": "chem",
+    "technology": "technol",
+    "engineering": "eng",
+    "pharmacy": "pharm", "pharmaceutical": "pharm", "pharmacology": "pharmacol",
+    "environmental": "environ", "environment": "environ",
+    "management": "manag",
+    "applied": "appl",
+    "current": "curr",
+    "annals": "ann",
+    "archives": "arch",
+    "bulletin": "bull",
+    "proceedings": "proc",
+}
+_abbreviations = set(ABBREVIATIONS.values()) - set(ABBREVIATIONS)
+# Abbreviated words that say nothing about a journal's field
+GENERIC_WORDS = {"j", "int", "sci", "res", "rev", "adv", "curr", "rep", "stud", "proc", "ann", "arch", "bull"}
+_stopwords = {"of", "the", "and", "for", "in", "on", "a", "an", "de", "et", "la"}
+_subtitle = re.compile(r"\s+:\s+.*$")
+_punct = re.compile(r"[^\w]+")
+# Titles with more words than this may also match with their words reordered, or near-identically
+MIN_FALLBACK_WORDS = 4
+
+
+def title_words(name):
+    """
+    e.g. "Journal of Alzheimer's disease : JAD" -> ["journal", "of", "alzheimer", "s", "disease"]
+    Case, accents and punctuation are removed, "&" reads as "and" and PubMed's " : abbreviation" suffix is dropped.
+    Parenthesised qualifiers are kept, so "Research (French version)" is not "Research".
+    """
+    name = _subtitle.sub("", str(name))
+    name = unicodedata.normalize("NFKD", name.replace("&", " and ")).encode("ascii", "ignore").decode("ascii")
+    return _punct.sub(" ", name.casefold()).split()
+
+
+def journal_key(name, abbreviated=False):
+    """
+    Title words without stopwords, e.g. "Science & Technology" -> "science technology".
+    abbreviated: fold full words to their ISO 4 abbreviation, "Science & Technology" -> "sci technol"
+    """
+    words = [w for w in title_words(name) if w not in _stopwords]
+    return " ".join(ABBREVIATIONS.get(w, w) if abbreviated else w for w in words)
+
+
+def is_abbreviated(name):
+    """
+    True for titles written with ISO 4 abbreviations, e.g. "Int J Med Sci"
+    """
+    return any(w in _abbreviations for w in title_words(name))
+
+
+def is_generic(name):
+    """
+    True for titles made only of GENERIC_WORDS, e.g. "Journal of Science" or "Research".
+    Many unrelated journals share these, so they do not identify the listed one.
+    """
+    return all(w in GENERIC_WORDS for w in journal_key(name, abbreviated=True).split())
+
+
+class JournalScreen:
+    """
+    Hashed index of the predatory journal list. A journal matches a listed title exactly, then case-folded, then on
+    ISO 4 abbreviations if it is itself abbreviated. Titles of at least MIN_FALLBACK_WORDS words may also match with
+    their words in any order, then on near-identical titles sharing a first word.
+    path: e.g. data/predatory_journals.txt, one title per line
+    include_hijacked: also match entries such as "Agrociencia (hijacker of the legitimate journal Agrociencia)",
+    which have the same title as the journal they imitate and so flag the real one too
+    include_generic: also match generic titles such as "Journal of Science", see is_generic
+    fuzzy_cutoff: difflib ratio for the last stage, 0 to turn it off
+    """
+
+    def __init__(self, path="data/predatory_journals.txt", include_hijacked=False, fuzzy_cutoff=0.95, include_generic=False):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.exact = set()
+        self.folded = {}
+        self.abbreviated = {}
+        self.titles = {}
+        self.sorted_titles = {}
+        self.blocks = defaultdict(list)
+        self.hijacked = 0
+        self.generic = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                title = line.strip()
+                if not title:
+                    continue
+                if "hijack" in title.lower() and not include_hijacked:
+                    self.hijacked += 1
+                    continue
+                if is_generic(title) and not include_generic:
+                    self.generic += 1
+                    continue
+                self.exact.add(title)
+                self.folded.setdefault(" ".join(title_words(title)), title)
+                self.abbreviated.setdefault(journal_key(title, abbreviated=True), title)
+                k = journal_key(title)
+                if not k:
+                    continue
+                self.titles.setdefault(k, title)
+                if len(title_words(title)) >= MIN_FALLBACK_WORDS:
+                    self.sorted_titles.setdefault(" ".join(sorted(k.split())), title)
+                    self.blocks[k.split()[0]].append(k)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.exact)
+
+    def _match(self, journal):
+        journal = journal.strip()
+        if journal in self.exact:
+            return journal
+        words = title_words(journal)
+        title = self.folded.get(" ".join(words))
+        if title is None and is_abbreviated(journal):
+            title = self.abbreviated.get(journal_key(journal, abbreviated=True))
+        if title is not None or len(words) < MIN_FALLBACK_WORDS or is_generic(journal):
+            return title
+        k = journal_key(journal)
+        title = self.sorted_titles.get(" ".join(sorted(k.split())))
+        if title is None and self.fuzzy_cutoff and k:
+            close = difflib.get_close_matches(k, self.blocks.get(k.split()[0], []), n=1, cutoff=self.fuzzy_cutoff)
+            title = self.titles[close[0]] if close else None
+        return title
+
+    def match(self, journal):
+        """
+        Returns the listed title the journal matches, or None
+        """
+        if not isinstance(journal, str) or not journal.strip():
+            return None
+        if journal not in self._cache:
+            self._cache[journal] = self._match(journal)
+        return self._cache[journal]
+
+
+def screen_records(records, screen, skip=False, on_skip=None):
+    """
+    Adds 'predatory' (matched title or None) to each input record.
+    skip: drop records from listed journals instead, calling on_skip(record) for each
+    """
+    for x in records:
+        x["predatory"] = screen.match(x.get("journal"))
+        if skip and x["predatory"]:
+            if on_skip is not None:
+                on_skip(x)
+            continue
+        yield x
+
+
+def skip_listed(records, path="data/predatory_journals.txt"):
+    """
+    Drop records from listed journals before extraction, reporting how many were skipped
+    """
+    screen = JournalScreen(path)
+    skipped = []
+    for x in screen_records(records, screen, skip=True, on_skip=skipped.append):
+        yield x
+    print("Skipped {} records from {} listed journals".format(len(skipped), len({x["predatory"] for x in skipped})))
+
+
+def counts_by_year(records):
+    """
+    records: screened records with 'pub_date'
+    Returns {year: (number of records, number in listed journals)}
+    """
+    n, npred = Counter(), Counter()
+    for x in records:
+        year = str(x.get("pub_date") or "")[:4]
+        if not year.isdigit():
+            continue
+        n[year] += 1
+        if x.get("predatory"):
+            npred[year] += 1
+    return {year: (n[year], npred[year]) for year in sorted(n)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flag or skip PubMed records from predatory journals before extraction")
+    parser.add_argument("input", help="e.g. data/pubmed_new.json")
+    parser.add_argument("output", help="Screened records, e.g. data/pubmed_new_screened.json")
+    parser.add_argument("--journals", default="data/predatory_journals.txt")
+    parser.add_argument("--skip", action="store_true", help="Leave records from listed journals out of the output")
+    parser.add_argument("--include-hijacked", action="store_true")
+    parser.add_argument("--include-generic", action="store_true", help="Also match generic listed titles such as 'Journal of Science'")
+    parser.add_argument("--fuzzy-cutoff", type=float, default=0.95)
+    parser.add_argument("--counts", default="data/pubmed_counts/predatory_by_year.csv", help="Records and predatory records per year")
+    args = parser.parse_args()
+
+    screen = JournalScreen(args.journals, args.include_hijacked, args.fuzzy_cutoff, args.include_generic)
+    print("{} listed journals ({} hijacked and {} generic titles left out)".format(len(screen), screen.hijacked, screen.generic))
+    records = list(iter_records(args.input))
+    skipped = []
+    kept = list(screen_records(records, screen, args.skip, skipped.append))
+    with open(args.output, "w") as f:
+        json.dump(kept, f)
+
+    flagged = Counter(x["predatory"] for x in records if x["predatory"])
+    print("{} of {} records are from {} listed journals{}".format(
+        sum(flagged.values()), len(records), len(flagged), ", skipped" if args.skip else ""))
+    for title, count in flagged.most_common(10):
+        print("  {}: {}".format(title, count))
+
+    with open(args.counts, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Year", "Count", "Predatory"])
+        for year, (n, npred) in counts_by_year(records).items():
+            writer.writerow([year, n, npred])
+    print("Wrote counts per year to {}".format(args.counts))
+
+
+if __name__ == "__main__":
+    main()
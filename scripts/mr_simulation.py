@@ -0,0 +1,211 @@
+import argparse
+import csv
+import itertools
+import time
+
+import numpy as np
+
+try:
+    from scipy import stats as scipy_stats
+except ImportError:
+    # scipy is optional, it is not in requirements.txt
+    scipy_stats = None
+
+# Replicates are simulated in chunks of at most this many genotype values, to bound memory
+CHUNK_VALUES = 20_000_000
+Z_975 = 1.959963984540054
+
+
+def t_quantile(df, z=Z_975):
+    """
+    Two-sided 95% quantile of Student's t, as used by R's confint. Exact from scipy if it is installed (it is optional),
+    otherwise from the Cornish-Fisher expansion around the normal, which is within 1e-4 from df = 10 but low for smaller df
+    (3.1786 instead of 3.1824 at df = 3)
+    """
+    df = np.asarray(df, dtype=float)
+    if scipy_stats is not None:
+        return scipy_stats.t.ppf(scipy_stats.norm.cdf(z), df)
+    return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3)
+            + (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / (92160 * df ** 4))
+
+
+def simulate(rng, reps, n=1000, n_snps=10, maf=0.3, strength=0.3, strength_sd=0.1, confounding=0.8, causal=0.0, noise_sd=0.5):
+    """
+    reps datasets as in obs-iv-figure.r: G has n_snps SNPs coded 0/1/2, U is a confounder of X and Y, and
+    X = G beta + confounding U + e, Y = causal X + confounding U + e. Each replicate draws its own beta ~ N(strength, strength_sd).
+    Returns G (reps, n, n_snps), X and Y (reps, n)
+    """
+    G = rng.binomial(2, maf, size=(reps, n, n_snps)).astype(np.float64)
+    U = rng.standard_normal((reps, n))
+    beta = rng.normal(strength, strength_sd, size=(reps, n_snps))
+    X = np.einsum("rnk,rk->rn", G, beta) + confounding * U + rng.normal(0, noise_sd, size=(reps, n))
+    Y = causal * X + confounding * U + rng.normal(0, noise_sd, size=(reps, n))
+    return G, X, Y
+
+
+def ols_slope(x, y):
+    """
+    Slope and standard error of lm(y ~ x) for every row of x and y (reps, n)
+    """
+    xc = x - x.mean(axis=1, keepdims=True)
+    yc = y - y.mean(axis=1, keepdims=True)
+    sxx = np.einsum("rn,rn->r", xc, xc)
+    b = np.einsum("rn,rn->r", xc, yc) / sxx
+    resid = yc - b[:, None] * xc
+    se = np.sqrt(np.einsum("rn,rn->r", resid, resid) / (x.shape[1] - 2) / sxx)
+    return b, se
+
+
+def first_stage(G, X):
+    """
+    Fitted values of lm(X ~ G) for every replicate from one batched solve of the normal equations, and the first stage F statistic
+    """
+    Gc = G - G.mean(axis=1, keepdims=True)
+    Xc = X - X.mean(axis=1, keepdims=True)
+    GtG = Gc.transpose(0, 2, 1) @ Gc
+    GtX = np.einsum("rnk,rn->rk", Gc, Xc)
+    try:
+        coef = np.linalg.solve(GtG, GtX[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # A SNP with no variation in a small sample; the pseudo-inverse drops it as lm does
+        coef = np.einsum("rkj,rj->rk", np.linalg.pinv(GtG), GtX)
+    fitted = np.einsum("rnk,rk->rn", Gc, coef)
+    n, k = G.shape[1], G.shape[2]
+    ss_reg = np.einsum("rn,rn->r", fitted, fitted)
+    ss_res = np.einsum("rn,rn->r", Xc - fitted, Xc - fitted)
+    f_stat = (ss_reg / k) / (ss_res / (n - k - 1))
+    return X.mean(axis=1, keepdims=True) + fitted, f_stat
+
+
+def two_stage(G, X, Y):
+    """
+    Observational and 2SLS estimates for every replicate.
+    iv_se is the 2SLS standard error (residuals from Y - b X); iv_se_naive is what lm(Y ~ X_predicted) reports, as in the figure.
+    Returns (dict of (reps,) arrays, X_predicted)
+    """
+    n = X.shape[1]
+    X_predicted, f_stat = first_stage(G, X)
+    obs, obs_se = ols_slope(X, Y)
+    iv, iv_se_naive = ols_slope(X_predicted, Y)
+    xc = X_predicted - X_predicted.mean(axis=1, keepdims=True)
+    resid = (Y - Y.mean(axis=1, keepdims=True)) - iv[:, None] * (X - X.mean(axis=1, keepdims=True))
+    iv_se = np.sqrt(np.einsum("rn,rn->r", resid, resid) / (n - 2) / np.einsum("rn,rn->r", xc, xc))
+    t = t_quantile(n - 2)
+    return {
+        "obs": obs, "obs_se": obs_se, "obs_lower": obs - t * obs_se, "obs_upper": obs + t * obs_se,
+        "iv": iv, "iv_se": iv_se, "iv_lower": iv - t * iv_se, "iv_upper": iv + t * iv_se,
+        "iv_se_naive": iv_se_naive, "f_stat": f_stat,
+    }, X_predicted
+
+
+def binned(X_predicted, X, Y, n_bins=10):
+    """
+    Mean X, Y and predicted X within quantile bins of predicted X for every replicate, like the figure's genetic score classes.
+    Bins are formed by rank, so each holds n / n_bins individuals. Returns dict of (reps, n_bins) arrays and the bin sizes
+    """
+    n = X.shape[1]
+    order = np.argsort(X_predicted, axis=1)
+    starts = (np.arange(n_bins) * n) // n_bins
+    sizes = np.diff(np.append(starts, n))
+    out = {}
+    for name, values in (("mean_X", X), ("mean_Y", Y), ("mean_X_predicted", X_predicted)):
+        out[name] = np.add.reduceat(np.take_along_axis(values, order, axis=1), starts, axis=1) / sizes
+    return out, sizes
+
+
+def run_scenario(rng, reps, n_bins=10, causal=0.0, **params):
+    """
+    Simulate reps replicates of one scenario in chunks and summarise them: mean and SD of each estimate, CI coverage of
+    the causal effect, mean F statistic, and the bin means averaged over replicates
+    """
+    chunk = max(1, CHUNK_VALUES // (params.get("n", 1000) * params.get("n_snps", 10)))
+    estimates, bins = [], []
+    for start in range(0, reps, chunk):
+        G, X, Y = simulate(rng, min(chunk, reps - start), causal=causal, **params)
+        e, X_predicted = two_stage(G, X, Y)
+        estimates.append(e)
+        b, sizes = binned(X_predicted, X, Y, n_bins)
+        bins.append(b)
+    e = {k: np.concatenate([x[k] for x in estimates]) for k in estimates[0]}
+    summary = {
+        "obs_mean": e["obs"].mean(), "obs_sd": e["obs"].std(ddof=1) if reps > 1 else 0.0,
+        "obs_coverage": np.mean((e["obs_lower"] <= causal) & (causal <= e["obs_upper"])),
+        "iv_mean": e["iv"].mean(), "iv_sd": e["iv"].std(ddof=1) if reps > 1 else 0.0,
+        "iv_coverage": np.mean((e["iv_lower"] <= causal) & (causal <= e["iv_upper"])),
+        "iv_coverage_naive": np.mean(np.abs(e["iv"] - causal) <= t_quantile(params.get("n", 1000) - 2) * e["iv_se_naive"]),
+        "f_mean": e["f_stat"].mean(),
+    }
+    bin_means = {k: np.concatenate([b[k] for b in bins]).mean(axis=0) for k in bins[0]}
+    return summary, bin_means, sizes
+
+
+def figure_data(seed=123, n_bins=10, **params):
+    """
+    One replicate with everything obs-iv-figure.r plots: individual points, bin means and both estimates with their CIs
+    """
+    G, X, Y = simulate(np.random.default_rng(seed), 1, **params)
+    e, X_predicted = two_stage(G, X, Y)
+    b, sizes = binned(X_predicted, X, Y, n_bins)
+    points = {"X": X[0], "Y": Y[0], "X_predicted": X_predicted[0]}
+    bins = {k: v[0] for k, v in b.items()}
+    bins["n"] = sizes
+    return points, bins, {k: float(v[0]) for k, v in e.items()}
+
+
+def write_columns(path, columns):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns))
+        writer.writerows(zip(*columns.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo comparison of observational and 2SLS estimates across MR scenarios")
+    parser.add_argument("--n", type=int, nargs="+", default=[1000])
+    parser.add_argument("--snps", type=int, nargs="+", default=[10])
+    parser.add_argument("--strength", type=float, nargs="+", default=[0.3], help="Mean SNP effect on X")
+    parser.add_argument("--confounding", type=float, nargs="+", default=[0.8], help="Effect of U on both X and Y")
+    parser.add_argument("--causal", type=float, nargs="+", default=[0.0], help="True effect of X on Y")
+    parser.add_argument("--reps", type=int, default=1000)
+    parser.add_argument("--bins", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--output", default="data/mr_simulation.csv", help="One row per scenario")
+    parser.add_argument("--bins-output", default="data/mr_simulation_bins.csv", help="Bin means per scenario, averaged over replicates")
+    parser.add_argument("--figure", default=None, help="Also write one replicate of the first scenario for the figure, e.g. data/obs_iv")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    grid = list(itertools.product(args.n, args.snps, args.strength, args.confounding, args.causal))
+    start = time.monotonic()
+    rows, bin_rows = [], []
+    for i, (n, snps, strength, confounding, causal) in enumerate(grid):
+        params = {"n": n, "n_snps": snps, "strength": strength, "confounding": confounding}
+        summary, bin_means, sizes = run_scenario(rng, args.reps, args.bins, causal=causal, **params)
+        rows.append({"scenario": i, **params, "causal": causal, "reps": args.reps, **summary})
+        for b in range(args.bins):
+            bin_rows.append({"scenario": i, "bin": b + 1, "n": sizes[b], **{k: v[b] for k, v in bin_means.items()}})
+    write_columns(args.output, {k: [r[k] for r in rows] for k in rows[0]})
+    write_columns(args.bins_output, {k: [r[k] for r in bin_rows] for k in bin_rows[0]})
+    print("Simulated {} scenarios x {} replicates in {:.1f}s, wrote {} and {}".format(
+        len(grid), args.reps, time.monotonic() - start, args.output, args.bins_output))
+
+    if args.figure:
+        n, snps, strength, confounding, causal = grid[0]
+        points, bins, estimates = figure_data(args.seed, args.bins, n=n, n_snps=snps, strength=strength, confounding=confounding, causal=causal)
+        write_columns(args.figure + "_points.csv", points)
+        write_columns(args.figure + "_bins.csv", bins)
+        t = t_quantile(n - 2)
+        rows = {
+            "model": ["observational", "iv"],
+            "estimate": [estimates["obs"], estimates["iv"]],
+            "se": [estimates["obs_se"], estimates["iv_se_naive"]],
+            "lower": [estimates["obs_lower"], estimates["iv"] - t * estimates["iv_se_naive"]],
+            "upper": [estimates["obs_upper"], estimates["iv"] + t * estimates["iv_se_naive"]],
+        }
+        write_columns(args.figure + "_estimates.csv", rows)
+        print("Wrote figure data to {}_points.csv, {}_bins.csv and {}_estimates.csv".format(args.figure, args.figure, args.figure))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import json
+import time
+from collections import Counter
+
+from prompts import PROMPT_VERSION
+from results_store import ResultsStore, iter_records
+
+_decoder = json.JSONDecoder()
+
+
+class ParseError(ValueError):
+    pass
+
+
+def parse_content(text):
+    """
+    Parse a model response: skip anything before the first '{' that starts a json object (markdown fences,
+    whitespace, control characters, preamble that may itself hold braces) and ignore anything after the matching '}'.
+    """
+    start = text.find("{")
+    if start < 0:
+        raise ParseError("no json object in response")
+    first = None
+    while start >= 0:
+        try:
+            o, _ = _decoder.raw_decode(text, start)
+            return o
+        except json.JSONDecodeError as err:
+            # Report why the first candidate failed, it is the one most likely meant as the answer
+            first = first or err
+            # Braces before the point of failure are inside this candidate, e.g. the traits of a truncated response
+            start = text.find("{", max(start + 1, err.pos))
+    raise ParseError("invalid json: {}".format(first.msg))
+
+
+def _check_traits(o, key, problems):
+    traits = o.get(key)
+    if not isinstance(traits, list):
+        problems.append("'{}' is not a list".format(key))
+        return
+    for i, x in enumerate(traits):
+        if not isinstance(x, dict) or not isinstance(x.get("trait"), str) or not isinstance(x.get("category"), str):
+            problems.append("{}[{}] needs string 'trait' and 'category'".format(key, i))
+
+
+def validate(o, kind="abstracts"):
+    """
+    Check a parsed result against the output schema, coercing numeric strings in 'results'.
+    Returns a list of problems, empty if the record is valid
+    """
+    problems = []
+    if not isinstance(o, dict):
+        return ["result is not a json object"]
+    if kind == "authors":
+        for key in ("institution", "country"):
+            if not isinstance(o.get(key), str):
+                problems.append("'{}' is not a string".format(key))
+        return problems
+    _check_traits(o, "exposures", problems)
+    _check_traits(o, "outcomes", problems)
+    if "methods" in o and not (isinstance(o["methods"], list) and all(isinstance(m, str) for m in o["methods"])):
+        problems.append("'methods' is not a list of strings")
+    if "results" in o:
+        results = o["results"]
+        if not isinstance(results, dict):
+            problems.append("'results' is not an object")
+        else:
+            for key in ("null", "non-null"):
+                value = results.get(key, 0)
+                if isinstance(value, str) and value.strip().isdigit():
+                    results[key] = value = int(value)
+                if not isinstance(value, int) or value < 0:
+                    problems.append("results['{}'] is not a count".format(key))
+    return problems
+
+
+def parse_result(text, pmid, kind="abstracts", prompt_version=PROMPT_VERSION):
+    """
+    Parse and validate a response, returning the record with its pmid and prompt_version or raising ParseError
+    """
+    o = parse_content(text)
+    problems = validate(o, kind)
+    if problems:
+        raise ParseError("; ".join(problems))
+    o["pmid"] = pmid
+    o["prompt_version"] = prompt_version
+    return o
+
+
+def iter_batch_output(lines, kind="abstracts", on_usage=None):
+    """
+    lines: lines of a Batch API output or error file, e.g. from iter_lines() or an open file
+    on_usage: called with (custom_id, usage) for each response that reports token usage
+    Yields (custom_id, record, None) for good responses and (custom_id, None, reason) otherwise
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            x = json.loads(line)
+        except json.JSONDecodeError:
+            yield None, None, "unreadable output line"
+            continue
+        custom_id = x.get("custom_id")
+        response = x.get("response") or {}
+        if x.get("error"):
+            yield custom_id, None, "batch error: {}".format(x["error"].get("message", x["error"]))
+            continue
+        usage = (response.get("body") or {}).get("usage")
+        if on_usage is not None and usage:
+            on_usage(custom_id, usage)
+        if response.get("status_code") != 200:
+            message = ((response.get("body") or {}).get("error") or {}).get("message", "")
+            yield custom_id, None, "http {}: {}".format(response.get("status_code"), message)
+            continue
+        try:
+            content = response["body"]["choices"][0]["message"]["content"]
+            yield custom_id, parse_result(content, custom_id, kind), None
+        except ParseError as err:
+            yield custom_id, None, str(err)
+        except (KeyError, IndexError, TypeError):
+            yield custom_id, None, "response has no message content"
+
+
+class DeadLetterQueue(ResultsStore):
+    """
+    JSONL file of records that could not be processed, with the reason, so they can be retried in bulk.
+    path: e.g. data/pubmed_abstracts_new.failed.jsonl
+    """
+
+    def add(self, pmid, reason, stage="parse", content=None):
+        record = {"pmid": pmid, "stage": stage, "reason": reason, "time": time.time()}
+        if content is not None:
+            record["content"] = content[:2000]
+        self.append(record)
+
+    def reasons(self):
+        self.sync()
+        latest = {x["pmid"]: x for x in iter_records(self.path)}
+        return Counter(x["reason"].split(":")[0] for x in latest.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect dead-lettered records for a bulk retry")
+    parser.add_argument("dead_letter", help="e.g. data/pubmed_abstracts_new.failed.jsonl")
+    parser.add_argument("input", help="Original input, e.g. data/pubmed_new.json")
+    parser.add_argument("output", help="JSON list of input records to retry")
+    parser.add_argument("--done", nargs="*", default=[], help="Results files whose PMIDs have since succeeded")
+    args = parser.parse_args()
+
+    done = {x["pmid"] for path in args.done for x in iter_records(path)}
+    with DeadLetterQueue(args.dead_letter) as dlq:
+        for reason, count in dlq.reasons().most_common():
+            print("{}: {}".format(reason, count))
+        retry = [x for x in iter_records(args.input) if x["pmid"] in dlq and x["pmid"] not in done]
+    with open(args.output, "w") as f:
+        json.dump(retry, f)
+    print("Wrote {} records to {}".format(len(retry), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import random
+
+from extract_engine import extract_all, make_openai_call, pack_records
+from prompts import abstract_messages, compact_messages, compact_prefix, packed_messages
+from response_cache import ResponseCache, cached_call
+from results_store import iter_records
+from token_planner import TokenCounter
+
+
+def variants(pack_sizes=(5, 10)):
+    """
+    Returns {name: (pack size, build_messages)}; pack size 1 means one abstract per request
+    """
+    v = {
+        "current": (1, abstract_messages),
+        "compact": (1, lambda abstract: compact_messages(abstract)),
+        "compact, no few-shot": (1, lambda abstract: compact_messages(abstract, few_shot=False)),
+    }
+    for k in pack_sizes:
+        v["packed x{}".format(k)] = (k, lambda group: packed_messages(group))
+        v["packed x{}, no few-shot".format(k)] = (k, lambda group: packed_messages(group, few_shot=False))
+    return v
+
+
+def token_report(records, counter, pack_sizes=(5, 10)):
+    """
+    Prompt tokens per abstract for each variant, and how many of them are a shared prefix the provider can cache.
+    """
+    prefix = {True: counter.count_messages([compact_prefix()])[0], False: counter.count_messages([compact_prefix(few_shot=False)])[0]}
+    print("{:<26} {:>12} {:>16}".format("variant", "tokens/abs", "uncached/abs"))
+    for name, (size, build_messages) in variants(pack_sizes).items():
+        if size == 1:
+            requests = [build_messages(x["ab"]) for x in records]
+        else:
+            requests = [build_messages(g["group"]) for g in pack_records(records, size)]
+        counts = counter.count_messages(requests)
+        per_abstract = sum(counts) / len(records)
+        if name == "current":
+            # The prefix shared between requests ends before the abstract
+            cached = counter.count_messages([abstract_messages("")[:4]])[0]
+        else:
+            cached = prefix["no few-shot" not in name]
+        print("{:<26} {:>12.0f} {:>16.0f}".format(name, per_abstract, (sum(counts) - cached * len(requests)) / len(records)))
+
+
+def trait_set(o, key):
+    return {str(x.get("trait", "")).strip().lower() for x in o.get(key, []) if isinstance(x, dict)}
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def agreement(reference, candidate):
+    """
+    reference, candidate: {pmid: result}
+    Mean exposure/outcome trait overlap and method overlap over PMIDs present in both
+    """
+    common = [p for p in reference if p in candidate]
+    scores = {"n": len(common), "exposures": 0.0, "outcomes": 0.0, "methods": 0.0}
+    for p in common:
+        scores["exposures"] += jaccard(trait_set(reference[p], "exposures"), trait_set(candidate[p], "exposures"))
+        scores["outcomes"] += jaccard(trait_set(reference[p], "outcomes"), trait_set(candidate[p], "outcomes"))
+        scores["methods"] += jaccard({m.lower() for m in reference[p].get("methods", []) if isinstance(m, str)},
+                                     {m.lower() for m in candidate[p].get("methods", []) if isinstance(m, str)})
+    for k in ("exposures", "outcomes", "methods"):
+        scores[k] = scores[k] / len(common) if common else 0.0
+    return scores
+
+
+async def run_variant(records, call, size, build_messages, concurrency=8):
+    if size == 1:
+        results, stats = await extract_all(records, call, build_messages, "ab", concurrency=concurrency, report_every=0)
+    else:
+        results, stats = await extract_all(pack_records(records, size), call, build_messages, "group", concurrency=concurrency, report_every=0)
+    return {o["pmid"]: o for o in results}, stats
+
+
+async def run_variants(records, call, pack_sizes):
+    """
+    Run every variant in one event loop, since the API client cannot be reused once the loop it ran on is closed.
+    Returns {name: (results, stats)}
+    """
+    return {name: await run_variant(records, call, size, build_messages) for name, (size, build_messages) in variants(pack_sizes).items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare tokens per abstract and extraction agreement of the compact prompt modes")
+    parser.add_argument("input", help="e.g. data/pubmed_new.json")
+    parser.add_argument("--sample", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--pack", type=int, nargs="*", default=[5, 10])
+    parser.add_argument("--run", action="store_true", help="Also run every variant and compare outputs with the current prompt")
+    parser.add_argument("--base-url", default=None)
+    parser.add_argument("--cache", default="data/response_cache.sqlite")
+    args = parser.parse_args()
+
+    records = [x for x in iter_records(args.input) if "ab" in x.keys()]
+    random.seed(args.seed)
+    records = random.sample(records, min(args.sample, len(records)))
+
+    token_report(records, TokenCounter(args.model), args.pack)
+    if not args.run:
+        return
+
+    cache = ResponseCache(args.cache)
+    call = cached_call(make_openai_call(model=args.model, base_url=args.base_url), cache)
+    reference = None
+    print("{:<26} {:>6} {:>10} {:>10} {:>10} {:>8}".format("variant", "n", "exposures", "outcomes", "methods", "paid tok"))
+    for name, (results, stats) in asyncio.run(run_variants(records, call, args.pack)).items():
+        if reference is None:
+            reference = results
+        scores = agreement(reference, results)
+        print("{:<26} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>8}".format(
+            name, scores["n"], scores["exposures"], scores["outcomes"], scores["methods"], stats["prompt_tokens"] + stats["completion_tokens"]))
+    cache.print_stats()
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
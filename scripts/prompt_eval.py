@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from extract_engine import extract_all
+from prompt_compare import jaccard
+from prompts import abstract_messages, abstract_messages_v1, compact_messages
+from response_cache import CacheMiss, ResponseCache
+from results_store import iter_records
+from token_planner import estimate_cost
+from trait_normalise import key, normalise_category
+
+PROMPTS = {
+    "v1": abstract_messages_v1,
+    "current": abstract_messages,
+    "compact": compact_messages,
+    "compact-no-few-shot": lambda abstract: compact_messages(abstract, few_shot=False),
+}
+
+_ise = re.compile(r"isation\b")
+
+
+def parse_config(text):
+    """
+    "name=model:prompt", e.g. "mini=gpt-4o-mini:compact". The prompt defaults to 'current'.
+    """
+    name, _, spec = text.partition("=")
+    model, _, prompt = (spec or name).partition(":")
+    if (prompt or "current") not in PROMPTS:
+        raise ValueError("Unknown prompt '{}', choose from {}".format(prompt, ", ".join(PROMPTS)))
+    return {"name": name, "model": model, "prompt": prompt or "current"}
+
+
+def recorded_call(cache, model, offline=True, base_url=None):
+    """
+    Serve responses from the cache with the usage recorded when they were paid for, so costs can be compared offline.
+    offline: raise CacheMiss instead of calling the API for responses that were never recorded
+    """
+    live = None
+    if not offline:
+        from extract_engine import make_openai_call
+        live = make_openai_call(model=model, base_url=base_url)
+
+    async def call(messages):
+        hit = cache.get(model, messages)
+        if hit is not None:
+            return hit
+        if live is None:
+            raise CacheMiss("No recorded response")
+        content, usage = await live(messages)
+        cache.put(model, messages, content, usage)
+        return content, usage
+    call.model = model
+    return call
+
+
+def run_chunk(config, records, cache_path, offline=True, base_url=None, concurrency=8):
+    """
+    Run one configuration over some records. Called in a worker process, each with its own cache connection.
+    Returns (results, usage and failure counts)
+    """
+    cache = ResponseCache(cache_path, replay=offline)
+    call = recorded_call(cache, config["model"], offline, base_url)
+    results, stats = asyncio.run(extract_all(records, call, PROMPTS[config["prompt"]], "ab", concurrency=concurrency, report_every=0, kind="abstracts"))
+    cache.close()
+    reasons = Counter(reason.split(":")[0] for _, reason in stats["failures"])
+    return results, {"prompt_tokens": stats["prompt_tokens"], "completion_tokens": stats["completion_tokens"],
+                     "elapsed": stats["elapsed"], "failures": reasons}
+
+
+def trait_keys(o, field):
+    return {key(x["trait"]): x.get("category") for x in o.get(field, []) if isinstance(x, dict) and isinstance(x.get("trait"), str)}
+
+
+def method_set(o):
+    return {_ise.sub("ization", m.casefold().strip()) for m in o.get("methods", []) if isinstance(m, str)}
+
+
+def same_category(a, b):
+    # The first prompt asked for a new group name where the current one asks for "Other"
+    a, b = normalise_category(str(a)), normalise_category(str(b))
+    return (a or "other") == (b or "other")
+
+
+def score(gold, candidate):
+    """
+    gold, candidate: {pmid: result}
+    Agreement over the gold PMIDs: exposure/outcome trait overlap (Jaccard of normalised names), category accuracy on
+    the traits both found, method F1, and mean absolute error of the null and non-null result counts.
+    Method and result scores are None when the gold results have no methods or results, as with the first prompt.
+    """
+    s = {"n": 0, "missing": 0, "exposures": 0.0, "outcomes": 0.0}
+    categories = Counter()
+    methods = Counter()
+    null_error, null_n = 0, 0
+    for pmid, g in gold.items():
+        c = candidate.get(pmid)
+        if c is None:
+            s["missing"] += 1
+            continue
+        s["n"] += 1
+        for field in ("exposures", "outcomes"):
+            gt, ct = trait_keys(g, field), trait_keys(c, field)
+            s[field] += jaccard(set(gt), set(ct))
+            for k in set(gt) & set(ct):
+                categories[same_category(gt[k], ct[k])] += 1
+        if "methods" in g:
+            gm, cm = method_set(g), method_set(c)
+            methods["tp"] += len(gm & cm)
+            methods["fp"] += len(cm - gm)
+            methods["fn"] += len(gm - cm)
+        if isinstance(g.get("results"), dict) and isinstance(c.get("results"), dict):
+            for k in ("null", "non-null"):
+                if isinstance(g["results"].get(k), int) and isinstance(c["results"].get(k), int):
+                    null_error += abs(g["results"][k] - c["results"][k])
+                    null_n += 1
+    for field in ("exposures", "outcomes"):
+        s[field] = s[field] / s["n"] if s["n"] else None
+    s["category_accuracy"] = categories[True] / sum(categories.values()) if categories else None
+    s["method_f1"] = 2 * methods["tp"] / (2 * methods["tp"] + methods["fp"] + methods["fn"]) if sum(methods.values()) else None
+    s["null_count_error"] = null_error / null_n if null_n else None
+    return s
+
+
+def evaluate(configs, records, cache_path, workers=None, chunk_size=50, offline=True, base_url=None):
+    """
+    Run every configuration over the records in a process pool, splitting each into chunks of chunk_size.
+    Returns {name: (results {pmid: result}, usage and failure counts)}
+    """
+    chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+    out = {c["name"]: ({}, {"prompt_tokens": 0, "completion_tokens": 0, "elapsed": 0.0, "failures": Counter()}) for c in configs}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [(c["name"], pool.submit(run_chunk, c, chunk, cache_path, offline, base_url)) for c in configs for chunk in chunks]
+        for name, future in futures:
+            results, stats = future.result()
+            out[name][0].update((o["pmid"], o) for o in results)
+            for k in ("prompt_tokens", "completion_tokens", "elapsed"):
+                out[name][1][k] += stats[k]
+            out[name][1]["failures"].update(stats["failures"])
+    return out
+
+
+def fmt(value, spec=".3f"):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score prompt/model configurations and recorded outputs against a gold set of abstract results")
+    parser.add_argument("--gold", default="data/pubmed_abstracts.json", help="Reference results, e.g. the first prompt's output or a hand-checked set")
+    parser.add_argument("--input", default="data/pubmed.json", help="Abstracts to run the configurations on")
+    parser.add_argument("--configs", nargs="*", default=[], help="name=model:prompt, prompt one of {}".format(", ".join(PROMPTS)))
+    parser.add_argument("--outputs", nargs="*", default=[], help="Recorded results to score as they are, name=path, e.g. v2=data/pubmed_abstracts_new.json")
+    parser.add_argument("--sample", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache", default="data/response_cache.sqlite")
+    parser.add_argument("--live", action="store_true", help="Call the API for responses missing from the cache instead of counting them as failed")
+    parser.add_argument("--base-url", default=None)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, default the number of CPUs")
+    parser.add_argument("--report", default=None, help="Also write the scores as JSON")
+    args = parser.parse_args()
+
+    configs = [parse_config(c) for c in args.configs]
+    if configs and not args.live and not os.path.exists(args.cache):
+        parser.error("{} does not exist; recorded responses are needed to run offline, or use --live".format(args.cache))
+    outputs = {name: {x["pmid"]: x for x in iter_records(path) if "pmid" in x} for name, path in (o.split("=", 1) for o in args.outputs)}
+    gold = {x["pmid"]: x for x in iter_records(args.gold) if "pmid" in x}
+    # Every configuration and output is scored on the same PMIDs
+    pmids = set(gold)
+    for recorded in outputs.values():
+        pmids &= set(recorded)
+    if configs:
+        inputs = {x["pmid"]: x for x in iter_records(args.input) if "ab" in x.keys()}
+        pmids &= set(inputs)
+    random.seed(args.seed)
+    pmids = random.sample(sorted(pmids), min(args.sample, len(pmids)))
+    gold = {p: gold[p] for p in pmids}
+    print("Scoring {} configurations and {} recorded outputs on {} gold PMIDs".format(len(configs), len(outputs), len(gold)))
+
+    if not gold:
+        print("No PMIDs are in the gold set and every output and input")
+        return
+
+    rows = []
+    for name, recorded in outputs.items():
+        rows.append({"name": name, "model": None, "prompt": "-", **score(gold, recorded), "tokens_per_record": None, "cost_per_1k": None, "seconds": None})
+    if configs:
+        start = time.monotonic()
+        runs = evaluate(configs, [inputs[p] for p in pmids], args.cache, args.workers, offline=not args.live, base_url=args.base_url)
+        for c in configs:
+            results, stats = runs[c["name"]]
+            s = score(gold, results)
+            tokens = stats["prompt_tokens"] + stats["completion_tokens"]
+            cost = estimate_cost(stats["prompt_tokens"], stats["completion_tokens"], c["model"], batch=False)
+            rows.append({**c, **s, "tokens_per_record": tokens / len(results) if results else None, "seconds": stats["elapsed"],
+                         "cost_per_1k": cost / len(results) * 1000 if results else None, "failures": dict(stats["failures"])})
+        print("Ran {} configurations in {:.1f}s".format(len(configs), time.monotonic() - start))
+
+    print("{:<14} {:<16} {:>5} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9}".format(
+        "config", "prompt", "n", "missing", "exposures", "outcomes", "category", "methods", "null err", "tok/rec", "$/1k rec"))
+    for r in rows:
+        print("{:<14} {:<16} {:>5} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9}".format(
+            r["name"], r["prompt"], r["n"], r["missing"], fmt(r["exposures"]), fmt(r["outcomes"]), fmt(r["category_accuracy"]),
+            fmt(r["method_f1"]), fmt(r["null_count_error"], ".2f"), fmt(r["tokens_per_record"], ".0f"), fmt(r["cost_per_1k"], ".2f")))
+        if r.get("failures"):
+            print("  failed: " + ", ".join("{}: {}".format(k, v) for k, v in r["failures"].items()))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"gold": args.gold, "sample": len(gold), "rows": rows}, f, indent=1)
+        print("Wrote scores to {}".format(args.report))
+
+
+if __name__ == "__main__":
+    main()
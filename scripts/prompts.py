@@ -0,0 +1,198 @@
+# Prompt definitions shared by the extraction modules.
+# These are the same messages used in openai-extract2.py and the
+# openai-extract-*.ipynb notebooks, kept in one place so the async engine,
+# the cache and the batch tooling all build identical requests.
+
+# Bump this whenever any of the messages below change
+PROMPT_VERSION = "2"
+
+system_message = {"role": "system", "content": "You are a helpful assistant."}
+
+abstract3 = {"role": "user", "content": """Background: The association between air pollution, lung function, gastroesophageal reflux disease, and Non-alcoholic fatty liver disease (NAFLD) remains inconclusive. Previous studies were not convincing due to confounding factors and reverse causality. We aim to investigate the causal relationship between air pollution, lung function, gastroesophageal reflux disease, and NAFLD using Mendelian randomization analysis.
+
+Methods: In this study, univariate Mendelian randomization analysis was conducted first. Subsequently, Steiger testing was performed to exclude the possibility of reverse association. Finally, significant risk factors identified from the univariate Mendelian analysis, as well as important factors affecting NAFLD from previous observational studies (type 2 diabetes and body mass index), were included in the multivariable Mendelian randomization analysis.
+
+Results: The results of the univariable Mendelian randomization analysis showed a positive correlation between particulate matter 2.5, gastroesophageal reflux disease, and NAFLD. There was a negative correlation between forced expiratory volume in 1 s, forced vital capacity, and NAFLD. The multivariable Mendelian randomization analysis indicated a direct causal relationship between gastroesophageal reflux disease (OR = 1.537, p = 0.011), type 2 diabetes (OR = 1.261, p < 0.001), and NAFLD.
+
+Conclusion: This Mendelian randomization study confirmed the causal relationships between air pollution, lung function, gastroesophageal reflux, and NAFLD. Furthermore, gastroesophageal reflux and type 2 diabetes were identified as independent risk factors for NAFLD, having a direct causal connection with the occurrence of NAFLD."""}
+
+prompt = {"role": "user", "content": """What are the exposures and outcomes in this abstract? If there are multiple exposures or outcomes, provide them all. If there are no exposures or outcomes, provide an empty list. Also categorize the exposures and outcomes into the following groups using the exact category names provided: 
+- molecular
+- socioeconomic
+- environmental
+- behavioural
+- anthropometric
+- clinical measures
+- infectious disease
+- neoplasm
+- disease of the blood and blood-forming organs
+- metabolic disease
+- mental disorder
+- disease of the nervous system
+- disease of the eye and adnexa
+- disease of the ear and mastoid process
+- disease of the circulatory system
+- disease of the digestive system
+- disease of the skin and subcutaneous tissue
+- disease of the musculoskeletal system and connective tissue
+- disease of the genitourinary system
+If an exposure or outcome does not fit into any of these groups, specify "Other". 
+List the analytical methods used in the abstract. Match the methods to the following list of exact method names. If a method is used that is not in the list, specify "Other" and also provide the name of the method. The list of methods is as follows:
+- two-sample mendelian randomization
+- multivariable mendelian randomization
+- colocalization
+- network mendelian randomization
+- triangulation
+- reverse mendelian randomization
+- one-sample mendelian randomization
+- negative controls
+- sensitivity analysis
+- non-linear mendelian randomization
+- within-family mendelian randomization
+Summarise how many null vs non-null results were found in the abstract.
+Provide your answer in strict json format using exactly the format as the example output and without markdown code blocks."""}
+
+
+example_output = {"role": "assistant", "content": """
+{
+  "exposures": [
+    {
+        "id": "1",
+        "trait": "Particulate matter 2.5",
+        "category": "Environmental"
+    },
+    {
+        "id": "2",
+        "trait": "Type 2 diabetes",
+        "category": "metabolic disease"
+    },
+    {
+        "id": "3",
+        "trait": "Body mass index",
+        "category": "Anthropometric"
+    }
+  ],
+  "outcomes": [
+    {
+        "id": "1",
+        "trait": "Forced expiratory volume in 1 s",
+        "category": "Clinical measure"
+    },
+    {
+        "id": "2",
+        "trait": "Forced vital capacity",
+        "category": "Clinical measure"
+    },
+    {
+        "id": "3",
+        "trait": "Gastroesophageal reflux disease",
+        "category": "disease of the digestive system"
+    },
+    {
+        "id": "4",
+        "trait": "Non-alcoholic fatty liver disease (NAFLD)",
+        "category": "disease of the digestive system"
+    }
+  ],
+  "methods": ["two-sample mendelian randomization", "multivariable mendelian randomization", "colocalisation", "network mendelian randomization"],
+  "results": {
+    "null": 0,
+    "non-null": 6
+  }
+}
+"""}
+
+abstract4 = {"role": "user", "content": """Background: Epidemiological evidence links a close correlation between long-term exposure to air pollutants and autoimmune diseases, while the causality remained unknown.
+
+Methods: Two-sample Mendelian randomization (TSMR) was used to investigate the role of PM10, PM2.5, NO2, and NOX (N = 423,796-456,380) in 15 autoimmune diseases (N = 14,890-314,995) using data from large European GWASs including UKB, FINNGEN, IMSGC, and IPSCSG. Multivariable Mendelian randomization (MVMR) was conducted to investigate the direct effect of each air pollutant and the mediating role of common factors, including body mass index (BMI), alcohol consumption, smoking status, and household income. Transcriptome-wide association studies (TWAS), two-step MR, and colocalization analyses were performed to explore underlying mechanisms between air pollution and autoimmune diseases.
+
+Results: In TSMR, after correction of multiple testing, hypothyroidism was causally associated with higher exposure to NO2 [odds ratio (OR): 1.37, p = 9.08 × 10-4] and NOX [OR: 1.34, p = 2.86 × 10-3], ulcerative colitis (UC) was causally associated with higher exposure to NOX [OR: 2.24, p = 1.23 × 10-2] and PM2.5 [OR: 2.60, p = 5.96 × 10-3], rheumatoid arthritis was causally associated with higher exposure to NOX [OR: 1.72, p = 1.50 × 10-2], systemic lupus erythematosus was causally associated with higher exposure to NOX [OR: 4.92, p = 6.89 × 10-3], celiac disease was causally associated with lower exposure to NOX [OR: 0.14, p = 6.74 × 10-4] and PM2.5 [OR: 0.17, p = 3.18 × 10-3]. The risky effects of PM2.5 on UC remained significant in MVMR analyses after adjusting for other air pollutants. MVMR revealed several common mediators between air pollutants and autoimmune diseases. Transcriptional analysis identified specific gene transcripts and pathways interconnecting air pollutants and autoimmune diseases. Two-step MR revealed that POR, HSPA1B, and BRD2 might mediate from air pollutants to autoimmune diseases. POR pQTL (rs59882870, PPH4=1.00) strongly colocalized with autoimmune diseases.
+
+Conclusion: This research underscores the necessity of rigorous air pollutant surveillance within public health studies to curb the prevalence of autoimmune diseases."""}
+
+
+auth_prompt = {"role": "user", "content": """Extract the university name and country from this text. Provide the result in json format with one field for the 'institution' and one field for the 'country'. If the country is not mentioned, provide an empty string. If the institution is not mentioned, provide an empty string. If the institution is mentioned but not the country, provide an empty string for the country. For the institution, retain only the university name and no department names etc."""}
+
+
+def clean_text(text):
+    return bytes(text, 'utf-8').decode('utf-8', 'ignore')
+
+
+def abstract_messages(abstract, example=abstract4):
+    """
+    abstract: abstract text
+    example: few-shot abstract sent before the example output (abstract3 in openai-extract.py, abstract4 in the notebooks)
+    """
+    return [system_message,
+            example,
+            prompt,
+            example_output,
+            {"role": "user", "content": clean_text(abstract)},
+            prompt]
+
+
+def auth_messages(author_affil):
+    """
+    author_affil: first author affiliation string
+    """
+    return [system_message,
+            {"role": "user", "content": clean_text(author_affil)},
+            auth_prompt]
+
+
+# The first prompt, from openai-extract.py, that produced data/pubmed_abstracts.json: no methods or results,
+# and new group names instead of "Other". Kept so it can be evaluated against the current one.
+prompt_v1 = {"role": "user", "content": prompt["content"].split("If an exposure")[0] + "If an exposure or outcome does not fit into any of these groups, provide a new group name. Provide your answer in strict json format using exactly the format as the example output and without markdown code blocks."}
+example_output_v1 = {"role": "assistant", "content": example_output["content"].split(',\n  "methods"')[0] + "\n}\n"}
+
+
+def abstract_messages_v1(abstract, example=abstract3):
+    return [system_message,
+            example,
+            prompt_v1,
+            example_output_v1,
+            {"role": "user", "content": clean_text(abstract)},
+            prompt_v1]
+
+
+# Compact mode: the instructions and example come first and never change, so the whole
+# preamble is a shared prefix the provider can cache, and the prompt is not sent twice.
+example_format = {"role": "user", "content": prompt["content"] + "\n\nExample output:\n" + example_output["content"]}
+
+packed_prompt = {"role": "user", "content": """The next message contains several abstracts, each starting with a line "PMID: <pmid>". Answer the question above for every abstract separately. Provide a single json object whose keys are the PMIDs and whose values use exactly the format of the example output, without markdown code blocks."""}
+
+
+def compact_prefix(example=abstract4, few_shot=True):
+    """
+    example: few-shot abstract, only used when few_shot is True
+    few_shot: include the worked example; otherwise only the example output is shown as a format
+    """
+    if few_shot:
+        return [system_message, prompt, example, example_output]
+    return [system_message, example_format]
+
+
+def compact_messages(abstract, example=abstract4, few_shot=True):
+    return compact_prefix(example, few_shot) + [{"role": "user", "content": clean_text(abstract)}]
+
+
+def packed_messages(records, field="ab", example=abstract4, few_shot=True):
+    """
+    records: input records to send in one request, each with 'pmid' and the text field
+    The response is keyed by PMID, see split_packed_output
+    """
+    abstracts = "\n\n".join("PMID: {}\n{}".format(x["pmid"], clean_text(x[field])) for x in records)
+    return compact_prefix(example, few_shot) + [packed_prompt, {"role": "user", "content": abstracts}]
+
+
+def split_packed_output(o, pmids):
+    """
+    o: parsed response to packed_messages
+    pmids: the PMIDs sent in the request
+    Returns one result per PMID found in the response, in the usual format
+    """
+    result = []
+    for pmid in pmids:
+        if isinstance(o.get(str(pmid)), dict):
+            result.append({**o[str(pmid)], "pmid": pmid})
+    return result
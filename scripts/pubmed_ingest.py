@@ -0,0 +1,236 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+from results_store import ResultsStore, iter_records
+from work_planner import PmidIndex
+
+MONTHS = {m: i for i, m in enumerate(["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+
+# Fields of an input record that matter to extraction; a record is only re-emitted when one of these changes
+CONTENT_FIELDS = ("ab", "title", "journal", "journal_issn", "author_affil", "pub_date")
+# Hash of seeded records. Older inputs lack most of CONTENT_FIELDS, so their own hash would never match a fetched record's
+SEEDED = "seeded"
+
+
+def format_date(year, month=None, day=None):
+    """
+    PubMed dates have month names or numbers and may lack a month or day, e.g. ("2025", "May") -> "2025-05-01"
+    """
+    if not year or not str(year)[:4].isdigit():
+        return None
+    month = str(month or "1").strip().lower()[:3]
+    month = MONTHS.get(month) or (int(month) if month.isdigit() else 1)
+    day = int(day) if day and str(day).isdigit() else 1
+    return "{}-{:02d}-{:02d}".format(str(year)[:4], month, day)
+
+
+def _text(elem):
+    # itertext keeps the text inside <i>, <sup> etc.
+    return "".join(elem.itertext()).strip() if elem is not None else ""
+
+
+def _date(elem):
+    if elem is None:
+        return None
+    return format_date(elem.findtext("Year"), elem.findtext("Month"), elem.findtext("Day"))
+
+
+def parse_article(article):
+    """
+    article: a PubmedArticle element
+    Returns an input record with the fields the extraction scripts expect
+    """
+    citation = article.find("MedlineCitation")
+    art = citation.find("Article")
+    x = {"pmid": citation.findtext("PMID")}
+    parts = [_text(a) for a in art.findall("Abstract/AbstractText")]
+    if any(parts):
+        x["ab"] = " ".join(p for p in parts if p)
+    x["pub_date"] = (_date(article.find("PubmedData/History/PubMedPubDate[@PubStatus='pubmed']"))
+                     or _date(art.find("ArticleDate"))
+                     or _date(art.find("Journal/JournalIssue/PubDate"))
+                     or format_date((art.findtext("Journal/JournalIssue/PubDate/MedlineDate") or "")[:4]))
+    x["title"] = _text(art.find("ArticleTitle"))
+    x["journal_issn"] = art.findtext("Journal/ISSN")
+    x["journal"] = art.findtext("Journal/Title")
+    affil = art.find("AuthorList/Author/AffiliationInfo/Affiliation")
+    if affil is not None:
+        x["author_affil"] = _text(affil)
+    x["date_revised"] = _date(citation.find("DateRevised"))
+    return x
+
+
+def iter_pubmed_xml(f):
+    """
+    Stream records from a PubMed XML export (efetch, or the baseline/update files), one article in memory at a time.
+    Yields input records, and {"pmid": ..., "deleted": True} for DeleteCitation entries in update files.
+    """
+    context = ET.iterparse(f, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event != "end":
+            continue
+        if elem.tag == "PubmedArticle":
+            yield parse_article(elem)
+            root.clear()
+        elif elem.tag == "DeleteCitation":
+            for pmid in elem.findall("PMID"):
+                yield {"pmid": pmid.text, "deleted": True}
+            root.clear()
+
+
+def _medline_record(tags):
+    """
+    tags: {tag: [(value, line position)]}
+    """
+    first = lambda tag: tags[tag][0][0] if tag in tags else None
+    x = {"pmid": first("PMID")}
+    if first("AB"):
+        x["ab"] = first("AB")
+    edat = first("EDAT") or ""
+    x["pub_date"] = format_date(edat[:4], edat[5:7], edat[8:10]) if edat else format_date(*(first("DP") or "").split(" ")[:3])
+    x["title"] = first("TI") or ""
+    x["journal_issn"] = (first("IS") or "").split(" ")[0] or None
+    x["journal"] = first("JT")
+    # Affiliations follow the author they belong to, so only an AD before the second author is the first author's
+    authors = tags.get("FAU") or tags.get("AU") or []
+    second = authors[1][1] if len(authors) > 1 else float("inf")
+    affil = [value for value, position in tags.get("AD", []) if position < second]
+    if affil:
+        x["author_affil"] = affil[0]
+    lr = first("LR") or ""
+    x["date_revised"] = format_date(lr[:4], lr[4:6], lr[6:8]) if lr else None
+    return x
+
+
+def iter_medline(f):
+    """
+    Stream records from a MEDLINE/nbib text export: "TAG - value" lines, indented continuation lines,
+    records separated by blank lines
+    """
+    tags, tag, position = {}, None, 0
+    for line in f:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            if tags:
+                yield _medline_record(tags)
+            tags, tag, position = {}, None, 0
+        elif line.startswith("      ") and tag is not None:
+            value, pos = tags[tag][-1]
+            tags[tag][-1] = (value + " " + line.strip(), pos)
+        elif len(line) > 5 and line[4:6] == "- ":
+            tag = line[:4].strip()
+            tags.setdefault(tag, []).append((line[6:].strip(), position))
+            position += 1
+    if tags:
+        yield _medline_record(tags)
+
+
+def iter_pubmed(path):
+    """
+    Records from a PubMed XML (optionally .gz) or MEDLINE file
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        start = f.read(512).lstrip()
+    with opener(path, "rb") as f:
+        if start.startswith(b"<"):
+            yield from iter_pubmed_xml(f)
+        else:
+            yield from iter_medline(line.decode("utf-8", "replace") for line in f)
+
+
+def record_hash(record):
+    return hashlib.sha1(json.dumps([record.get(k) for k in CONTENT_FIELDS]).encode("utf-8")).hexdigest()
+
+
+def in_window(record, start=None, end=None):
+    """
+    True if the record was added or revised between start and end (YYYY-MM-DD, inclusive)
+    """
+    if start is None and end is None:
+        return True
+    dates = [d for d in (record.get("pub_date"), record.get("date_revised")) if d]
+    return any((start is None or d >= start) and (end is None or d <= end) for d in dates)
+
+
+def ingest(paths, index, store, start=None, end=None):
+    """
+    Stream PubMed exports into store, keeping only records in the date window that are new or changed since the
+    last ingest. Seeded records count as unchanged the first time they are seen.
+    Returns (stats Counter, [(pmid, hash, pub_date)] to mark as ingested once the output is written)
+    """
+    stats = Counter()
+    emitted = {}
+    for path in paths:
+        for x in iter_pubmed(path):
+            stats["read"] += 1
+            if x.get("deleted"):
+                stats["deleted"] += 1
+                continue
+            if not x.get("pmid"):
+                continue
+            if not in_window(x, start, end):
+                stats["outside window"] += 1
+                continue
+            h = record_hash(x)
+            old = emitted[x["pmid"]][1] if x["pmid"] in emitted else index.ingested_hash(x["pmid"])
+            if old == SEEDED:
+                # Already fetched before the index existed; its hash is recorded so later revisions are picked up
+                stats["unchanged"] += 1
+                emitted[x["pmid"]] = (x["pmid"], h, x.get("pub_date"))
+                continue
+            if old == h:
+                stats["unchanged"] += 1
+                continue
+            stats["new" if old is None else "updated"] += 1
+            store.append(x)
+            emitted[x["pmid"]] = (x["pmid"], h, x.get("pub_date"))
+    return stats, list(emitted.values())
+
+
+def seed(paths, index):
+    """
+    Mark the records of existing inputs, e.g. data/pubmed.json, as already ingested, unless they were ingested since
+    """
+    rows = [(str(x["pmid"]), SEEDED, x.get("pub_date")) for path in paths for x in iter_records(path)
+            if "pmid" in x and index.ingested_hash(str(x["pmid"])) is None]
+    index.mark_ingested(rows)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Turn PubMed XML or MEDLINE exports into the pubmed.json input, keeping only new or updated records")
+    parser.add_argument("inputs", nargs="+", help="PubMed XML (.xml, .xml.gz) or MEDLINE (.txt, .nbib) files or globs")
+    parser.add_argument("--output", default="data/pubmed_new.json")
+    parser.add_argument("--index", default="data/pmid_index.sqlite")
+    parser.add_argument("--from", dest="start", default=None, help="Only records added or revised on or after this date, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", default=None, help="Only records added or revised on or before this date, YYYY-MM-DD")
+    parser.add_argument("--seed", nargs="*", default=[], help="Existing inputs to mark as ingested first, e.g. data/pubmed.json")
+    args = parser.parse_args()
+
+    paths = sorted({p for pattern in args.inputs for p in glob.glob(pattern)})
+    index = PmidIndex(args.index)
+    if args.seed:
+        print("Marked {} existing records as ingested".format(seed(args.seed, index)))
+
+    staging = os.path.splitext(args.output)[0] + ".jsonl"
+    with ResultsStore(staging) as store:
+        stats, rows = ingest(paths, index, store, args.start, args.end)
+        n = store.compact(args.output)
+    index.mark_ingested(rows)
+    index.close()
+    os.remove(staging)
+
+    print(", ".join("{}: {}".format(k, v) for k, v in stats.items()))
+    print("Wrote {} new or updated records from {} files to {}".format(n, len(paths), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+def request_key(model, messages):
+    """
+    Hash of the model name and the full message list, so any change to the few-shot
+    example, the prompt, the example output or the abstract gives a new key.
+    """
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of chat completion responses.
+    path: e.g. data/response_cache.sqlite
+    max_bytes: evict least recently used responses once stored content exceeds this, None for no limit
+    replay: open read-only; a miss raises CacheMiss instead of calling the API
+    """
+
+    def __init__(self, path, max_bytes=None, replay=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # A retried request looks up the same key again; it only counts as one miss
+        self.missed = set()
+        if replay:
+            self.db = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+        else:
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                content TEXT,
+                usage TEXT,
+                size INTEGER,
+                created REAL,
+                last_used REAL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.db.commit()
+            # Running total of stored content, so a put only scans for evictions once it goes over max_bytes
+            self.total = self.size()
+
+    def get(self, model, messages):
+        key = request_key(model, messages)
+        row = self.db.execute("SELECT content, usage FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            if key not in self.missed:
+                self.missed.add(key)
+                self.stats["misses"] += 1
+            if self.replay:
+                raise CacheMiss(key)
+            return None
+        self.stats["hits"] += 1
+        if not self.replay:
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0], json.loads(row[1])
+
+    def put(self, model, messages, content, usage):
+        if self.replay:
+            return
+        now = time.time()
+        key = request_key(model, messages)
+        size = len(content.encode("utf-8"))
+        old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, model, content, json.dumps(usage), size, now, now))
+        self.total += size - (old[0] if old else 0)
+        self.missed.discard(key)
+        if self.max_bytes is not None and self.total > self.max_bytes:
+            self.evict()
+        self.db.commit()
+
+    def size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def evict(self):
+        """
+        Drop least recently used responses until the total is back under max_bytes, reading only as many rows as needed
+        """
+        drop = []
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if self.total <= self.max_bytes:
+                break
+            drop.append((key,))
+            self.total -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", drop)
+        self.stats["evictions"] += len(drop)
+
+    def close(self):
+        if not self.replay:
+            self.db.commit()
+        self.db.close()
+
+    def print_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        print("Cache: {} hits, {} misses ({:.0%} hit rate), {} evicted, {} entries".format(
+            self.stats["hits"], self.stats["misses"], self.stats["hits"] / lookups if lookups else 0, self.stats["evictions"], len(self)))
+
+
+def cached_call(call, cache, model=None):
+    """
+    Wrap an async call from make_openai_call so responses are served from and saved to the cache.
+    Cached responses report zero usage since nothing was paid for them.
+    """
+    model = model or call.model
+
+    async def wrapped(messages):
+        hit = cache.get(model, messages)
+        if hit is not None:
+            return hit[0], {}
+        content, usage = await call(messages)
+        cache.put(model, messages, content, usage)
+        return content, usage
+    wrapped.model = model
+    return wrapped
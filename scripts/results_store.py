@@ -0,0 +1,150 @@
+import json
+import os
+
+
+def iter_json_list(path, chunk_size=1 << 16):
+    """
+    Stream the records of a file holding a single JSON list, e.g. data/pubmed_abstracts.json,
+    without loading the whole document.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf = ""
+        while not buf:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # Leading whitespace can be longer than a chunk
+            buf = chunk.lstrip()
+        if not buf.startswith("["):
+            raise ValueError("{} does not contain a JSON list".format(path))
+        buf = buf[1:]
+        eof = False
+        while True:
+            buf = buf.lstrip().lstrip(",").lstrip()
+            if buf.startswith("]"):
+                return
+            try:
+                record, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf += chunk
+                continue
+            yield record
+            buf = buf[end:]
+            if len(buf) < chunk_size and not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf += chunk
+
+
+def iter_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # Partial last line from an interrupted run
+                continue
+
+
+def iter_records(path):
+    """
+    Stream records from either a .jsonl store or a .json list file.
+    """
+    if path.endswith(".jsonl"):
+        return iter_jsonl(path)
+    return iter_json_list(path)
+
+
+class ResultsStore:
+    """
+    Append-only JSONL store with one record per line.
+    path: e.g. data/pubmed_abstracts_new.jsonl
+    fsync_every: number of appended records between fsyncs
+    Records already in the file are picked up on open, so a rerun skips them via done_pmids.
+    """
+
+    def __init__(self, path, fsync_every=50):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.done_pmids = set()
+        self._pending = 0
+        if os.path.exists(path):
+            self._recover()
+        self._f = open(path, "a", encoding="utf-8")
+
+    def _recover(self):
+        # Drop a torn final line so the next append starts on a clean line
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                good += len(line)
+                if "pmid" in record:
+                    self.done_pmids.add(record["pmid"])
+        if good != os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+
+    def __contains__(self, pmid):
+        return pmid in self.done_pmids
+
+    def __len__(self):
+        return len(self.done_pmids)
+
+    def append(self, record):
+        self._f.write(json.dumps(record) + "\n")
+        self.done_pmids.add(record["pmid"])
+        self._pending += 1
+        if self._pending >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._f.closed:
+            self.sync()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def todo(self, records):
+        """
+        records: input records, e.g. data/pubmed.json
+        Returns the records whose pmid has not been stored yet
+        """
+        return [x for x in records if x["pmid"] not in self.done_pmids]
+
+    def compact(self, json_path):
+        """
+        Write the store out in the existing JSON list format, keeping the last record for each pmid.
+        """
+        self.sync()
+        latest = {}
+        for record in iter_jsonl(self.path):
+            latest.pop(record["pmid"], None)
+            latest[record["pmid"]] = record
+        tmp = json_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(list(latest.values()), f)
+        os.replace(tmp, json_path)
+        return len(latest)
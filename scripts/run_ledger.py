@@ -0,0 +1,215 @@
+import argparse
+import json
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from token_planner import estimate_cost
+
+# Pipeline stages in the order they run. 'api' sums the time of concurrent requests, so it can exceed the wall time.
+STAGES = ("load", "filter", "prompt", "api", "parse", "persist", "upload", "submit", "poll", "wait")
+
+
+class RunLedger:
+    """
+    SQLite record of extraction runs: timings per stage, and status, tokens, retries and failure reason per PMID.
+    path: e.g. data/run_ledger.sqlite, shared by every run so refreshes can be compared
+    flush_every: number of PMID rows buffered between writes
+    """
+
+    def __init__(self, path="data/run_ledger.sqlite", flush_every=500):
+        self.path = path
+        self.flush_every = flush_every
+        self.run_id = None
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY,
+            script TEXT,
+            kind TEXT,
+            model TEXT,
+            batch INTEGER,
+            args TEXT,
+            started REAL,
+            finished REAL,
+            status TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS stages (
+            run_id INTEGER,
+            stage TEXT,
+            seconds REAL,
+            calls INTEGER,
+            PRIMARY KEY (run_id, stage))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS records (
+            run_id INTEGER,
+            pmid TEXT,
+            status TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            retries INTEGER,
+            seconds REAL,
+            stage TEXT,
+            reason TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS records_run ON records (run_id, status)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS records_pmid ON records (pmid)")
+        self.db.commit()
+        self._stages = defaultdict(lambda: [0.0, 0])
+        self._rows = []
+
+    def start(self, script, kind=None, model=None, batch=False, args=None):
+        """
+        Open a run. args: the parsed command line, stored as JSON
+        """
+        cur = self.db.execute("INSERT INTO runs (script, kind, model, batch, args, started, status) VALUES (?, ?, ?, ?, ?, ?, 'running')",
+                              (script, kind, model, int(batch), json.dumps(vars(args) if args is not None else {}, default=str), time.time()))
+        self.db.commit()
+        self.run_id = cur.lastrowid
+        return self.run_id
+
+    def add_time(self, stage, seconds, calls=1):
+        self._stages[stage][0] += seconds
+        self._stages[stage][1] += calls
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def record(self, pmid, status="done", prompt_tokens=0, completion_tokens=0, retries=0, seconds=None, stage=None, reason=None):
+        """
+        status: 'done', 'failed' or 'local' (resolved without the model)
+        seconds: time spent waiting on the API for this PMID, retries included
+        """
+        self._rows.append((self.run_id, str(pmid), status, prompt_tokens, completion_tokens, retries, seconds, stage, reason))
+        if len(self._rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._rows)
+        self.db.executemany("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)",
+                            [(self.run_id, stage, seconds, calls) for stage, (seconds, calls) in self._stages.items()])
+        self.db.commit()
+        self._rows = []
+
+    def finish(self, status="completed"):
+        self.flush()
+        self.db.execute("UPDATE runs SET finished = ?, status = ? WHERE run_id = ?", (time.time(), status, self.run_id))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if self.run_id is not None:
+            self.finish("completed" if exc_type is None else "failed")
+        self.close()
+
+    def run_ids(self, limit=10):
+        return [r[0] for r in self.db.execute("SELECT run_id FROM runs ORDER BY run_id DESC LIMIT ?", (limit,))][::-1]
+
+    def summary(self, run_id):
+        """
+        Returns a dict of the run's settings, wall time, seconds per stage, PMIDs per status, tokens, retries,
+        estimated cost and most common failure reasons
+        """
+        script, kind, model, batch, started, finished, status = self.db.execute(
+            "SELECT script, kind, model, batch, started, finished, status FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        stages = {stage: {"seconds": seconds, "calls": calls} for stage, seconds, calls in self.db.execute(
+            "SELECT stage, seconds, calls FROM stages WHERE run_id = ?", (run_id,))}
+        records = Counter(dict(self.db.execute("SELECT status, COUNT(*) FROM records WHERE run_id = ? GROUP BY status", (run_id,))))
+        prompt_tokens, completion_tokens, retries, api_seconds = self.db.execute(
+            "SELECT COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(retries), 0), SUM(seconds) "
+            "FROM records WHERE run_id = ?", (run_id,)).fetchone()
+        # Reasons are grouped on their prefix, e.g. "ParseError", "http 429"
+        reasons = Counter()
+        for reason, n in self.db.execute("SELECT reason, COUNT(*) FROM records WHERE run_id = ? AND status = 'failed' GROUP BY reason", (run_id,)):
+            reasons[str(reason).split(":")[0]] += n
+        return {
+            "run_id": run_id, "script": script, "kind": kind, "model": model, "batch": bool(batch), "status": status, "started": started,
+            "wall_seconds": (finished or time.time()) - started, "stages": stages, "records": dict(records),
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "retries": retries,
+            "api_seconds_per_record": api_seconds / records["done"] if api_seconds and records["done"] else None,
+            "cost_usd": estimate_cost(prompt_tokens, completion_tokens, model or "gpt-3.5-turbo", bool(batch)),
+            "failure_reasons": dict(reasons.most_common(10)),
+        }
+
+    def failures(self, run_id):
+        """
+        Returns [(pmid, stage, reason)] for the run
+        """
+        return self.db.execute("SELECT pmid, stage, reason FROM records WHERE run_id = ? AND status = 'failed'", (run_id,)).fetchall()
+
+
+def prometheus(summaries):
+    """
+    Prometheus text exposition of run summaries, e.g. for the node_exporter textfile collector
+    """
+    metrics = defaultdict(list)
+    for s in summaries:
+        labels = 'run="{}",script="{}",kind="{}",model="{}"'.format(s["run_id"], s["script"], s["kind"], s["model"])
+        metrics["extraction_run_wall_seconds"].append((labels, s["wall_seconds"]))
+        for stage, v in s["stages"].items():
+            metrics["extraction_stage_seconds"].append(('{},stage="{}"'.format(labels, stage), v["seconds"]))
+        for status, n in s["records"].items():
+            metrics["extraction_records_total"].append(('{},status="{}"'.format(labels, status), n))
+        metrics["extraction_tokens_total"].append(('{},type="prompt"'.format(labels), s["prompt_tokens"]))
+        metrics["extraction_tokens_total"].append(('{},type="completion"'.format(labels), s["completion_tokens"]))
+        metrics["extraction_retries_total"].append((labels, s["retries"]))
+        metrics["extraction_cost_usd"].append((labels, s["cost_usd"]))
+    lines = []
+    for name, values in metrics.items():
+        lines.append("# TYPE {} {}".format(name, "counter" if name.endswith("_total") else "gauge"))
+        lines += ["{}{{{}}} {}".format(name, labels, value) for labels, value in values]
+    return "\n".join(lines) + "\n"
+
+
+def print_table(summaries):
+    stages = [stage for stage in STAGES if any(stage in s["stages"] for s in summaries)]
+    print("{:>4} {:<18} {:<9} {:<14} {:>8} {:>7} {:>6} {:>7} {:>11} {:>8}".format(
+        "run", "script", "kind", "model", "wall s", "done", "failed", "retries", "tokens", "cost $") + "".join(" {:>8}".format(s) for s in stages))
+    for s in summaries:
+        print("{:>4} {:<18} {:<9} {:<14} {:>8.1f} {:>7} {:>6} {:>7} {:>11} {:>8.2f}".format(
+            s["run_id"], s["script"], str(s["kind"]), str(s["model"]), s["wall_seconds"], s["records"].get("done", 0), s["records"].get("failed", 0),
+            s["retries"], s["prompt_tokens"] + s["completion_tokens"], s["cost_usd"])
+            + "".join(" {:>8.1f}".format(s["stages"][stage]["seconds"]) if stage in s["stages"] else " {:>8}".format("-") for stage in stages))
+    for s in summaries:
+        if s["failure_reasons"]:
+            print("Run {} failures: {}".format(s["run_id"], ", ".join("{}: {}".format(k, v) for k, v in s["failure_reasons"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare extraction runs recorded in the run ledger, or export their metrics")
+    parser.add_argument("--ledger", default="data/run_ledger.sqlite")
+    parser.add_argument("--runs", type=int, nargs="*", default=None, help="Run ids, default the latest --last runs")
+    parser.add_argument("--last", type=int, default=10)
+    parser.add_argument("--format", choices=["table", "json", "prometheus"], default="table")
+    parser.add_argument("--output", default=None, help="Write the metrics to this file instead of printing them")
+    parser.add_argument("--failures", type=int, default=None, help="List the failed PMIDs of this run")
+    args = parser.parse_args()
+
+    ledger = RunLedger(args.ledger)
+    if args.failures is not None:
+        for pmid, stage, reason in ledger.failures(args.failures):
+            print("{}\t{}\t{}".format(pmid, stage, reason))
+        return
+    summaries = [ledger.summary(run_id) for run_id in (args.runs or ledger.run_ids(args.last))]
+    if args.format == "table":
+        print_table(summaries)
+        return
+    text = json.dumps(summaries, indent=1) if args.format == "json" else prometheus(summaries)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        print("Wrote metrics for {} runs to {}".format(len(summaries), args.output))
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import glob
+import heapq
+import json
+import os
+import re
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from results_store import iter_jsonl, iter_records
+from work_planner import DEFAULT_OUTPUTS, record_ok, record_prompt_version, snapshot_date
+
+PRECEDENCE = ("latest", "prompt-version")
+
+_dated = re.compile(r"20\d{6}")
+
+
+def rank(record, kind, order, line, precedence="latest"):
+    """
+    Sort key of a record among those sharing its PMID, the largest wins. A record with every required field always
+    beats one without; then the last source wins ('latest'), or the newest prompt version and then the last source
+    ('prompt-version'). Within a source the later line wins.
+    order: position of the source, oldest first
+    """
+    if precedence == "latest":
+        return [int(record_ok(record, kind)), order, line]
+    return [int(record_ok(record, kind)), record_prompt_version(record, kind), order, line]
+
+
+def iter_ranked(paths, kind, precedence="latest", stats=None):
+    """
+    Yields [pmid, rank, source, record] for every record with a pmid in the sources
+    """
+    for order, path in enumerate(paths):
+        for line, record in enumerate(iter_records(path)):
+            if stats is not None:
+                stats[path]["read"] += 1
+            if not isinstance(record, dict) or record.get("pmid") is None:
+                if stats is not None:
+                    stats[path]["no pmid"] += 1
+                continue
+            yield [str(record["pmid"]), rank(record, kind, order, line, precedence), path, record]
+
+
+def _sort_key(row):
+    return row[0], row[1]
+
+
+def sorted_runs(rows, run_size, tmpdir):
+    """
+    External sort: rows are sorted run_size at a time and spilled to JSONL files in tmpdir, unless they all fit in one run.
+    Returns iterators over the sorted runs, for heapq.merge
+    """
+    runs = []
+    buf = []
+    for row in rows:
+        buf.append(row)
+        if len(buf) >= run_size:
+            runs.append(_spill(buf, tmpdir, len(runs)))
+            buf = []
+    buf.sort(key=_sort_key)
+    if not runs:
+        return [iter(buf)]
+    if buf:
+        runs.append(_spill(buf, tmpdir, len(runs)))
+    return [iter_jsonl(path) for path in runs]
+
+
+def _spill(buf, tmpdir, i):
+    buf.sort(key=_sort_key)
+    path = os.path.join(tmpdir, "run{:04d}.jsonl".format(i))
+    with open(path, "w", encoding="utf-8") as f:
+        for row in buf:
+            f.write(json.dumps(row) + "\n")
+    return path
+
+
+def merge_sorted(runs):
+    """
+    Yields (winning record, its source, sources it replaced) for each PMID, in PMID order
+    """
+    pmid, best, replaced = None, None, []
+    for row in heapq.merge(*runs, key=_sort_key):
+        if row[0] != pmid:
+            if best is not None:
+                yield best[3], best[2], replaced
+            pmid, replaced = row[0], []
+        else:
+            replaced.append(best[2])
+        # Rows of a PMID arrive in rank order, so the last one wins
+        best = row
+    if best is not None:
+        yield best[3], best[2], replaced
+
+
+def upsert(paths, output, kind="abstracts", precedence="latest", run_size=200000, provenance=True):
+    """
+    Merge snapshots into one canonical output with one record per PMID, streaming, so the sources can be larger than memory.
+    paths: snapshots, oldest first, e.g. data/pubmed_abstracts.json data/pubmed_abstracts_new.json
+    output: .json list or .jsonl, written atomically
+    provenance: add {"source", "snapshot", "prompt_version", "replaced"} to each record; its prompt_version is always kept at the top level
+    Returns {path: Counter of read, kept, superseded, no pmid}
+    """
+    stats = defaultdict(Counter)
+    snapshots = {path: snapshot_date(path) for path in paths}
+    directory = os.path.dirname(os.path.abspath(output))
+    tmp = output + ".tmp"
+    with tempfile.TemporaryDirectory(dir=directory) as tmpdir, open(tmp, "w", encoding="utf-8") as f:
+        runs = sorted_runs(iter_ranked(paths, kind, precedence, stats), run_size, tmpdir)
+        jsonl = output.endswith(".jsonl")
+        if not jsonl:
+            f.write("[")
+        first = True
+        for record, source, replaced in merge_sorted(runs):
+            stats[source]["kept"] += 1
+            for path in replaced:
+                stats[path]["superseded"] += 1
+            record["prompt_version"] = str(record_prompt_version(record, kind))
+            if provenance:
+                record["provenance"] = {"source": source, "snapshot": snapshots[source], "prompt_version": record["prompt_version"],
+                                        "replaced": sorted(set(replaced))}
+            if jsonl:
+                f.write(json.dumps(record) + "\n")
+            else:
+                f.write(("" if first else ",\n") + json.dumps(record))
+            first = False
+        if not jsonl:
+            f.write("]\n")
+    os.replace(tmp, output)
+    return stats
+
+
+def default_sources(kind, output):
+    """
+    Every output of kind in data/, oldest first. Modification times change on checkout, so the undated files
+    (pubmed_authors.json) count as older than the dated snapshots that followed them (pubmed_authors_20250502.json).
+    """
+    paths = [p for pattern in DEFAULT_OUTPUTS[kind] for p in glob.glob(pattern)
+             if not p.endswith((".failed.jsonl", "_normalised.json", "_merged.json")) and os.path.abspath(p) != os.path.abspath(output)]
+    dated = {p: _dated.search(os.path.basename(p)) for p in paths}
+    return sorted(set(paths), key=lambda p: (dated[p].group(0) if dated[p] else "", p))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge overlapping result snapshots into one record per PMID")
+    parser.add_argument("inputs", nargs="*", help="Snapshots, oldest first; default every output of --kind in data/")
+    parser.add_argument("--kind", choices=["abstracts", "authors"], default="abstracts")
+    parser.add_argument("--output", default=None, help="Default data/pubmed_<kind>_merged.json")
+    parser.add_argument("--precedence", choices=PRECEDENCE, default="latest",
+                        help="'latest': the last source wins; 'prompt-version': the newest prompt version wins, then the last source")
+    parser.add_argument("--run-size", type=int, default=200000, help="Records sorted in memory at a time before spilling to disk")
+    parser.add_argument("--no-provenance", action="store_true")
+    args = parser.parse_args()
+
+    output = args.output or "data/pubmed_{}_merged.json".format(args.kind)
+    paths = args.inputs or default_sources(args.kind, output)
+    start = time.monotonic()
+    stats = upsert(paths, output, args.kind, args.precedence, args.run_size, not args.no_provenance)
+
+    print("{:<45} {:>9} {:>8} {:>10} {:>8}".format("source", "records", "kept", "superseded", "no pmid"))
+    for path in paths:
+        s = stats[path]
+        print("{:<45} {:>9} {:>8} {:>10} {:>8}".format(path, s["read"], s["kept"], s["superseded"], s["no pmid"]))
+    print("Wrote {} records from {} sources to {} ({:.1f}s)".format(
+        sum(s["kept"] for s in stats.values()), len(paths), output, time.monotonic() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# Local stand-in for the OpenAI chat completions, Files and Batch endpoints,
+# for testing the extraction tooling without paying for API calls.
+#
+#   python scripts/stub_server.py --port 8000 --latency 0.2 --error-rate 0.05
+#   python scripts/extract_engine.py data/pubmed_new.json /tmp/out.json --base-url http://127.0.0.1:8000/v1
+import argparse
+import contextlib
+import email.parser
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from prompts import auth_prompt, example_output, packed_prompt
+
+
+_packed_pmid = re.compile(r"^PMID: (\S+)$", re.M)
+
+
+def fake_completion(messages, model):
+    if messages[-1]["content"] == auth_prompt["content"]:
+        content = json.dumps({"institution": "University of Bristol", "country": "UK"})
+    elif len(messages) > 1 and messages[-2]["content"] == packed_prompt["content"]:
+        # One example output per abstract, keyed by the PMIDs of the packed message
+        content = json.dumps({pmid: json.loads(example_output["content"]) for pmid in _packed_pmid.findall(messages[-1]["content"])})
+    else:
+        content = example_output["content"]
+    prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": "chatcmpl-stub{}".format(random.randint(0, 10**9)),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+class FakeBatchAPI:
+    """
+    In-memory Files and Batch API. Batches complete batch_delay seconds after creation,
+    with request_error_rate of their requests written to the error file instead of the output file.
+    batch_failure_rate: fraction of batches that fail outright, as when the enqueued token limit is hit
+    """
+
+    def __init__(self, batch_delay=1.0, request_error_rate=0.0, batch_failure_rate=0.0):
+        self.batch_delay = batch_delay
+        self.request_error_rate = request_error_rate
+        self.batch_failure_rate = batch_failure_rate
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count()
+        self._lock = threading.RLock()
+
+    def _id(self, prefix):
+        return "{}-stub{}".format(prefix, next(self._ids))
+
+    def upload(self, filename, data, purpose="batch"):
+        with self._lock:
+            file_id = self._id("file")
+            self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                                   "filename": filename, "purpose": purpose, "status": "processed", "data": data}
+        return self.file_object(file_id)
+
+    def file_object(self, file_id):
+        return {k: v for k, v in self.files[file_id].items() if k != "data"}
+
+    def content(self, file_id):
+        return self.files[file_id]["data"]
+
+    def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        with self._lock:
+            batch_id = self._id("batch")
+            self.batches[batch_id] = {"id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+                                      "completion_window": completion_window, "status": "validating", "created_at": int(time.time()),
+                                      "output_file_id": None, "error_file_id": None, "errors": None, "metadata": metadata or {},
+                                      "request_counts": {"total": 0, "completed": 0, "failed": 0}, "_created": time.monotonic()}
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id):
+        with self._lock:
+            batch = self.batches[batch_id]
+            if batch["status"] in ("validating", "in_progress"):
+                if time.monotonic() - batch["_created"] >= self.batch_delay:
+                    self._finish(batch)
+                else:
+                    batch["status"] = "in_progress"
+        return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    def _finish(self, batch):
+        if random.random() < self.batch_failure_rate:
+            batch["status"] = "failed"
+            batch["errors"] = {"object": "list", "data": [{"code": "token_limit_exceeded", "message": "Enqueued token limit reached"}]}
+            return
+        output, errors = [], []
+        for line in self.files[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if random.random() < self.request_error_rate:
+                errors.append({"id": self._id("batch_req"), "custom_id": request["custom_id"],
+                               "response": {"status_code": 500, "request_id": "", "body": {"error": {"message": "Internal server error", "type": "server_error"}}},
+                               "error": None})
+            else:
+                body = fake_completion(request["body"]["messages"], request["body"].get("model", "gpt-3.5-turbo"))
+                output.append({"id": self._id("batch_req"), "custom_id": request["custom_id"],
+                               "response": {"status_code": 200, "request_id": "", "body": body}, "error": None})
+        batch["status"] = "completed"
+        batch["request_counts"] = {"total": len(output) + len(errors), "completed": len(output), "failed": len(errors)}
+        batch["output_file_id"] = self.upload("output.jsonl", "".join(json.dumps(x) + "\n" for x in output).encode("utf-8"), "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self.upload("errors.jsonl", "".join(json.dumps(x) + "\n" for x in errors).encode("utf-8"), "batch_output")["id"]
+
+
+class _StreamedContent:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_lines(self):
+        return iter(self.data.decode("utf-8").splitlines())
+
+    @property
+    def text(self):
+        return self.data.decode("utf-8")
+
+
+class FakeBatchClient:
+    """
+    Object with the parts of the OpenAI client used by batch_orchestrator.py, backed by a FakeBatchAPI,
+    so the orchestrator can be exercised in-process without the openai package or a server.
+    """
+
+    def __init__(self, api=None):
+        api = api or FakeBatchAPI()
+        self.api = api
+
+        def files_create(file, purpose):
+            data = file.read()
+            return SimpleNamespace(**api.upload(getattr(file, "name", "upload.jsonl"), data, purpose))
+
+        @contextlib.contextmanager
+        def streaming_content(file_id):
+            yield _StreamedContent(api.content(file_id))
+
+        def batches_create(input_file_id, endpoint, completion_window, metadata=None):
+            return SimpleNamespace(**api.create_batch(input_file_id, endpoint, completion_window, metadata))
+
+        self.files = SimpleNamespace(create=files_create, content=lambda file_id: _StreamedContent(api.content(file_id)),
+                                     with_streaming_response=SimpleNamespace(content=streaming_content))
+        self.batches = SimpleNamespace(create=batches_create, retrieve=lambda batch_id: SimpleNamespace(**api.retrieve(batch_id)))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Set on the server by make_stub_server
+    latency = 0.0
+    error_rate = 0.0
+    respond = staticmethod(fake_completion)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def not_found(self):
+        self.send_json(404, {"error": {"message": "Unknown path {}".format(self.path)}})
+
+    def read_multipart(self):
+        length = int(self.headers.get("Content-Length", 0))
+        head = "Content-Type: {}\r\n\r\n".format(self.headers["Content-Type"]).encode("utf-8")
+        message = email.parser.BytesParser().parse(io.BytesIO(head + self.rfile.read(length)))
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        return fields
+
+    def do_GET(self):
+        api = self.server.batch_api
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in api.batches:
+            return self.send_json(200, api.retrieve(parts[-1]))
+        if len(parts) >= 3 and parts[-1] == "content" and parts[-2] in api.files:
+            data = api.content(parts[-2])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if len(parts) >= 2 and parts[-2] == "files" and parts[-1] in api.files:
+            return self.send_json(200, api.file_object(parts[-1]))
+        self.not_found()
+
+    def do_POST(self):
+        api = self.server.batch_api
+        if self.path.endswith("/files"):
+            fields = self.read_multipart()
+            filename, data = fields["file"]
+            return self.send_json(200, api.upload(filename, data, fields.get("purpose", (None, b"batch"))[1].decode("utf-8")))
+        if self.path.endswith("/batches"):
+            body = self.read_json()
+            return self.send_json(200, api.create_batch(body["input_file_id"], body["endpoint"], body["completion_window"], body.get("metadata")))
+        if not self.path.endswith("/chat/completions"):
+            return self.not_found()
+        body = self.read_json()
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}}, {"retry-after": "0.1"})
+            return self.send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+        self.send_json(200, self.respond(body["messages"], body.get("model", "gpt-3.5-turbo")))
+
+
+def make_stub_server(port=0, latency=0.0, error_rate=0.0, handler=StubHandler, batch_api=None):
+    """
+    Start the stub server in a background thread.
+    port: 0 picks a free port, read it back from server.server_address
+    latency: seconds to sleep before each response
+    error_rate: fraction of requests answered with a 429 or 500
+    batch_api: FakeBatchAPI behind the /files and /batches endpoints
+    """
+    handler = type("ConfiguredStubHandler", (handler,), {"latency": latency, "error_rate": error_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.batch_api = batch_api or FakeBatchAPI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub OpenAI chat completions server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="Seconds before a batch completes")
+    parser.add_argument("--batch-error-rate", type=float, default=0.0, help="Fraction of batch requests that fail")
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0, help="Fraction of whole batches that fail")
+    args = parser.parse_args()
+    api = FakeBatchAPI(args.batch_delay, args.batch_error_rate, args.batch_failure_rate)
+    server = make_stub_server(args.port, args.latency, args.error_rate, batch_api=api)
+    print("Stub server listening on http://127.0.0.1:{}/v1".format(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
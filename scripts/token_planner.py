@@ -0,0 +1,139 @@
+import argparse
+import functools
+
+from prompts import abstract_messages, auth_messages
+from results_store import iter_records
+
+# USD per million tokens (input, output), Batch API requests are billed at half
+PRICES = {
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-3.5-turbo-0125": (0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+BATCH_DISCOUNT = 0.5
+
+# From the OpenAI cookbook: every message is wrapped in a few extra tokens, and the reply is primed with 3
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCounter:
+    """
+    Counts chat request tokens for a whole corpus at once.
+    The few-shot example, prompt and example output are the same in every request, so each distinct
+    message is only encoded once and the abstracts are encoded together with encode_batch.
+    encoding: defaults to tiktoken's encoding for the model
+    """
+
+    def __init__(self, model="gpt-3.5-turbo", encoding=None, num_threads=8):
+        self.model = model
+        self.encoding = encoding or get_encoding(model)
+        self.num_threads = num_threads
+        self._cache = {}
+
+    def encode_lengths(self, texts):
+        todo = list({t for t in texts if t not in self._cache})
+        if todo:
+            for text, tokens in zip(todo, self.encoding.encode_batch(todo, num_threads=self.num_threads)):
+                self._cache[text] = len(tokens)
+        return [self._cache[t] for t in texts]
+
+    def count_messages(self, message_lists):
+        """
+        message_lists: list of chat message lists
+        Returns the number of prompt tokens for each
+        """
+        contents = [m["content"] for messages in message_lists for m in messages]
+        roles = list({m["role"] for messages in message_lists for m in messages})
+        lengths = iter(self.encode_lengths(contents))
+        role_lengths = dict(zip(roles, self.encode_lengths(roles)))
+        counts = []
+        for messages in message_lists:
+            n = TOKENS_PER_REPLY
+            for m in messages:
+                n += TOKENS_PER_MESSAGE + role_lengths[m["role"]] + next(lengths)
+            counts.append(n)
+        return counts
+
+
+def pack_shards(token_counts, max_batch_tokens, max_requests=50000):
+    """
+    Greedily group consecutive requests so each shard stays within the enqueued token limit.
+    Returns list of (start, end) index ranges
+    """
+    shards = []
+    start, total = 0, 0
+    for i, n in enumerate(token_counts):
+        if i > start and (total + n > max_batch_tokens or i - start >= max_requests):
+            shards.append((start, i))
+            start, total = i, 0
+        total += n
+    if start < len(token_counts):
+        shards.append((start, len(token_counts)))
+    return shards
+
+
+def estimate_cost(input_tokens, output_tokens, model="gpt-3.5-turbo", batch=True):
+    price_in, price_out = PRICES.get(model, PRICES["gpt-3.5-turbo"])
+    cost = (input_tokens * price_in + output_tokens * price_out) / 1e6
+    return cost * BATCH_DISCOUNT if batch else cost
+
+
+def plan_shards(token_counts, max_batch_tokens, model="gpt-3.5-turbo", output_tokens=300, tpm=2000000, batch=True, max_requests=50000):
+    """
+    token_counts: prompt tokens per request, from TokenCounter.count_messages
+    output_tokens: expected completion tokens per request
+    tpm: tokens per minute the account processes, used for the wall time estimate
+    Returns a list of dicts describing each shard
+    """
+    plan = []
+    for start, end in pack_shards(token_counts, max_batch_tokens, max_requests):
+        n_in = sum(token_counts[start:end])
+        n_out = (end - start) * output_tokens
+        plan.append({"start": start, "end": end, "requests": end - start, "input_tokens": n_in, "output_tokens": n_out,
+                     "cost": estimate_cost(n_in, n_out, model, batch), "minutes": (n_in + n_out) / tpm})
+    return plan
+
+
+def print_plan(plan):
+    print("{:>5} {:>8} {:>12} {:>12} {:>9} {:>8}".format("shard", "requests", "input tok", "output tok", "cost $", "minutes"))
+    for i, s in enumerate(plan):
+        print("{:>5} {:>8} {:>12} {:>12} {:>9.2f} {:>8.1f}".format(i, s["requests"], s["input_tokens"], s["output_tokens"], s["cost"], s["minutes"]))
+    print("{:>5} {:>8} {:>12} {:>12} {:>9.2f} {:>8.1f}".format(
+        "total", sum(s["requests"] for s in plan), sum(s["input_tokens"] for s in plan), sum(s["output_tokens"] for s in plan),
+        sum(s["cost"] for s in plan), sum(s["minutes"] for s in plan)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token count, shard and cost a corpus before submitting it")
+    parser.add_argument("input", help="e.g. data/pubmed_new.json")
+    parser.add_argument("--kind", choices=["abstracts", "authors"], default="abstracts")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--max-batch-tokens", type=int, default=2000000, help="Enqueued token limit per batch")
+    parser.add_argument("--output-tokens", type=int, default=None, help="Expected completion tokens per request")
+    parser.add_argument("--tpm", type=int, default=2000000)
+    parser.add_argument("--sync", action="store_true", help="Price as synchronous requests rather than Batch API")
+    args = parser.parse_args()
+
+    if args.kind == "abstracts":
+        build_messages, field, output_tokens = abstract_messages, "ab", 300
+    else:
+        build_messages, field, output_tokens = auth_messages, "author_affil", 30
+    records = [x for x in iter_records(args.input) if field in x.keys()]
+    counts = TokenCounter(args.model).count_messages([build_messages(x[field]) for x in records])
+    plan = plan_shards(counts, args.max_batch_tokens, args.model, args.output_tokens or output_tokens, args.tpm, not args.sync)
+    print_plan(plan)
+
+
+if __name__ == "__main__":
+    main()
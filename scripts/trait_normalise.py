@@ -0,0 +1,342 @@
+import argparse
+import difflib
+import functools
+import json
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+from prompts import prompt
+from results_store import iter_records
+
+# The category list given to the model in the prompt
+CATEGORIES = [line[2:].strip() for line in prompt["content"].split("If an exposure")[0].splitlines() if line.startswith("- ")]
+
+# Spelling variants and shortened names seen in the outputs
+CATEGORY_SYNONYMS = {
+    "behavioral": "behavioural",
+    "behavorial": "behavioural",
+    "clinical measure": "clinical measures",
+    "clinical": "clinical measures",
+    "neoplasms": "neoplasm",
+    "cancer": "neoplasm",
+    "infectious diseases": "infectious disease",
+    "mental disorders": "mental disorder",
+    "metabolic": "metabolic disease",
+    "metabolic diseases": "metabolic disease",
+}
+
+# Answers that mean "none of the listed groups" rather than naming a new one
+OTHER_CATEGORIES = {"other", "other group", "new group", "new group name", "new category", "new category name", "none",
+                    "unknown", "n/a", "na", "not specified", "not applicable", "various", ""}
+
+_separators = re.compile(r"[\s\-_/,;:'\"’‘`]+")
+_paren = re.compile(r"^(.*?)\s*\(([^()]+)\)\s*$")
+_acronym = re.compile(r"^[A-Za-z0-9.+\-]{2,12}$")
+_stopwords = {"of", "in", "the", "and", "to", "for", "on", "with", "a"}
+
+
+def key(text):
+    """
+    Case-folded, punctuation-insensitive form of a trait or category name.
+    """
+    text = unicodedata.normalize("NFKC", str(text)).casefold()
+    text = _separators.sub(" ", text).strip()
+    if text.startswith("the "):
+        text = text[4:]
+    return text
+
+
+def is_acronym(text):
+    text = text.strip()
+    return bool(_acronym.match(text)) and sum(c.isupper() for c in text) >= max(2, sum(c.isalpha() for c in text) // 2)
+
+
+def initialism(k):
+    """
+    'particulate matter 2.5' -> 'pm2.5', used to find acronyms written out in full
+    """
+    parts = []
+    for word in k.split(" "):
+        if word in _stopwords or not word:
+            continue
+        parts.append(word if word[0].isdigit() else word[0])
+    return "".join(parts) if len(parts) > 1 else None
+
+
+@functools.lru_cache(maxsize=None)
+def normalise_category(category):
+    """
+    Map a category to one of CATEGORIES, 'other', or None if it is a new group name.
+    """
+    k = key(category)
+    if k in _other_keys:
+        return "other"
+    for candidate in (k, k.rstrip("s"), "disease of the " + k, "disease of the " + k.rstrip("s")):
+        if candidate in _category_keys:
+            return _category_keys[candidate]
+        if candidate in CATEGORY_SYNONYMS:
+            return CATEGORY_SYNONYMS[candidate]
+    match = difflib.get_close_matches(k, _category_keys, n=1, cutoff=0.9)
+    return _category_keys[match[0]] if match else None
+
+
+_category_keys = {key(c): c for c in CATEGORIES}
+_other_keys = {key(c) for c in OTHER_CATEGORIES}
+
+
+_numbers = re.compile(r"\d+(?:\.\d+)?")
+
+
+def similar_words(a, b, cutoff=0.75):
+    """
+    Guard for fuzzy matches: labels may only differ in spelling, not in numbers or whole words,
+    so "type 1 diabetes" / "type 2 diabetes" and "HDL-C" / "LDL-C" stay apart.
+    """
+    if _numbers.findall(a) != _numbers.findall(b):
+        return False
+    wa, wb = set(a.split(" ")), set(b.split(" "))
+    only_a = sorted(w for w in wa - wb if w not in _stopwords)
+    only_b = sorted(w for w in wb - wa if w not in _stopwords)
+    if len(only_a) != len(only_b) or len(only_a) > 2:
+        return False
+    return all(difflib.SequenceMatcher(None, x, y).ratio() >= cutoff for x, y in zip(only_a, only_b))
+
+
+class TraitIndex:
+    """
+    Vocabulary of canonical traits, each with an id, label, category and all the keys that resolve to it.
+    Keys are tried in order: exact text, case-folded key, parenthetical/acronym forms, written-out acronym,
+    then a batched fuzzy match over the remaining clusters (see merge_fuzzy).
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.keys = {}
+        self.acronyms = defaultdict(set)
+        self.initials = defaultdict(set)
+        self.clusters = {}
+        self._parent = {}
+
+    def find(self, cid):
+        while self._parent.get(cid, cid) != cid:
+            cid = self._parent[cid]
+        return cid
+
+    def lookup(self, trait):
+        """
+        Returns (cluster id, stage) or (None, None)
+        """
+        if trait in self.exact:
+            return self.find(self.exact[trait]), "exact"
+        k = key(trait)
+        if k in self.keys:
+            return self.find(self.keys[k]), "casefold"
+        m = _paren.match(trait)
+        if m:
+            long_form, short_form = self._split(m)
+            if key(long_form) in self.keys:
+                return self.find(self.keys[key(long_form)]), "acronym"
+            # The bracketed part alone is only trusted against a cluster that is just that term, e.g.
+            # "statins" for "HMG-CoA reductase inhibitors (statins)", not "OA" for "Hip osteoarthritis (OA)"
+            # or "including specific types" for "Focal epilepsy (including specific types)"
+            cid = self.keys.get(key(short_form))
+            if cid is not None:
+                label = self.clusters[self.find(cid)]["label"]
+                if is_acronym(label) if is_acronym(short_form) else key(label) == key(short_form):
+                    return self.find(cid), "acronym"
+        elif is_acronym(trait):
+            ids = {self.find(i) for i in self.acronyms.get(k, ())}
+            if len(ids) == 1:
+                return next(iter(ids)), "acronym"
+        else:
+            ini = initialism(k)
+            # Two or three letter initialisms are too ambiguous to match on their own
+            ids = {self.find(i) for i in self.initials.get(ini, ())} if ini and (len(ini) >= 4 or _numbers.search(ini)) else ()
+            if len(ids) == 1:
+                return next(iter(ids)), "acronym"
+        return None, None
+
+    @staticmethod
+    def _split(m):
+        long_form, short_form = m.group(1), m.group(2)
+        if is_acronym(long_form) and not is_acronym(short_form):
+            long_form, short_form = short_form, long_form
+        return long_form, short_form
+
+    def add(self, trait, cid=None):
+        """
+        Register trait under cluster cid, creating a new cluster if cid is None. Returns the cluster id.
+        """
+        if cid is None:
+            cid = "T{:05d}".format(len(self.clusters) + 1)
+            self.clusters[cid] = {"label": trait, "aliases": [], "categories": Counter(), "count": 0}
+        self.clusters[cid]["aliases"].append(trait)
+        self.exact[trait] = cid
+        self.keys.setdefault(key(trait), cid)
+        m = _paren.match(trait)
+        if m:
+            long_form, short_form = self._split(m)
+            self.keys.setdefault(key(long_form), cid)
+            if is_acronym(short_form):
+                self.acronyms[key(short_form)].add(cid)
+                # Only record written-out forms that spell the acronym, e.g. "particulate matter 2.5" for PM2.5
+                ini = initialism(key(long_form))
+                if ini == key(short_form).replace(" ", ""):
+                    self.initials[ini].add(cid)
+        elif is_acronym(trait):
+            self.acronyms[key(trait)].add(cid)
+        return cid
+
+    def merge_fuzzy(self, cutoff=0.92):
+        """
+        Merge clusters whose labels are near-identical, comparing only labels that share a first word
+        and have compatible lengths, so the whole vocabulary is matched in one batched pass.
+        Returns the number of merges.
+        """
+        blocks = defaultdict(list)
+        for cid, c in self.clusters.items():
+            if self.find(cid) == cid:
+                k = key(c["label"])
+                blocks[k.split(" ")[0]].append((len(k), k, cid))
+        merged = 0
+        for block in blocks.values():
+            block.sort()
+            for i, (n, k, cid) in enumerate(block):
+                matcher = difflib.SequenceMatcher(None, "", k)
+                for m, k2, cid2 in block[i + 1:]:
+                    # Lengths only grow from here, stop once a match is impossible
+                    if 2 * n / (n + m) < cutoff:
+                        break
+                    matcher.set_seq1(k2)
+                    if (matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff and matcher.ratio() >= cutoff
+                            and similar_words(k, k2)):
+                        a, b = self.find(cid), self.find(cid2)
+                        if a != b:
+                            # Keep the more frequent label as canonical
+                            if self.clusters[a]["count"] < self.clusters[b]["count"]:
+                                a, b = b, a
+                            self._parent[b] = a
+                            merged += 1
+        for cid in list(self.clusters):
+            root = self.find(cid)
+            if root != cid:
+                c = self.clusters.pop(cid)
+                self.clusters[root]["aliases"] += c["aliases"]
+                self.clusters[root]["categories"] += c["categories"]
+                self.clusters[root]["count"] += c["count"]
+        for table in (self.exact, self.keys):
+            for k, cid in table.items():
+                table[k] = self.find(cid)
+        for table in (self.acronyms, self.initials):
+            for k, ids in table.items():
+                table[k] = {self.find(i) for i in ids}
+        self._parent = {}
+        return merged
+
+    def category(self, cid):
+        categories = self.clusters[cid]["categories"]
+        return categories.most_common(1)[0][0] if categories else None
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"clusters": {cid: {**c, "categories": dict(c["categories"])} for cid, c in self.clusters.items()},
+                       "keys": self.keys, "acronyms": {k: sorted(v) for k, v in self.acronyms.items()},
+                       "initials": {k: sorted(v) for k, v in self.initials.items()}}, f)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path) as f:
+            d = json.load(f)
+        for cid, c in d["clusters"].items():
+            index.clusters[cid] = {**c, "categories": Counter(c["categories"])}
+            for alias in c["aliases"]:
+                index.exact[alias] = cid
+        index.keys = d["keys"]
+        index.acronyms = defaultdict(set, {k: set(v) for k, v in d["acronyms"].items()})
+        index.initials = defaultdict(set, {k: set(v) for k, v in d["initials"].items()})
+        return index
+
+
+def iter_mentions(records):
+    for record in records:
+        for role in ("exposures", "outcomes"):
+            for x in record.get(role) or []:
+                if isinstance(x, dict) and isinstance(x.get("trait"), str) and x["trait"]:
+                    yield record, role, x
+
+
+def build_index(records, fuzzy_cutoff=0.92):
+    """
+    records: extraction results, e.g. data/pubmed_abstracts.json
+    Returns (TraitIndex, stats). Traits are added most frequent first so the commonest spelling becomes the label.
+    """
+    counts = Counter()
+    categories = defaultdict(Counter)
+    for _, _, x in iter_mentions(records):
+        counts[x["trait"]] += 1
+        categories[x["trait"]][str(x.get("category", ""))] += 1
+
+    index = TraitIndex()
+    stages = Counter()
+    for trait, n in counts.most_common():
+        cid, stage = index.lookup(trait)
+        stages[stage or "new"] += 1
+        cid = index.add(trait, cid)
+        index.clusters[cid]["count"] += n
+        for category, m in categories[trait].items():
+            c = normalise_category(str(category))
+            if c is not None and c != "other":
+                index.clusters[cid]["categories"][c] += m
+    stages["fuzzy merged"] = index.merge_fuzzy(fuzzy_cutoff) if fuzzy_cutoff else 0
+    return index, stages
+
+
+def normalise_records(records, index):
+    """
+    Annotate each exposure/outcome with trait_id, trait_norm and category_norm.
+    category_norm is None for categories that are not in the prompt's list; those are counted in the returned Counter.
+    Returns (records, unmatched categories)
+    """
+    unmatched = Counter()
+    for _, _, x in iter_mentions(records):
+        cid, _ = index.lookup(x["trait"])
+        x["trait_id"] = cid
+        x["trait_norm"] = index.clusters[cid]["label"] if cid else None
+        category = normalise_category(str(x.get("category", "")))
+        if category is None:
+            unmatched[key(x.get("category", ""))] += 1
+            category = index.category(cid) if cid else None
+        x["category_norm"] = category
+    return records, unmatched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Normalise extracted traits and categories")
+    parser.add_argument("inputs", nargs="+", help="e.g. data/pubmed_abstracts.json data/pubmed_abstracts_new.json")
+    parser.add_argument("--output", default="data/pubmed_abstracts_normalised.json")
+    parser.add_argument("--index", default="data/trait_index.json")
+    parser.add_argument("--fuzzy-cutoff", type=float, default=0.92)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    records = [r for path in args.inputs for r in iter_records(path)]
+    index, stages = build_index(records, args.fuzzy_cutoff)
+    records, unmatched = normalise_records(records, index)
+    index.save(args.index)
+    with open(args.output, "w") as f:
+        json.dump(records, f)
+
+    print("{} records, {} distinct traits -> {} canonical traits in {:.1f}s".format(
+        len(records), len(index.exact), len(index.clusters), time.monotonic() - start))
+    for stage, n in stages.items():
+        print("  {}: {}".format(stage, n))
+    print("Categories not in the prompt's list ({} mentions):".format(sum(unmatched.values())))
+    for category, n in unmatched.most_common(30):
+        print("  {}: {}".format(category, n))
+
+
+if __name__ == "__main__":
+    main()
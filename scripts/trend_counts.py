@@ -0,0 +1,287 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from collections import Counter, defaultdict
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from build_tables import BUCKETS, KIND_TABLES, TableBuilder
+from country_index import get_index
+from results_store import iter_records
+
+LEGACY_EXPORTS = ["data/pubmed_counts/PubMed_Timeline_Results_by_Year*.csv", "data/pubmed_counts/PubMed by Year*.csv"]
+DEFAULT_INPUTS = ["data/pubmed.json", "data/pubmed_new*.json"]
+
+# Names for the searches in the legacy exports, first match on the normalised query wins
+TOPICS = [
+    ("mediation analysis, not MR", re.compile(r"mediation analysis.* not ")),
+    ("mediation analysis", re.compile(r"mediation analysis")),
+    ("mendelian randomization", re.compile(r"mendelian randomi[sz]ation")),
+    ("gwas", re.compile(r"genome.?wide association")),
+    ("systematic review", re.compile(r"systematic review")),
+    ("meta-analysis", re.compile(r"meta.?analysis")),
+]
+
+# The only column each table file is counted by
+AGGREGATED = {"traits": "category_norm", "methods": "method", "authors": "country"}
+
+_tag_space = re.compile(r"\s+\[")
+_or = re.compile(r"\s+or\s+")
+_not = re.compile(r"\s+not\s+")
+
+
+def query_key(query):
+    """
+    Spelling-insensitive form of a PubMed query, so the same search exported twice gets the same key, e.g.
+    '"Mendelian randomization" [tiab] OR "Mendelian randomisation" [tiab]' ->
+    'mendelian randomisation[tiab] or mendelian randomization[tiab]'
+    """
+    q = _tag_space.sub("[", query.casefold().replace('"', "")).strip()
+    include, *exclude = _not.split(q)
+    return " or ".join(sorted(_or.split(include))) + "".join(" not " + t for t in sorted(exclude))
+
+
+def topic(query):
+    k = query_key(query)
+    return next((name for name, pattern in TOPICS if pattern.search(k)), k)
+
+
+def read_legacy(path):
+    """
+    One PubMed export. The timeline downloads have a "Search query: ..." line then Year,Count. The "PubMed by Year"
+    files have a Year column and one column per query, holding normalised rates rather than counts.
+    Returns (measure, {topic: {year: value}})
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        rows = [row for row in csv.reader(f) if row]
+    series = defaultdict(dict)
+    if rows[0][0].startswith("Search query:"):
+        name = topic(rows[0][0][len("Search query:"):])
+        for year, count in rows[2:]:
+            series[name][int(year)] = int(count)
+        return "count", series
+    names = [topic(q) for q in rows[0][1:]]
+    for row in rows[1:]:
+        for name, value in zip(names, row[1:]):
+            if value.strip():
+                series[name][int(row[0])] = float(value)
+    return "rate", series
+
+
+def legacy_baseline(paths):
+    """
+    Reconcile the legacy exports: for every search and year, the value from the newest export holding that year.
+    Exports are dated by their last year, then by their total, since PubMed counts only grow as records are indexed.
+    Returns rows of (measure, topic, year, value, source)
+    """
+    exports = defaultdict(list)
+    for path in paths:
+        measure, series = read_legacy(path)
+        for name, values in series.items():
+            exports[measure, name].append(((max(values), sum(values.values())), path, values))
+    rows = []
+    for (measure, name), found in sorted(exports.items()):
+        best = {}
+        for _, path, values in sorted(found):
+            for year, value in values.items():
+                best[year] = (value, path)
+        rows += [(measure, name, year, value, path) for year, (value, path) in sorted(best.items())]
+    return rows
+
+
+def write_baseline(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Measure", "Topic", "Year", "Value", "Source"])
+        writer.writerows(rows)
+
+
+def read_baseline(path):
+    with open(path, newline="") as f:
+        return [(m, t, int(y), int(v) if m == "count" else float(v), s) for m, t, y, v, s in list(csv.reader(f))[1:]]
+
+
+def pmid_years(paths):
+    """
+    Table of pmid and publication year from input records, e.g. data/pubmed.json, later files winning
+    """
+    years = {}
+    for path in paths:
+        for x in iter_records(path):
+            year = str(x.get("pub_date") or "")[:4]
+            if "pmid" in x and year.isdigit():
+                years[str(x["pmid"])] = int(year)
+    return pa.table({"pmid": pa.array(list(years), pa.string()), "year": pa.array(list(years.values()), pa.int32())})
+
+
+def read_part(path):
+    if path.endswith(".parquet"):
+        return pq.read_table(path)
+    return feather.read_table(path, memory_map=True)
+
+
+def _scalar(column):
+    """
+    Group-bys and joins run on plain strings rather than the tables' dictionary encoding.
+    A list column, as author countries were when a record had several affiliations, counts by its first value.
+    """
+    if pa.types.is_list(column.type):
+        column = pa.array([v[0] if v else None for v in column.to_pylist()], pa.string())
+    if pa.types.is_dictionary(column.type):
+        column = pc.cast(column, column.type.value_type)
+    return column
+
+
+def _mapped(column, mapping):
+    """
+    Apply a Python mapping to the distinct values of a string column only, then spread the result with take
+    """
+    distinct = pc.unique(column)
+    values = pa.array([mapping(v) for v in distinct.to_pylist()], pa.string())
+    return pc.take(values, pc.index_in(column, value_set=distinct))
+
+
+def count_by_year(year, value, pmid):
+    """
+    Distinct PMIDs per (year, value), as [(value, year, count)]
+    """
+    table = pa.table({"year": year, "value": value, "pmid": pmid}).filter(pc.is_valid(value))
+    grouped = table.group_by(["value", "year"]).aggregate([("pmid", "count_distinct")])
+    return list(zip(*(grouped[c].to_pylist() for c in ("value", "year", "pmid_count_distinct"))))
+
+
+def aggregate_part(name, table, years, index):
+    """
+    Per-year counts of one table file, as {dimension: [(value, year, count)]}, and the number of its PMIDs without a year
+    name: 'traits', 'methods' or 'authors'
+    index: CountryIndex for the country and SDI dimensions
+    """
+    table = table.select(["pmid", AGGREGATED[name]])
+    table = pa.table({c: _scalar(table[c]) for c in table.column_names})
+    joined = table.join(years, "pmid", join_type="left outer")
+    unknown = len(pc.unique(joined.filter(pc.is_null(joined["year"]))["pmid"]))
+    t = joined.filter(pc.is_valid(joined["year"]))
+    out = {}
+    if name == "traits":
+        out["all"] = count_by_year(t["year"], pa.array(["all"] * len(t), pa.string()), t["pmid"])
+        out["category"] = count_by_year(t["year"], pc.fill_null(t["category_norm"], "new group"), t["pmid"])
+    elif name == "methods":
+        method = pc.replace_substring_regex(pc.utf8_trim_whitespace(pc.utf8_lower(t["method"])), r"isation\b", "ization")
+        out["method"] = count_by_year(t["year"], method, t["pmid"])
+    elif name == "authors":
+        country = _mapped(t["country"], index.resolve)
+        out["country"] = count_by_year(t["year"], country, t["pmid"])
+        out["sdi"] = count_by_year(t["year"], _mapped(country, lambda c: index.countries.get(c, {}).get("sdi")), t["pmid"])
+    return out, unknown
+
+
+def signature(paths):
+    return hashlib.sha1(json.dumps([(p, os.path.getmtime(p), os.path.getsize(p)) for p in paths]).encode("utf-8")).hexdigest()[:16]
+
+
+class TrendAggregator:
+    """
+    Per-year counts by category, method, country and SDI over the canonical datasets, cached per table file.
+    A file's counts are recomputed only when the file changes, or when it had PMIDs without a year and the inputs changed.
+    Table files each hold a disjoint set of PMIDs (one bucket of one source), so their counts add up.
+    cache_path: JSON cache of the per-file counts, e.g. data/pubmed_counts/aggregates.json
+    """
+
+    def __init__(self, builder, cache_path="data/pubmed_counts/aggregates.json"):
+        self.builder = builder
+        self.cache_path = cache_path
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+
+    def parts(self, sources):
+        for source in sources:
+            entry = self.builder.manifest["sources"].get(source)
+            if entry is None:
+                continue
+            for name in KIND_TABLES[entry["kind"]]:
+                for b in range(BUCKETS):
+                    path = self.builder.part_path(name, entry["snapshot"], source, b)
+                    if os.path.exists(path) and name != "results":
+                        yield name, path
+
+    def update(self, sources, input_paths):
+        """
+        Returns ({dimension: Counter{(value, year): count}}, number of table files recomputed)
+        """
+        years, index = None, None
+        inputs = signature(input_paths)
+        totals = defaultdict(Counter)
+        recomputed = 0
+        live = set()
+        for name, path in self.parts(sources):
+            live.add(path)
+            st = os.stat(path)
+            entry = self.cache.get(path)
+            if (entry is None or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size
+                    or (entry["unknown"] and entry["inputs"] != inputs)):
+                if years is None:
+                    years, index = pmid_years(input_paths), get_index()
+                counts, unknown = aggregate_part(name, read_part(path), years, index)
+                entry = self.cache[path] = {"mtime": st.st_mtime, "size": st.st_size, "inputs": inputs, "unknown": unknown, "counts": counts}
+                recomputed += 1
+            for dimension, rows in entry["counts"].items():
+                for value, year, count in rows:
+                    totals[dimension][value, year] += count
+        self.cache = {p: e for p, e in self.cache.items() if p in live}
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_path)
+        return totals, recomputed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-year counts by category, method, country and SDI from the canonical datasets")
+    parser.add_argument("--abstracts", default="data/pubmed_abstracts_merged.json", help="From snapshot_merge.py")
+    parser.add_argument("--authors", default="data/pubmed_authors_merged.json", help="From snapshot_merge.py --kind authors")
+    parser.add_argument("--inputs", nargs="*", default=None, help="Input records with pub_date, default data/pubmed.json and data/pubmed_new*.json")
+    parser.add_argument("--tables", default="data/tables")
+    parser.add_argument("--format", choices=["parquet", "feather"], default="parquet")
+    parser.add_argument("--cache", default="data/pubmed_counts/aggregates.json")
+    parser.add_argument("--baseline", default="data/pubmed_counts/baseline.csv", help="Legacy PubMed exports, reconciled once")
+    parser.add_argument("--rebuild-baseline", action="store_true", help="Re-read the legacy exports in data/pubmed_counts/")
+    parser.add_argument("--output", default="data/pubmed_counts/trends.csv")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    if args.rebuild_baseline or not os.path.exists(args.baseline):
+        legacy = sorted({p for pattern in LEGACY_EXPORTS for p in glob.glob(pattern)})
+        baseline = legacy_baseline(legacy)
+        write_baseline(baseline, args.baseline)
+        print("Reconciled {} legacy exports into {} ({} topics)".format(len(legacy), args.baseline, len({(r[0], r[1]) for r in baseline})))
+    else:
+        baseline = read_baseline(args.baseline)
+
+    input_paths = args.inputs if args.inputs is not None else sorted({p for pattern in DEFAULT_INPUTS for p in glob.glob(pattern)})
+    sources = [p for p in (args.abstracts, args.authors) if os.path.exists(p)]
+    builder = TableBuilder(args.tables, args.format)
+    for path in sources:
+        builder.update(path)
+    totals, recomputed = TrendAggregator(builder, args.cache).update(sources, input_paths)
+
+    rows = [(year, dimension, value, count) for dimension, counts in totals.items() for (value, year), count in counts.items()]
+    rows += [(year, "pubmed_" + measure, name, value) for measure, name, year, value, _ in baseline]
+    with open(args.output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Year", "Dimension", "Value", "Count"])
+        writer.writerows(sorted(rows, key=lambda r: (r[1], str(r[2]), r[0])))
+    print("Wrote {} rows to {}, {} table files recomputed ({:.1f}s)".format(len(rows), args.output, recomputed, time.monotonic() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+from datetime import date
+
+from prompts import PROMPT_VERSION
+from results_store import iter_records
+
+# Keys a record needs before it is counted as done
+REQUIRED_FIELDS = {
+    "abstracts": ("exposures", "outcomes"),
+    "authors": ("institution", "country"),
+}
+
+DEFAULT_OUTPUTS = {
+    "abstracts": ["data/pubmed_abstracts*.json", "data/pubmed_abstracts*.jsonl"],
+    "authors": ["data/pubmed_authors*.json", "data/pubmed_authors*.jsonl", "data/author_processing_*.json"],
+}
+
+
+def record_prompt_version(record, kind):
+    """
+    Prompt version a record was extracted with, as an integer so that version 10 sorts after version 2
+    """
+    if "prompt_version" in record:
+        return int(record["prompt_version"])
+    # Outputs from before records were stamped came from version 2 at the latest, and only its abstract prompt asked for methods
+    if kind == "abstracts" and "methods" not in record:
+        return 1
+    return 2
+
+
+def record_ok(record, kind):
+    return all(k in record for k in REQUIRED_FIELDS[kind])
+
+
+def snapshot_date(path):
+    """
+    Date in the file name, e.g. data/pubmed_authors_20250502.json -> 20250502, otherwise the file's modification date
+    """
+    m = re.search(r"(20\d{6})", os.path.basename(path))
+    if m:
+        return m.group(1)
+    return date.fromtimestamp(os.path.getmtime(path)).strftime("%Y%m%d")
+
+
+class PmidIndex:
+    """
+    Persistent index of which PMIDs each output file holds, refreshed only for files that changed.
+    path: e.g. data/pmid_index.sqlite
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT, mtime REAL, size INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outputs (pmid TEXT, kind TEXT, path TEXT, prompt_version TEXT, ok INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outputs_path ON outputs (path)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS inputs (pmid TEXT, kind TEXT, PRIMARY KEY (pmid, kind))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ingested (pmid TEXT PRIMARY KEY, hash TEXT, pub_date TEXT)")
+        self.db.commit()
+
+    def refresh(self, paths, kind):
+        """
+        paths: output files to index, e.g. data/pubmed_authors.json and the dated snapshots
+        kind: 'abstracts' or 'authors'
+        """
+        updated = 0
+        for path in paths:
+            st = os.stat(path)
+            row = self.db.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+            if row == (st.st_mtime, st.st_size):
+                continue
+            self.db.execute("DELETE FROM outputs WHERE path = ?", (path,))
+            self.db.executemany("INSERT INTO outputs VALUES (?, ?, ?, ?, ?)", (
+                (str(r["pmid"]), kind, path, record_prompt_version(r, kind), int(record_ok(r, kind)))
+                for r in iter_records(path) if "pmid" in r))
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, kind, st.st_mtime, st.st_size))
+            updated += 1
+        self.db.commit()
+        return updated
+
+    def best_outputs(self, kind):
+        """
+        Returns {pmid: (prompt_version, ok)} keeping the best output for each pmid across all files
+        """
+        best = {}
+        for pmid, version, ok in self.db.execute("SELECT pmid, prompt_version, ok FROM outputs WHERE kind = ?", (kind,)):
+            version = int(version)
+            if pmid not in best or (ok, version) > best[pmid]:
+                best[pmid] = (ok, version)
+        return {pmid: (version, ok) for pmid, (ok, version) in best.items()}
+
+    def seen_inputs(self, kind):
+        return {row[0] for row in self.db.execute("SELECT pmid FROM inputs WHERE kind = ?", (kind,))}
+
+    def mark_seen(self, pmids, kind):
+        self.db.executemany("INSERT OR IGNORE INTO inputs VALUES (?, ?)", ((p, kind) for p in pmids))
+        self.db.commit()
+
+    def ingested_hash(self, pmid):
+        row = self.db.execute("SELECT hash FROM ingested WHERE pmid = ?", (pmid,)).fetchone()
+        return row[0] if row else None
+
+    def mark_ingested(self, rows):
+        """
+        rows: (pmid, content hash, pub_date) of input records written by pubmed_ingest.py
+        """
+        self.db.executemany("INSERT OR REPLACE INTO ingested VALUES (?, ?, ?)", rows)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def plan(records, index, kind, field, prompt_version=PROMPT_VERSION, missing=()):
+    """
+    Split input records into the work needed for the next run.
+    records: input records, e.g. data/pubmed.json
+    field: 'ab' or 'author_affil'; records without it are skipped as before
+    missing: pmids known to be missing, e.g. data/missing_pmids.txt
+    Returns {'new': [...], 'missing': [...], 'failed': [...], 'stale': [...]} of input records
+    """
+    best = index.best_outputs(kind)
+    seen = index.seen_inputs(kind)
+    missing = set(missing)
+    prompt_version = int(prompt_version)
+    todo = {"new": [], "missing": [], "failed": [], "stale": []}
+    for record in records:
+        if field not in record.keys():
+            continue
+        pmid = str(record["pmid"])
+        if pmid not in best:
+            todo["missing" if pmid in seen or pmid in missing else "new"].append(record)
+        elif not best[pmid][1]:
+            todo["failed"].append(record)
+        elif best[pmid][0] != prompt_version:
+            todo["stale"].append(record)
+    return todo
+
+
+def merge_by_pmid(old, new):
+    """
+    Replace records in old with those in new sharing a pmid, e.g. authors and batch_results.
+    Linear replacement for [x for x in old if x['pmid'] not in [y['pmid'] for y in new]] + new
+    """
+    new_pmids = {x["pmid"] for x in new}
+    return [x for x in old if x["pmid"] not in new_pmids] + list(new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work out which PMIDs still need extracting")
+    parser.add_argument("input", help="e.g. data/pubmed.json")
+    parser.add_argument("output", help="JSON list of input records to process next")
+    parser.add_argument("--kind", choices=["abstracts", "authors"], default="abstracts")
+    parser.add_argument("--index", default="data/pmid_index.sqlite")
+    parser.add_argument("--outputs", nargs="*", default=None, help="Output files to check, defaults to the data/ snapshots")
+    parser.add_argument("--missing", default="data/missing_pmids.txt")
+    parser.add_argument("--prompt-version", type=int, default=PROMPT_VERSION, help="Current prompt version, outputs from other versions are stale")
+    parser.add_argument("--include", nargs="*", default=["new", "missing", "failed", "stale"])
+    args = parser.parse_args()
+
+    field = "ab" if args.kind == "abstracts" else "author_affil"
+    if args.outputs is None:
+        args.outputs = sorted({p for pattern in DEFAULT_OUTPUTS[args.kind] for p in glob.glob(pattern)})
+
+    index = PmidIndex(args.index)
+    print("Re-indexed {} of {} output files".format(index.refresh(args.outputs, args.kind), len(args.outputs)))
+
+    missing = []
+    if args.missing and os.path.exists(args.missing):
+        with open(args.missing) as f:
+            missing = [line.rstrip() for line in f if line.strip()]
+
+    records = list(iter_records(args.input))
+    todo = plan(records, index, args.kind, field, args.prompt_version, missing)
+    for k, v in todo.items():
+        print("{}: {}".format(k, len(v)))
+
+    work = [r for k in args.include for r in todo[k]]
+    with open(args.output, "w") as f:
+        json.dump(work, f)
+    print("Wrote {} records to {}".format(len(work), args.output))
+
+    index.mark_seen((str(r["pmid"]) for r in records), args.kind)
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import shutil
+
+from affil_resolver import AffiliationResolver, Automaton, learned_outputs, normalise
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+COUNTRIES = {"uk": "United Kingdom", "united kingdom": "United Kingdom", "ukraine": "Ukraine", "china": "China", "ca": "USA", "canada": "Canada"}
+INSTITUTIONS = {"University of Bristol": "United Kingdom", "Sichuan University": "China", "Bristol": None}
+
+
+def test_automaton_finds_overlapping_phrases():
+    automaton = Automaton()
+    for phrase in ("he", "she", "his", "hers"):
+        automaton.add(phrase, phrase)
+    found = automaton.build().matches("ushers")
+    assert sorted(found) == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
+
+
+def test_automaton_matches_whole_words_only():
+    automaton = Automaton()
+    for alias, country in COUNTRIES.items():
+        automaton.add(" {} ".format(alias), country)
+    automaton.build()
+    assert [value for _, _, value in automaton.matches(normalise("Kyiv, Ukraine"))] == ["Ukraine"]
+    assert [value for _, _, value in automaton.matches(normalise("London, UK."))] == ["United Kingdom"]
+    assert automaton.matches(normalise("Ukrainian Academy")) == []
+
+
+def test_resolve_fixed_affiliations():
+    resolver = AffiliationResolver(COUNTRIES, INSTITUTIONS)
+    assert resolver.resolve("Department of Epidemiology, Sichuan University, Chengdu, China.") == {
+        "institution": "Sichuan University", "country": "China", "confidence": 1.0}
+    # Only the first affiliation is used, and email addresses are dropped
+    assert resolver.resolve(["MRC Integrative Epidemiology Unit, University of Bristol, Bristol, UK. a.b@bristol.ac.uk; Kyiv, Ukraine"]) == {
+        "institution": "University of Bristol", "country": "United Kingdom", "confidence": 0.9}
+    # "CA" counts only as the last word, and a known institution in another country lowers the confidence
+    assert resolver.resolve("Sichuan University, CA Building, Chengdu, China")["country"] == "China"
+    assert resolver.resolve("Sichuan University, Chengdu, CA")["confidence"] == 0.5
+    assert resolver.resolve("Lab of Genetics") == {"institution": "", "country": "", "confidence": 0.0}
+
+
+def test_build_uses_the_index_in_its_data_dir(tmp_path):
+    for name in ("sdi.csv", "continent.csv", "countries.csv", "985_universities.txt", "211_universities.txt"):
+        shutil.copy(os.path.join(DATA_DIR, name), str(tmp_path))
+    shutil.copytree(os.path.join(DATA_DIR, "nature_index"), str(tmp_path / "nature_index"))
+    resolver = AffiliationResolver.build(data_dir=str(tmp_path))
+    assert (tmp_path / "country_index.json").exists()
+    assert resolver.resolve("Sichuan University, Chengdu, China.")["country"] == "China"
+
+
+def test_learned_outputs_skip_own_results(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("data")
+    for name in ("pubmed_authors.json", "pubmed_authors_local.json", "pubmed_authors_remaining.json", "pubmed_authors_new.failed.jsonl"):
+        open(os.path.join("data", name), "w").close()
+    assert learned_outputs() == ["data/pubmed_authors.json"]
@@ -0,0 +1,30 @@
+from batch_orchestrator import BatchOrchestrator
+from output_parser import DeadLetterQueue
+from prompts import abstract_messages
+from results_store import ResultsStore, iter_records
+from stub_server import FakeBatchAPI, FakeBatchClient
+
+
+def run(tmp_path, batch_delay):
+    records = [{"pmid": str(i), "ab": "Abstract {}".format(i)} for i in range(20)]
+    root = str(tmp_path / "batch")
+    with ResultsStore(root + ".results.jsonl") as store, DeadLetterQueue(root + ".failed.jsonl") as dead_letter:
+        orchestrator = BatchOrchestrator(FakeBatchClient(FakeBatchAPI(batch_delay=batch_delay)), root + ".state.json", store, dead_letter,
+                                         poll_interval=0.01, max_poll_interval=0.01)
+        orchestrator.prepare(records, abstract_messages, "ab", root, max_requests=8)
+        orchestrator.run()
+        store.compact(str(tmp_path / "out.json"))
+    return orchestrator, list(iter_records(str(tmp_path / "out.json"))), list(iter_records(root + ".failed.jsonl"))
+
+
+def test_batch_finished_on_create(tmp_path):
+    orchestrator, results, failed = run(tmp_path, batch_delay=0)
+    assert len(results) == 20
+    assert failed == []
+    assert all(s["status"] == "completed" and s["output_file_id"] for s in orchestrator.state["shards"])
+
+
+def test_batch_finished_after_polling(tmp_path):
+    _, results, failed = run(tmp_path, batch_delay=0.05)
+    assert len(results) == 20
+    assert failed == []
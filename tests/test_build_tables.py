@@ -0,0 +1,54 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from build_tables import BUCKETS, TableBuilder, default_inputs, flatten, to_table  # noqa: E402
+
+AUTHORS = [
+    {"pmid": "1", "institution": "University of Bristol", "country": "UK"},
+    {"pmid": "38176227", "institution": ["Southern Medical University", "Sichuan University"], "country": ["PR China", "PR China"]},
+]
+
+
+def test_flatten_author_lists():
+    columns = flatten(AUTHORS, "authors")["authors"]
+    assert columns["institution"] == ["University of Bristol", "Southern Medical University"]
+    assert columns["country"] == ["UK", "PR China"]
+    assert columns["countries"] == [["UK"], ["PR China", "PR China"]]
+    table = to_table("authors", columns)
+    assert table["country"].to_pylist() == ["UK", "PR China"]
+
+
+def test_emptied_source_removes_tables(tmp_path):
+    source = tmp_path / "pubmed_authors_20250502.json"
+    source.write_text(json.dumps(AUTHORS))
+    builder = TableBuilder(str(tmp_path / "tables"))
+    assert builder.update(str(source)) == 2
+    parts = [builder.part_path("authors", "20250502", str(source), b) for b in range(BUCKETS)]
+    assert any(os.path.exists(p) for p in parts)
+
+    source.write_text("[]")
+    assert builder.update(str(source)) == 2
+    assert not any(os.path.exists(p) for p in parts)
+    assert builder.manifest["sources"][str(source)]["hashes"] == {}
+
+
+def test_compacted_checkpoints_are_not_read_twice(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("data")
+    with open("data/pubmed_authors_new.jsonl", "w") as f:
+        f.write("".join(json.dumps(x) + "\n" for x in AUTHORS))
+    builder = TableBuilder("tables")
+    builder.update("data/pubmed_authors_new.jsonl")
+    assert default_inputs() == ["data/pubmed_authors_new.jsonl"]
+
+    with open("data/pubmed_authors_new.json", "w") as f:
+        json.dump(AUTHORS, f)
+    assert default_inputs() == ["data/pubmed_authors_new.json"]
+    builder.update("data/pubmed_authors_new.json")
+    builder.prune(default_inputs(), drop=["data/pubmed_authors_new.jsonl"])
+    assert list(builder.manifest["sources"]) == ["data/pubmed_authors_new.json"]
+    assert sum(len(os.listdir(os.path.join("tables", "authors", d))) for d in os.listdir(os.path.join("tables", "authors"))) == 2
@@ -0,0 +1,35 @@
+import asyncio
+import json
+
+from extract_engine import extract_all, pack_records
+from output_parser import DeadLetterQueue
+from prompts import packed_messages
+from run_ledger import RunLedger
+from stub_server import fake_completion
+
+
+def stub_call(drop=()):
+    async def call(messages):
+        body = fake_completion(messages, "stub")
+        content = json.loads(body["choices"][0]["message"]["content"])
+        content = json.dumps({k: v for k, v in content.items() if k not in drop})
+        return content, {k: body["usage"][k] for k in ("prompt_tokens", "completion_tokens")}
+    call.model = "stub"
+    return call
+
+
+def test_packed_results_and_failures_are_per_pmid(tmp_path):
+    records = [{"pmid": str(i), "ab": "Abstract {}".format(i)} for i in range(10)]
+    ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+    ledger.start("test", "abstracts", "stub")
+    with DeadLetterQueue(str(tmp_path / "failed.jsonl")) as dlq:
+        results, stats = asyncio.run(extract_all(pack_records(records, 5), stub_call(drop={"3"}), packed_messages, "group",
+                                                 on_failure=dlq.add, kind="abstracts", report_every=0, ledger=ledger))
+        assert "3" in dlq and "4" not in dlq
+    ledger.finish()
+    assert sorted(o["pmid"] for o in results) == [str(i) for i in range(10) if i != 3]
+    assert stats["done"] == 1 and stats["failed"] == 1
+    summary = ledger.summary(ledger.run_id)
+    assert summary["records"] == {"done": 9, "failed": 1}
+    assert summary["prompt_tokens"] == stats["prompt_tokens"]
+    assert [pmid for pmid, *_ in ledger.failures(ledger.run_id)] == ["3"]
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from journal_screen import JournalScreen
+
+LIST = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "predatory_journals.txt")
+
+
+@pytest.fixture(scope="module")
+def screen():
+    return JournalScreen(LIST)
+
+
+@pytest.mark.parametrize("journal", [
+    "Science",
+    "Science (New York, N.Y.)",
+    "Research",
+    "Sci",
+    "Journal of Science",
+    "International Journal of Science",
+    "Journal of Alzheimer's disease : JAD",
+    "Scientific reports",
+])
+def test_legitimate_or_generic_titles_do_not_match(screen, journal):
+    assert screen.match(journal) is None
+
+
+@pytest.mark.parametrize("journal, title", [
+    ("Frontiers in Genetics", "Frontiers in Genetics"),
+    ("Frontiers in genetics", "Frontiers in Genetics"),
+    ("J Clin Med", "Journal of Clinical Medicine"),
+    ("International journal of environmental research and public health", "International Journal of Environmental Research and Public Health"),
+])
+def test_listed_titles_match(screen, journal, title):
+    assert screen.match(journal) == title
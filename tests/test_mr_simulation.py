@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from mr_simulation import binned, first_stage, simulate, two_stage  # noqa: E402
+
+
+def lm(y, *columns):
+    """
+    Coefficients, residuals and the slope's standard error of lm(y ~ columns) for one replicate, the slope being the first column's
+    """
+    design = np.column_stack([np.ones(len(y)), *columns])
+    coef = np.linalg.lstsq(design, y, rcond=None)[0]
+    resid = y - design @ coef
+    cov = resid @ resid / (len(y) - design.shape[1]) * np.linalg.inv(design.T @ design)
+    return coef, resid, np.sqrt(cov[1, 1])
+
+
+def test_batched_estimates_match_per_replicate_lstsq():
+    G, X, Y = simulate(np.random.default_rng(1), 5, n=200, n_snps=4)
+    X_predicted, f_stat = first_stage(G, X)
+    e, _ = two_stage(G, X, Y)
+    n, k = G.shape[1], G.shape[2]
+    for r in range(len(X)):
+        coef, resid, _ = lm(X[r], G[r])
+        fitted = X[r] - resid
+        assert np.allclose(X_predicted[r], fitted)
+        ss_res = resid @ resid
+        ss_reg = ((fitted - fitted.mean()) ** 2).sum()
+        assert np.isclose(f_stat[r], (ss_reg / k) / (ss_res / (n - k - 1)))
+
+        coef, _, se = lm(Y[r], X[r])
+        assert np.isclose(e["obs"][r], coef[1]) and np.isclose(e["obs_se"][r], se)
+        coef, _, se = lm(Y[r], fitted)
+        assert np.isclose(e["iv"][r], coef[1]) and np.isclose(e["iv_se_naive"][r], se)
+        # The 2SLS standard error takes its residuals from the observed X, not the predicted one
+        resid = Y[r] - coef[0] - coef[1] * X[r]
+        resid = resid - resid.mean()
+        xc = fitted - fitted.mean()
+        assert np.isclose(e["iv_se"][r], np.sqrt(resid @ resid / (n - 2) / (xc @ xc)))
+
+
+@pytest.mark.parametrize("n", [100, 103])
+def test_bin_sizes_add_up_to_n(n):
+    G, X, Y = simulate(np.random.default_rng(2), 3, n=n, n_snps=2)
+    X_predicted, _ = first_stage(G, X)
+    b, sizes = binned(X_predicted, X, Y, n_bins=10)
+    assert sizes.sum() == n and sizes.max() - sizes.min() <= 1
+    # Bins follow predicted X, and their means weighted by size give back the overall mean
+    assert (np.diff(b["mean_X_predicted"], axis=1) >= 0).all()
+    assert np.allclose(b["mean_Y"] @ sizes / n, Y.mean(axis=1))
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from output_parser import DeadLetterQueue, ParseError, iter_batch_output, parse_content, parse_result, validate
+
+RESULT = {"exposures": [{"id": "1", "trait": "BMI", "category": "anthropometric"}], "outcomes": [], "methods": ["colocalization"],
+          "results": {"null": "1", "non-null": 2}}
+
+
+@pytest.mark.parametrize("text", [
+    json.dumps(RESULT),
+    "```json\n{}\n```".format(json.dumps(RESULT, indent=2)),
+    "\x00\n  " + json.dumps(RESULT) + " trailing text }",
+    "Here is {the} result: " + json.dumps(RESULT),
+])
+def test_parse_content(text):
+    assert parse_content(text) == RESULT
+
+
+@pytest.mark.parametrize("text, message", [
+    ("no object here", "no json object"),
+    ('{"exposures": [{"trait": "BMI", "category": "anthropometric"}], "outcomes": [', "invalid json"),
+    ("{'exposures': []}", "invalid json"),
+])
+def test_parse_content_errors(text, message):
+    with pytest.raises(ParseError, match=message):
+        parse_content(text)
+
+
+def test_validate_coerces_counts():
+    o = json.loads(json.dumps(RESULT))
+    assert validate(o) == []
+    assert o["results"] == {"null": 1, "non-null": 2}
+
+
+def test_validate_wrong_types():
+    assert validate([]) == ["result is not a json object"]
+    assert validate({"exposures": {}, "outcomes": [{"trait": 1, "category": "x"}], "methods": "MR", "results": {"null": -1}}) == [
+        "'exposures' is not a list", "outcomes[0] needs string 'trait' and 'category'", "'methods' is not a list of strings",
+        "results['null'] is not a count"]
+    assert validate({"institution": "University of Bristol", "country": ["UK"]}, "authors") == ["'country' is not a string"]
+
+
+def test_parse_result_adds_pmid():
+    o = parse_result(json.dumps({"institution": "University of Bristol", "country": "UK"}), "1", "authors")
+    assert o["pmid"] == "1"
+    with pytest.raises(ParseError, match="'exposures' is not a list"):
+        parse_result(json.dumps({"outcomes": []}), "1")
+
+
+def test_iter_batch_output():
+    def line(custom_id, status, content):
+        body = {"choices": [{"message": {"content": content}}], "usage": {"prompt_tokens": 10}}
+        return json.dumps({"custom_id": custom_id, "response": {"status_code": status, "body": body}})
+    lines = [line("1", 200, json.dumps(RESULT)), line("2", 200, "sorry"), line("3", 500, ""), "", "not json",
+             json.dumps({"custom_id": "4", "error": {"message": "expired"}}).encode("utf-8")]
+    usage = {}
+    out = list(iter_batch_output(lines, on_usage=usage.__setitem__))
+    assert [(c, r is not None, reason) for c, r, reason in out] == [
+        ("1", True, None), ("2", False, "no json object in response"), ("3", False, "http 500: "),
+        (None, False, "unreadable output line"), ("4", False, "batch error: expired")]
+    assert set(usage) == {"1", "2", "3"}
+
+
+def test_dead_letter_queue(tmp_path):
+    path = str(tmp_path / "failed.jsonl")
+    with DeadLetterQueue(path) as dlq:
+        dlq.add("1", "ParseError: invalid json: Expecting value", content="x" * 5000)
+        dlq.add("2", "RateLimitError: too many requests", stage="request")
+        dlq.add("1", "ParseError: 'exposures' is not a list")
+    with DeadLetterQueue(path) as dlq:
+        assert "1" in dlq and "3" not in dlq
+        # The latest entry for each pmid counts
+        assert dlq.reasons() == {"ParseError": 1, "RateLimitError": 1}
+    with open(path) as f:
+        records = [json.loads(x) for x in f]
+    assert len(records[0]["content"]) == 2000 and "content" not in records[1]
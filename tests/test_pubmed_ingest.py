@@ -0,0 +1,45 @@
+import json
+
+from pubmed_ingest import ingest, seed
+from results_store import ResultsStore
+from work_planner import PmidIndex
+
+ARTICLE = """<?xml version="1.0"?>
+<PubmedArticleSet>
+<PubmedArticle>
+<MedlineCitation>
+<PMID>38176227</PMID>
+<DateRevised><Year>2024</Year><Month>01</Month><Day>10</Day></DateRevised>
+<Article>
+<Journal><ISSN>1234-5678</ISSN><JournalIssue><PubDate><Year>2024</Year><Month>Jan</Month></PubDate></JournalIssue><Title>Frontiers in Genetics</Title></Journal>
+<ArticleTitle>A Mendelian randomization study</ArticleTitle>
+<Abstract><AbstractText>{abstract}</AbstractText></Abstract>
+<AuthorList><Author><AffiliationInfo><Affiliation>Southern Medical University, Guangzhou, China.</Affiliation></AffiliationInfo></Author></AuthorList>
+</Article>
+</MedlineCitation>
+</PubmedArticle>
+</PubmedArticleSet>
+"""
+
+
+def run(tmp_path, index, abstract):
+    export = tmp_path / "export.xml"
+    export.write_text(ARTICLE.format(abstract=abstract))
+    with ResultsStore(str(tmp_path / "staging.jsonl")) as store:
+        stats, rows = ingest([str(export)], index, store)
+    index.mark_ingested(rows)
+    return stats
+
+
+def test_seeded_records_are_not_emitted_again(tmp_path):
+    # Records in data/pubmed.json have no title, journal or pub_date
+    existing = tmp_path / "pubmed.json"
+    existing.write_text(json.dumps([{"pmid": "38176227", "ab": "We used MR.", "author_affil": "Southern Medical University, Guangzhou, China."}]))
+    index = PmidIndex(str(tmp_path / "index.sqlite"))
+    assert seed([str(existing)], index) == 1
+
+    assert run(tmp_path, index, "We used MR.")["unchanged"] == 1
+    assert run(tmp_path, index, "We used MR.")["unchanged"] == 1
+    assert run(tmp_path, index, "We used two-sample MR.")["updated"] == 1
+    # Seeding again does not hide the revision already recorded
+    assert seed([str(existing)], index) == 0
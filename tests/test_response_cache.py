@@ -0,0 +1,67 @@
+import asyncio
+import itertools
+import time
+
+import pytest
+
+from response_cache import CacheMiss, ResponseCache, cached_call, request_key
+
+MESSAGES = [{"role": "user", "content": "Abstract 1"}]
+
+
+def test_key_changes_with_model_and_messages():
+    key = request_key("gpt-3.5-turbo", MESSAGES)
+    assert key == request_key("gpt-3.5-turbo", [dict(m) for m in MESSAGES])
+    assert key != request_key("gpt-4o-mini", MESSAGES)
+    assert key != request_key("gpt-3.5-turbo", [{"role": "user", "content": "Abstract 2"}])
+    assert key != request_key("gpt-3.5-turbo", [{"role": "system", "content": "Abstract 1"}])
+
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=30)
+    for i in range(3):
+        cache.put("m", [{"content": str(i)}], "x" * 10, {})
+    # Reading the first response makes the second the least recently used
+    assert cache.get("m", [{"content": "0"}]) == ("x" * 10, {})
+    cache.put("m", [{"content": "3"}], "x" * 10, {})
+    assert cache.get("m", [{"content": "1"}]) is None
+    assert [cache.get("m", [{"content": str(i)}]) is not None for i in (0, 2, 3)] == [True, True, True]
+    assert cache.stats["evictions"] == 1 and cache.size() == 30
+    # Replacing a response only counts the difference in size
+    cache.put("m", [{"content": "3"}], "x" * 5, {})
+    assert cache.stats["evictions"] == 1 and cache.size() == 25
+    cache.close()
+
+
+def test_misses_count_once_per_key(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get("m", MESSAGES) is None
+    assert cache.get("m", MESSAGES) is None
+    cache.put("m", MESSAGES, "{}", {"prompt_tokens": 3})
+    assert cache.get("m", MESSAGES) == ("{}", {"prompt_tokens": 3})
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+    cache.close()
+
+
+def test_replay_raises_instead_of_calling(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path)
+    cache.put("m", MESSAGES, "{}", {"prompt_tokens": 3})
+    cache.close()
+
+    calls = []
+
+    async def call(messages):
+        calls.append(messages)
+        return "{}", {}
+    call.model = "m"
+    replay = ResponseCache(path, replay=True)
+    wrapped = cached_call(call, replay)
+    # Cached responses report no usage
+    assert asyncio.run(wrapped(MESSAGES)) == ("{}", {})
+    with pytest.raises(CacheMiss):
+        asyncio.run(wrapped([{"role": "user", "content": "Abstract 2"}]))
+    assert calls == [] and len(replay) == 1
+    replay.close()
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from results_store import ResultsStore, iter_json_list, iter_jsonl, iter_records
+
+RECORDS = [{"pmid": str(i), "ab": "Results [{}], see {{note}}, été \"quoted\"".format(i) * (i % 4 + 1)} for i in range(20)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 16])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_json_list_across_chunks(tmp_path, chunk_size, indent):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps(RECORDS, indent=indent, ensure_ascii=False), encoding="utf-8")
+    assert list(iter_json_list(str(path), chunk_size)) == RECORDS
+
+
+def test_json_list_edge_cases(tmp_path):
+    path = tmp_path / "records.json"
+    path.write_text(" \n[ ]\n")
+    assert list(iter_json_list(str(path), 2)) == []
+    path.write_text('{"pmid": "1"}')
+    with pytest.raises(ValueError):
+        list(iter_json_list(str(path)))
+    path.write_text('[{"pmid": "1"}, {"pmid": ')
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_list(str(path), 4))
+
+
+def test_torn_line_is_dropped_on_reopen(tmp_path):
+    path = str(tmp_path / "store.jsonl")
+    with ResultsStore(path) as store:
+        for record in RECORDS[:3]:
+            store.append(record)
+    # An interrupted run leaves half a record at the end of the file
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(RECORDS[3])[:10])
+    assert [x["pmid"] for x in iter_jsonl(path)] == ["0", "1", "2"]
+
+    with ResultsStore(path) as store:
+        assert len(store) == 3 and "3" not in store
+        assert store.todo(RECORDS[:5]) == RECORDS[3:5]
+        for record in RECORDS[3:5]:
+            store.append(record)
+    assert list(iter_records(path)) == RECORDS[:5]
+
+
+def test_compact_keeps_the_last_record_per_pmid(tmp_path):
+    path = str(tmp_path / "store.jsonl")
+    with ResultsStore(path, fsync_every=1) as store:
+        store.append({"pmid": "1", "n": 1})
+        store.append({"pmid": "2", "n": 1})
+        store.append({"pmid": "1", "n": 2})
+        store.compact(str(tmp_path / "out.json"))
+    with open(str(tmp_path / "out.json")) as f:
+        assert json.load(f) == [{"pmid": "2", "n": 1}, {"pmid": "1", "n": 2}]
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from snapshot_merge import upsert
+
+DONE = {"exposures": [], "outcomes": [], "methods": []}
+
+
+def write(path, records):
+    with open(str(path), "w") as f:
+        json.dump(records, f)
+    return str(path)
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    old = write(tmp_path / "pubmed_abstracts_20240101.json", [
+        {"pmid": "1", **DONE, "prompt_version": "10", "n": "old"},
+        {"pmid": "2", **DONE, "n": "old"},
+        {"pmid": "3", **DONE, "n": "old"},
+        {"pmid": "4", **DONE, "n": "old"},
+    ])
+    new = write(tmp_path / "pubmed_abstracts_20250502.json", [
+        {"pmid": "1", **DONE, "prompt_version": "2", "n": "new"},
+        {"pmid": "2", "exposures": [], "n": "new"},
+        {"pmid": "3", **DONE, "n": "new first"},
+        {"pmid": "3", **DONE, "n": "new"},
+        {"pmid": "5", **DONE, "n": "new"},
+    ])
+    return [old, new]
+
+
+def merged(snapshots, tmp_path, precedence, run_size=200000):
+    output = str(tmp_path / "merged.json")
+    stats = upsert(snapshots, output, "abstracts", precedence, run_size)
+    with open(output) as f:
+        return {x["pmid"]: x for x in json.load(f)}, stats
+
+
+@pytest.mark.parametrize("run_size", [2, 200000])
+def test_latest_source_wins(snapshots, tmp_path, run_size):
+    old, new = snapshots
+    records, stats = merged(snapshots, tmp_path, "latest", run_size)
+    assert {p: x["n"] for p, x in records.items()} == {"1": "new", "2": "old", "3": "new", "4": "old", "5": "new"}
+    # A record missing a required field never wins
+    assert records["2"]["provenance"] == {"source": old, "snapshot": "20240101", "prompt_version": "2", "replaced": [new]}
+    assert records["3"]["provenance"]["replaced"] == [old, new]
+    assert records["4"]["provenance"]["replaced"] == []
+    assert records["1"]["prompt_version"] == "2"
+    assert stats[old]["kept"] == 2 and stats[old]["superseded"] == 2
+    assert stats[new]["read"] == 5 and stats[new]["kept"] == 3 and stats[new]["superseded"] == 2
+
+
+def test_newest_prompt_version_wins(snapshots, tmp_path):
+    old, new = snapshots
+    records, _ = merged(snapshots, tmp_path, "prompt-version")
+    # Version 10 beats version 2 although it comes from the older source
+    assert records["1"]["n"] == "old"
+    assert records["1"]["provenance"] == {"source": old, "snapshot": "20240101", "prompt_version": "10", "replaced": [new]}
+    assert records["3"]["n"] == "new"
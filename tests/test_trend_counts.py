@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+from build_tables import TableBuilder  # noqa: E402
+from trend_counts import TrendAggregator, aggregate_part, pmid_years  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ABSTRACTS = [
+    {"pmid": "1", "exposures": [{"trait": "BMI", "category": "anthropometric"}], "outcomes": [{"trait": "NAFLD", "category": "metabolic disease"}],
+     "methods": ["two-sample mendelian randomisation"]},
+    {"pmid": "2", "exposures": [{"trait": "PM2.5", "category": "environmental"}], "outcomes": [], "methods": ["Two-sample Mendelian randomization "]},
+    {"pmid": "3", "exposures": [], "outcomes": [], "methods": ["colocalization"]},
+]
+AUTHORS = [
+    {"pmid": "1", "institution": "University of Bristol", "country": "UK"},
+    {"pmid": "2", "institution": ["Southern Medical University", "Sichuan University"], "country": ["PR China", "PR China"]},
+]
+INPUTS = [{"pmid": "1", "pub_date": "2023-05-01"}, {"pmid": "2", "pub_date": "2024-01-10"}]
+
+
+def test_aggregate_part_counts_list_valued_countries():
+    table = pa.table({"pmid": ["1", "2", "3"], "country": pa.array([["UK"], ["PR China", "PR China"], []], pa.list_(pa.string()))})
+    years = pa.table({"pmid": pa.array(["1", "2"], pa.string()), "year": pa.array([2023, 2024], pa.int32())})
+
+    class Index:
+        countries = {"United Kingdom": {"sdi": "High SDI"}, "China": {"sdi": "High-middle SDI"}}
+
+        def resolve(self, country):
+            return {"UK": "United Kingdom", "PR China": "China"}.get(country)
+
+    counts, unknown = aggregate_part("authors", table, years, Index())
+    assert sorted(counts["country"]) == [("China", 2024, 1), ("United Kingdom", 2023, 1)]
+    assert sorted(counts["sdi"]) == [("High SDI", 2023, 1), ("High-middle SDI", 2024, 1)]
+    assert unknown == 1
+
+
+def test_rerun_recomputes_nothing(tmp_path, monkeypatch):
+    # The country index is read from data/ in the repository
+    monkeypatch.chdir(ROOT)
+    sources = [str(tmp_path / "pubmed_abstracts_merged.json"), str(tmp_path / "pubmed_authors_merged.json")]
+    for path, records in zip(sources, (ABSTRACTS, AUTHORS)):
+        with open(path, "w") as f:
+            json.dump(records, f)
+    inputs = tmp_path / "pubmed.json"
+    inputs.write_text(json.dumps(INPUTS))
+    assert pmid_years([str(inputs)]).num_rows == 2
+
+    builder = TableBuilder(str(tmp_path / "tables"))
+    for path in sources:
+        builder.update(path)
+    cache = str(tmp_path / "aggregates.json")
+    totals, recomputed = TrendAggregator(builder, cache).update(sources, [str(inputs)])
+    assert recomputed > 0
+    assert totals["method"] == {("two-sample mendelian randomization", 2023): 1, ("two-sample mendelian randomization", 2024): 1}
+    assert totals["all"] == {("all", 2023): 1, ("all", 2024): 1}
+    assert sum(totals["country"].values()) == 2
+
+    again, recomputed = TrendAggregator(builder, cache).update(sources, [str(inputs)])
+    assert recomputed == 0
+    assert again == totals
@@ -0,0 +1,24 @@
+import json
+
+from output_parser import parse_result
+from work_planner import PmidIndex, plan
+
+RESULT = {"exposures": [], "outcomes": [], "methods": []}
+
+
+def test_stamped_records_are_not_stale(tmp_path):
+    output = tmp_path / "pubmed_abstracts.json"
+    output.write_text(json.dumps([parse_result(json.dumps(RESULT), "1", prompt_version="10"),
+                                  {"pmid": "2", **RESULT},
+                                  {"pmid": "3", "exposures": [], "outcomes": []}]))
+    older = tmp_path / "pubmed_abstracts_20240101.json"
+    older.write_text(json.dumps([parse_result(json.dumps(RESULT), "1", prompt_version="2")]))
+    index = PmidIndex(str(tmp_path / "index.sqlite"))
+    index.refresh([str(output), str(older)], "abstracts")
+    records = [{"pmid": str(i), "ab": "Abstract"} for i in range(1, 5)]
+
+    todo = plan(records, index, "abstracts", "ab", prompt_version="10")
+    assert [x["pmid"] for x in todo["stale"]] == ["2", "3"]
+    assert [x["pmid"] for x in todo["new"]] == ["4"]
+    # Version 10 is newer than version 2, so the best output of pmid 1 is the one from version 10
+    assert index.best_outputs("abstracts")["1"] == (10, 1)